@@ -0,0 +1,47 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+'''
+Augmentation of batches of NCHW images as they are drawn from the dataset, instead of storing mirrored
+and shifted copies of every image. The arrays of each resolution can hold images a few pixels larger than
+the resolution (see scripts/image_reshape.py), from which a window of the resolution is cut at a random
+offset, and windows are mirrored left to right at random. Everything is done for the whole batch at once.
+'''
+
+
+# Center size x size window of NCHW images
+def center_crop(imgs, size):
+    h, w = imgs.shape[2:]
+    y, x = (h - size) // 2, (w - size) // 2
+    return imgs[:, :, y:y + size, x:x + size]
+
+
+# NCHW images cut from the center to a multiple of size and averaged down to size x size
+def downscale(imgs, size):
+    if imgs.shape[2] < size:
+        raise ValueError('Cannot downscale {}x{} images to {}x{}'.format(
+            imgs.shape[2], imgs.shape[3], size, size))
+    factor = imgs.shape[2] // size
+    imgs = center_crop(imgs, size * factor)
+    if factor == 1:
+        return imgs
+    n, c = imgs.shape[:2]
+    return imgs.reshape(n, c, size, factor, size, factor).mean((3, 5))
+
+
+# size x size window of each image at a random offset, mirrored with probability 0.5 if flip. The windows
+# are gathered from a strided view of all windows, so each image is only copied once.
+def crop_flip(imgs, size, random, flip=True):
+    n, c, h, w = imgs.shape
+    y = random.randint(0, h - size + 1, n)
+    x = random.randint(0, w - size + 1, n)
+    if h == size and w == size:
+        out = np.array(imgs)
+    else:
+        out = sliding_window_view(imgs, (size, size), axis=(2, 3))[np.arange(n), :, y, x]
+
+    if flip:
+        flipped = random.rand(n) < 0.5
+        out[flipped] = out[flipped, :, :, ::-1]
+    return out
@@ -0,0 +1,204 @@
+import json
+import multiprocessing as mp
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import device_lib
+
+import session_config
+
+
+'''
+Finds the batch size of every layer of a ProGAN that trains fastest within a memory budget, instead of
+tuning batch_sizes by hand until nothing runs out of memory. Each candidate batch size is run in a new
+process that builds the ProGAN: one traced step of the generator and of the discriminator, and a few
+untraced steps for the number of images per second. Batch sizes are tried from small to large until one
+doesn't fit, and the fastest one that fits is chosen.
+
+On a GPU the peak memory is the largest number of bytes in use by the allocators of the device during
+the traced steps. On CPU these allocator statistics are off and running out of memory gets the process
+killed instead of raising an error, so the peak memory is the largest resident set size of the process,
+and a process that dies counts as out of memory. Nothing is run in the calling process, which would
+otherwise hold on to the memory of the device.
+
+The schedule can be saved as batch_sizes in the JSON config file of the model (see cli.py), where
+ProGAN picks it up like a hand-written list. Images and latent vectors are zeros, the time of a step
+doesn't depend on their values, so no training data is read. Batch sizes are per worker.
+'''
+
+
+def default_candidates(max_batch_size=256):
+    return [2 ** i for i in range(int(np.log2(max_batch_size)) + 1)]
+
+
+# Largest number of bytes in use by an allocator during a run traced with FULL_TRACE
+def peak_bytes(run_metadata):
+    peak = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peak = max(peak, memory.allocator_bytes_in_use, memory.peak_bytes)
+    return peak
+
+
+# Peak memory in bytes reported by the allocators and images per second of the training steps of layer at
+# batch_size, run in the session of progan, which trains its variables. The peak memory is None if the
+# step ran out of memory. The allocator statistics are only collected on a GPU, see measure_process.
+def measure(progan, layer, batch_size, n_steps=5):
+    network = progan.networks[layer]
+    feed_dict = {
+        progan.x_placeholder: np.zeros([batch_size, 3, network.dim, network.dim],
+                                       progan.x_placeholder.dtype.as_numpy_dtype),
+        progan.z_placeholder: np.zeros([batch_size, progan.z_length])
+    }
+
+    # The session of progan already holds the initialized variables, a second session would hold them twice
+    sess = progan.sess
+    try:
+        peak = 0
+        for op in (network.g_train, network.d_train):
+            run_metadata = tf.RunMetadata()
+            sess.run(op, feed_dict, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                     run_metadata=run_metadata)
+            peak = max(peak, peak_bytes(run_metadata))
+
+        # Untraced runs are prepared separately from traced ones, so they are warmed up again
+        sess.run(network.g_train, feed_dict)
+        sess.run(network.d_train, feed_dict)
+
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            sess.run(network.g_train, feed_dict)
+            sess.run(network.d_train, feed_dict)
+        return peak, n_steps * batch_size / (time.perf_counter() - start)
+
+    except tf.errors.ResourceExhaustedError:
+        return None, 0.0
+
+
+# Peak resident set size of this process in bytes
+def peak_rss():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+# Build a ProGAN from progan_kwargs in a process of its own and put its layers, batch sizes and minibatch
+# stddev group size on results, followed by the measurement of batch_size at layer if one is given. The
+# model is built in an empty logdir, so nothing is restored or written next to the real checkpoints.
+def _measure_process(progan_kwargs, layer, batch_size, n_steps, results):
+    from progan_v16 import ProGAN
+
+    progan_kwargs = dict(progan_kwargs)
+    if progan_kwargs.get('session_options') is None:
+        progan_kwargs['session_options'] = session_config.load(progan_kwargs['logdir']) or dict()
+    logdir = tempfile.mkdtemp()
+    try:
+        progan = ProGAN(**dict(progan_kwargs, logdir=logdir))
+        results.put({'n_layers': progan.n_layers, 'batch_sizes': list(progan.batch_sizes),
+                     'stddev_group_size': progan.stddev_group_size})
+
+        if batch_size is not None:
+            peak, imgs_per_sec = measure(progan, layer, batch_size, n_steps)
+            gpu = any(device.device_type == 'GPU' for device in device_lib.list_local_devices())
+            results.put({'allocator_peak': peak, 'peak_rss': peak_rss(), 'gpu': gpu,
+                         'imgs_per_sec': imgs_per_sec})
+    finally:
+        shutil.rmtree(logdir, ignore_errors=True)
+
+
+# Run _measure_process and return what it put on its queue. The second item is missing if the process
+# died, e.g. when it was killed for running out of memory.
+def _run_process(progan_kwargs, layer=None, batch_size=None, n_steps=5):
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=_measure_process, args=(progan_kwargs, layer, batch_size, n_steps, results))
+    process.start()
+
+    items = []
+    while len(items) < (1 if batch_size is None else 2):
+        try:
+            items.append(results.get(timeout=1))
+        except queue.Empty:
+            if not process.is_alive():
+                break
+    process.join()
+    return items
+
+
+# Layers, default batch sizes and minibatch stddev group size of the ProGAN built from progan_kwargs
+def describe(progan_kwargs):
+    items = _run_process(progan_kwargs)
+    if not items:
+        raise RuntimeError('Building the ProGAN failed, see the error above')
+    return items[0]
+
+
+# Peak memory in bytes and images per second of the training steps of layer at batch_size, measured in a
+# new process. The peak is that of the device's allocators on a GPU and the peak resident set size on CPU,
+# and None if the process ran out of memory or died.
+def measure_process(progan_kwargs, layer, batch_size, n_steps=5):
+    items = _run_process(progan_kwargs, layer, batch_size, n_steps)
+    if len(items) < 2:
+        return None, 0.0
+
+    result = items[1]
+    if result['allocator_peak'] is None:
+        return None, 0.0
+    if not result['gpu']:
+        return result['peak_rss'], result['imgs_per_sec']
+    if not result['allocator_peak']:
+        raise RuntimeError('The GPU allocators reported no memory in use, the peak memory is unknown')
+    return result['allocator_peak'], result['imgs_per_sec']
+
+
+# Fastest batch size of each layer of the ProGAN built from progan_kwargs whose peak memory is at most
+# budget_mb. Layers where not even the smallest candidate fits keep their batch size from the model's
+# batch_sizes. Returns the list of batch sizes.
+def find_batch_sizes(progan_kwargs, budget_mb, candidates=None, n_steps=5, layers=None):
+    model = describe(progan_kwargs)
+    candidates = sorted(candidates if candidates is not None else default_candidates())
+    group_size = model['stddev_group_size']
+    if group_size:
+        # Batches larger than a minibatch stddev group have to split into whole groups
+        candidates = [b for b in candidates if b <= group_size or b % group_size == 0]
+
+    budget = budget_mb * 2 ** 20
+    schedule = list(model['batch_sizes'])
+    schedule += schedule[-1:] * (model['n_layers'] - len(schedule))
+
+    for layer in (layers if layers is not None else range(model['n_layers'])):
+        dim = 2 ** (layer + 2)
+        results = []
+        for batch_size in candidates:
+            peak, imgs_per_sec = measure_process(progan_kwargs, layer, batch_size, n_steps)
+            fits = peak is not None and peak <= budget
+            print('{}x{} ---- batch size: {} ---- peak memory: {} ---- images/sec: {:.2f}'.format(
+                dim, dim, batch_size, 'out of memory' if peak is None else '{:.1f} MB'.format(peak / 2 ** 20),
+                imgs_per_sec))
+            if not fits:
+                break
+            results.append((imgs_per_sec, batch_size))
+
+        if results:
+            schedule[layer] = max(results)[1]
+            print('{}x{} ---- fastest batch size within {} MB: {}\n'.format(dim, dim, budget_mb, schedule[layer]))
+        else:
+            print('{}x{} ---- no batch size fits in {} MB, keeping {}\n'.format(
+                dim, dim, budget_mb, schedule[layer]))
+
+    return schedule
+
+
+# Write batch_sizes into the JSON config file at config_path, keeping its other values
+def save_schedule(config_path, batch_sizes):
+    with open(config_path) as f:
+        config = json.load(f)
+    config['batch_sizes'] = batch_sizes
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=4)
@@ -0,0 +1,56 @@
+import sys
+import tempfile
+
+import numpy as np
+
+from feed_dict import FeedDict
+
+
+'''
+Compares loading whole arrays with interleaved sampling from several open memmaps (see FeedDict) at
+each resolution found in imgdir:
+
+    io amplification    bytes read from disk per byte of images returned
+    batch ms            mean and 95th percentile time to assemble a batch
+    arrays per batch    average number of different arrays the images of a batch come from
+
+Timings include reading from disk only the first time an array is read, after that it is usually in
+the page cache.
+'''
+
+
+def _arrays_per_batch(fd, res):
+    if fd.n_open_shards:
+        sampler = fd.samplers[res]
+        return len(np.unique(sampler.batch_ids[:, 0] % len(sampler.paths)))
+    return 1
+
+
+def benchmark(imgdir, batch_size=16, n_batches=200, open_shards=(None, 2, 4, 8), resolutions=None):
+    logdir = tempfile.mkdtemp()
+    probe = FeedDict(imgdir, logdir)
+    resolutions = resolutions or [s for s in probe.arrays if probe.arrays[s]]
+
+    results = dict()
+    for res in resolutions:
+        for n_open in open_shards:
+            fd = FeedDict(imgdir, logdir, seed=0, n_open_shards=n_open)
+            mixing = []
+            for _ in range(n_batches):
+                fd.next_batch(batch_size, res)
+                mixing.append(_arrays_per_batch(fd, res))
+
+            stats = fd.io_stats()
+            stats['arrays_per_batch'] = float(np.mean(mixing))
+            results[res, n_open] = stats
+            print('{}x{} ---- {} ---- io amplification: {:.2f} ---- batch ms: {:.3f} (p95 {:.3f}) '
+                  '---- arrays per batch: {:.2f}'.format(
+                res, res, 'whole arrays' if n_open is None else '{} open arrays'.format(n_open),
+                stats['io_amplification'], stats['batch_ms_mean'], stats['batch_ms_p95'],
+                stats['arrays_per_batch']))
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1])
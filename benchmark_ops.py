@@ -0,0 +1,154 @@
+import json
+import sys
+import time
+
+from ops import *
+
+
+'''
+Micro-benchmarks for the ops used in building the network. Each benchmark builds a small graph
+for every resolution of the model and times a forward and backward pass on the CPU.
+'''
+
+# Default channels and batch sizes of ProGAN for the resolutions 4x4 - 1024x1024
+resolutions = [2 ** i for i in range(2, 11)]
+channels = [512, 512, 512, 512, 256, 128, 64, 32, 16]
+batch_sizes = [16, 16, 16, 16, 16, 16, 8, 4, 3]
+
+
+def _time(sess, fetches, n_iter):
+    sess.run(fetches)
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        sess.run(fetches)
+    return (time.perf_counter() - start) / n_iter
+
+
+# Build upscale conv, downscale conv and decrese_res for every resampling mode on shared variables
+def _resample_graph(res, n_channels, batch_size):
+    x = tf.constant(np.random.normal(size=[batch_size, n_channels, res, res]), tf.float32)
+    outputs = dict()
+
+    with tf.variable_scope('resample_{}'.format(res), reuse=tf.AUTO_REUSE):
+        for mode in resample_modes:
+            with tf.variable_scope('upscale'):
+                up = conv(x, n_channels, mode='upscale', resample=mode)
+            with tf.variable_scope('downscale'):
+                down = conv(x, n_channels, mode='downscale', resample=mode)
+            blur = decrese_res(x, resample=mode)
+
+            ys = [up, down, blur]
+            grads = tf.gradients([tf.reduce_sum(y) for y in ys], [x])
+            outputs[mode] = (ys, grads)
+
+    return outputs
+
+
+# Check that all resampling modes produce the same outputs and gradients
+def check_resample(res=16, n_channels=8, batch_size=4, atol=1e-4):
+    with tf.Graph().as_default(), tf.Session() as sess:
+        outputs = _resample_graph(res, n_channels, batch_size)
+        sess.run(tf.global_variables_initializer())
+        results = sess.run(outputs)
+
+    reference = results[resample_modes[0]]
+    for mode in resample_modes[1:]:
+        for a, b in zip(reference[0] + reference[1], results[mode][0] + results[mode][1]):
+            max_diff = np.max(np.abs(a - b))
+            assert max_diff < atol, 'resample mode {} differs by {}'.format(mode, max_diff)
+    print('Resample modes {} are equivalent at {}x{}'.format(resample_modes, res, res))
+
+
+# Time every resampling mode at each resolution and return the fastest mode for each
+def benchmark_resample(n_iter=10):
+    fastest = []
+    for res, n_channels, batch_size in zip(resolutions, channels, batch_sizes):
+        with tf.Graph().as_default(), tf.Session() as sess:
+            outputs = _resample_graph(res, n_channels, batch_size)
+            sess.run(tf.global_variables_initializer())
+            times = {mode: _time(sess, outputs[mode], n_iter) for mode in resample_modes}
+
+        best = min(times, key=times.get)
+        fastest.append(best)
+        print('{}x{}: '.format(res, res) + ', '.join(
+            '{} {:.2f} ms'.format(mode, t * 1000) for mode, t in times.items()) +
+            ' ---- fastest: {}'.format(best))
+
+    return fastest
+
+
+# Previous tile/sqrt based implementations (concatenating on the channel axis), kept for comparison
+def _minibatch_stddev_tile(input):
+    shape = tf.shape(input)
+    x_ = tf.tile(tf.reduce_mean(input, 0, keepdims=True), [shape[0], 1, 1, 1])
+    sigma = tf.sqrt(tf.reduce_mean(tf.square(input - x_), 0, keepdims=True) + 1e-8)
+    sigma_avg = tf.reduce_mean(sigma, keepdims=True)
+    layer = tf.tile(sigma_avg, [shape[0], 1, shape[2], shape[3]])
+    return tf.concat((input, layer), 1)
+
+
+def _pixelwise_norm_sqrt(input):
+    pixel_var = tf.reduce_mean(tf.square(input), 1, keepdims=True)
+    return input / tf.sqrt(pixel_var + 1e-8)
+
+
+# Check gradients of minibatch_stddev and pixelwise_norm against numerical estimates
+def check_gradients(batch_size=4, n_channels=4, res=4, group_size=2, max_error=1e-2):
+    shape = [batch_size, n_channels, res, res]
+    with tf.Graph().as_default(), tf.Session():
+        x = tf.constant(np.random.normal(size=shape), tf.float64)
+        ops_to_check = [
+            ('minibatch_stddev', minibatch_stddev(x), [batch_size, n_channels + 1, res, res]),
+            ('minibatch_stddev(group_size={})'.format(group_size),
+             minibatch_stddev(x, group_size), [batch_size, n_channels + 1, res, res]),
+            ('pixelwise_norm', pixelwise_norm(x), shape)
+        ]
+        for name, y, y_shape in ops_to_check:
+            error = tf.test.compute_gradient_error(x, shape, y, y_shape)
+            assert error < max_error, '{} gradient error {}'.format(name, error)
+            print('{} gradient error: {}'.format(name, error))
+
+    # Without groups the new minibatch_stddev matches the previous implementation
+    with tf.Graph().as_default(), tf.Session() as sess:
+        x = tf.constant(np.random.normal(size=shape), tf.float32)
+        a, b = sess.run([minibatch_stddev(x), _minibatch_stddev_tile(x)])
+        assert np.allclose(a, b, atol=1e-5)
+
+
+# Time forward and backward passes of the normalization ops at each resolution
+def benchmark_norm_ops(n_iter=10, group_size=4):
+    implementations = [
+        ('minibatch_stddev', minibatch_stddev),
+        ('minibatch_stddev(group_size={})'.format(group_size),
+         lambda x: minibatch_stddev(x, group_size)),
+        ('minibatch_stddev (tile)', _minibatch_stddev_tile),
+        ('pixelwise_norm', pixelwise_norm),
+        ('pixelwise_norm (sqrt)', _pixelwise_norm_sqrt)
+    ]
+
+    for res, n_channels, batch_size in zip(resolutions, channels, batch_sizes):
+        with tf.Graph().as_default(), tf.Session() as sess:
+            x = tf.constant(np.random.normal(size=[batch_size, n_channels, res, res]), tf.float32)
+            times = []
+            for name, op in implementations:
+                if batch_size % group_size and 'group_size' in name:
+                    continue
+                y = op(x)
+                times.append((name, _time(sess, [y, tf.gradients(y, x)], n_iter)))
+
+        print('{}x{}: '.format(res, res) + ', '.join(
+            '{} {:.2f} ms'.format(name, t * 1000) for name, t in times))
+
+
+if __name__ == '__main__':
+    check_gradients()
+    benchmark_norm_ops()
+
+    check_resample()
+    resample_mode = benchmark_resample()
+    print('resample_mode={}'.format(resample_mode))
+
+    # Optionally save the result so it can be passed to ProGAN(resample_mode=...)
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'w') as f:
+            json.dump(resample_mode, f)
@@ -0,0 +1,105 @@
+import sys
+
+import numpy as np
+import tensorflow as tf
+
+import batch_size_finder
+import session_config
+from progan_v16 import ProGAN
+
+
+'''
+Compares ProGAN compiled with XLA against the uncompiled graph. Two ways of compiling are checked:
+
+    auto    XLA auto-clustering of the whole graph, enabled through the session config
+    jit     ProGAN(jit=True), which compiles the generator, discriminator and losses of every
+            resolution (forward and backward) while leaving the data and bookkeeping ops alone
+
+For the equivalence check each model is built in its own graph and the compiled one gets a copy of the
+variables of the reference, so generated images and critic outputs can be compared directly. The
+benchmark times every mode in a new process, as thread pools and auto-clustering on CPU are fixed when a
+process creates its first session.
+'''
+
+
+def _build(**kwargs):
+    with tf.Graph().as_default():
+        return ProGAN(**kwargs)
+
+
+# Copy the values of all global variables of src into the variables with the same name in dst
+def _copy_variables(src, dst):
+    with src.sess.graph.as_default():
+        values = src.sess.run({v.op.name: v for v in tf.global_variables()})
+    with dst.sess.graph.as_default():
+        for v in tf.global_variables():
+            v.load(values[v.op.name], dst.sess)
+
+
+# Move progan to the end of the fade-in of layer, where every network is fully active
+def _set_layer(progan, layer):
+    progan.total_imgs.load(2 * layer * progan.n_imgs, progan.sess)
+
+
+# Check that the generator and the critic distance of the jit compiled model match the uncompiled one
+# at every resolution
+def check_equivalence(progan_kwargs, batch_size=4, rtol=1e-3, atol=1e-4):
+    reference = _build(jit=False, **progan_kwargs)
+    compiled = _build(jit=True, **progan_kwargs)
+    _copy_variables(reference, compiled)
+
+    for layer in range(reference.n_layers):
+        dim = reference.networks[layer].dim
+        feed_dict = {
+            'x': reference.feed.next_batch(batch_size, dim),
+            'z': reference._z(batch_size)
+        }
+
+        results = []
+        for progan in (reference, compiled):
+            _set_layer(progan, layer)
+            network = progan.networks[layer]
+            results.append(progan.sess.run([network.Gz, network.wd], {
+                progan.x_placeholder: feed_dict['x'],
+                progan.z_placeholder: feed_dict['z']
+            }))
+
+        for name, a, b in zip(('Gz', 'wd'), *results):
+            assert np.allclose(a, b, rtol=rtol, atol=atol), '{}x{} {} differs by {}'.format(
+                dim, dim, name, np.max(np.abs(a - b)))
+        print('{}x{}: compiled outputs are equivalent'.format(dim, dim))
+
+
+# Time a training step of G and D at every resolution, uncompiled, with auto-clustering and with jit. Each
+# mode and resolution is timed in a process of its own, see session_config.measure.
+def benchmark(progan_kwargs, n_steps=10):
+    options = progan_kwargs.get('session_options')
+    if options is None:
+        options = session_config.load(progan_kwargs['logdir']) or dict()
+    modes = [
+        ('none', dict(progan_kwargs, jit=False), options),
+        ('auto', dict(progan_kwargs, jit=False), dict(options, xla=True)),
+        ('jit', dict(progan_kwargs, jit=True), options)
+    ]
+
+    n_layers = batch_size_finder.describe(progan_kwargs)['n_layers']
+    step_times = {mode: [] for mode, _, _ in modes}
+    for layer in range(n_layers):
+        times = []
+        for mode, kwargs, mode_options in modes:
+            result = session_config.measure(kwargs, mode_options, layer, n_steps)
+            step_times[mode].append(result['batch_size'] / result['imgs_per_sec'])
+            times.append(step_times[mode][-1])
+
+        dim = 2 ** (layer + 2)
+        print('{}x{}: '.format(dim, dim) + ', '.join('{} {:.2f} ms'.format(mode, t * 1000)
+            for (mode, _, _), t in zip(modes, times)))
+
+    return step_times
+
+
+if __name__ == '__main__':
+    logdir, imgdir = sys.argv[1:3]
+    progan_kwargs = {'logdir': logdir, 'imgdir': imgdir}
+    check_equivalence(progan_kwargs)
+    benchmark(progan_kwargs)
@@ -0,0 +1,319 @@
+import argparse
+import json
+import os
+import sys
+
+
+'''
+Command line interface for training, generating images, rendering videos and building datasets:
+
+    python cli.py train --config config.json
+    python cli.py batch-sizes --config config.json --budget-mb 8000
+    python cli.py generate --config config.json --out samples --n 64 --psi 0.7
+    python cli.py video --config config.json --audio song.mp3 --out song.mp4
+    python cli.py video --config config.json --audio song.mp3 --out song.mp4 --workers 4
+    python cli.py project --config config.json --images data/memmaps/64_0.npy --n 64 --out latents.npy
+    python cli.py download --subreddit EarthPorn --savedir downloads
+    python cli.py preprocess --imgdir downloads --savedir data
+    python cli.py index --imgdir data/memmaps --index data/nn_index --res 32
+    python cli.py nearest --config config.json --index data/nn_index --out nearest.png
+
+The config file is a JSON object of ProGAN keyword arguments, e.g.
+
+    {"logdir": "logdir_v5", "imgdir": "data/memmaps", "scaling_factor": 2, "ema_decay": 0.999}
+
+--logdir, --imgdir and --set key=value override values of the config file. TensorFlow and the video
+libraries are only imported by the commands that need them.
+'''
+
+
+def load_config(args):
+    config = dict()
+    if args.config:
+        with open(args.config) as f:
+            config.update(json.load(f))
+
+    for key in ('logdir', 'imgdir'):
+        if getattr(args, key, None) is not None:
+            config[key] = getattr(args, key)
+
+    # Values are parsed as JSON where possible so numbers, lists and booleans keep their type
+    for item in args.set or []:
+        key, value = item.split('=', 1)
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+
+    if 'logdir' not in config:
+        sys.exit('logdir must be given in the config file or with --logdir')
+    return config
+
+
+def train(args):
+    config = load_config(args)
+    if args.workers > 1:
+        import distributed
+        distributed.launch(args.workers, config, args.steps)
+        return
+
+    import session_config
+    from progan_v16 import ProGAN
+
+    # Every candidate is timed in a process of its own before this process creates a session, the options
+    # are saved to logdir where the trained model picks them up
+    if args.autotune:
+        session_config.autotune(config)
+
+    progan = ProGAN(**config)
+    progan.train(args.steps)
+
+
+# Measure the fastest batch size of every layer within a memory budget and save them to the config file
+def batch_sizes(args):
+    import batch_size_finder
+
+    config = load_config(args)
+    candidates = batch_size_finder.default_candidates(args.max_batch_size)
+    schedule = batch_size_finder.find_batch_sizes(config, args.budget_mb, candidates, args.steps)
+    print('batch_sizes: {}'.format(schedule))
+
+    if args.config and not args.dry_run:
+        batch_size_finder.save_schedule(args.config, schedule)
+        print('Saved batch_sizes to {}'.format(args.config))
+
+
+# Latent vectors for the generate command, truncated towards the mean of the prior if psi is given
+def _latents(args, z_length):
+    import latent
+    z = latent.normal(args.n, z_length, args.seed)
+    if args.psi is not None:
+        z = latent.truncate(z, args.psi, latent.mean_latent(z_length))
+    return z
+
+
+def generate(args):
+    import numpy as np
+    import preview
+    from progan_v16 import ProGAN
+
+    config = load_config(args)
+    config.setdefault('imgdir', None)
+    progan = ProGAN(training=False, **config)
+    z = _latents(args, progan.z_length)
+
+    if not os.path.exists(args.out): os.makedirs(args.out)
+    # Without a grid every image is saved as soon as its batch is generated
+    imgs = []
+    n_saved = 0
+    for batch in progan.iter_generate(z, args.batch_size, use_ema=not args.no_ema):
+        batch = preview.to_uint8(batch)
+        if args.grid:
+            imgs.append(batch)
+            continue
+        for img in batch:
+            with open(os.path.join(args.out, '{:05d}.png'.format(n_saved)), 'wb') as f:
+                f.write(preview.encode_png(img))
+            n_saved += 1
+
+    if args.grid:
+        with open(os.path.join(args.out, 'grid.png'), 'wb') as f:
+            f.write(preview.encode_png(preview.grid(np.concatenate(imgs), args.grid_cols)))
+    print('Saved {} images to {}'.format(args.n, args.out))
+
+
+# Latent vectors of the first n images of a .npy array of NCHW images, e.g. a memmap array of the dataset
+def project(args):
+    import numpy as np
+    from progan_v16 import ProGAN
+
+    config = load_config(args)
+    config.setdefault('imgdir', None)
+    progan = ProGAN(training=False, **config)
+    imgs = np.load(args.images, mmap_mode='r')[:args.n]
+    z, _ = progan.project(imgs, args.steps, args.batch_size, args.lr, args.feature_weight,
+                          use_ema=not args.no_ema)
+    np.save(args.out, z)
+    print('Saved {} latent vectors to {}'.format(len(z), args.out))
+
+
+def video(args):
+    from progan_v16 import ProGAN
+    import make_video
+
+    config = load_config(args)
+    config.setdefault('imgdir', None)
+    if args.workers:
+        make_video.render_segments(args.audio, args.out, config, n_workers=args.workers,
+                                   segment_seconds=args.segment_seconds, n_bins=args.n_bins,
+                                   random_state=args.random_state, imgs_per_batch=args.batch_size,
+                                   n_cols=args.n_cols)
+        return
+    progan = ProGAN(training=False, **config)
+    make_video.make_video(args.audio, args.out, progan, n_bins=args.n_bins,
+                          random_state=args.random_state, imgs_per_batch=args.batch_size, n_cols=args.n_cols)
+
+
+def download(args):
+    from scripts import downloader, image_reshape
+
+    # By default images too small for the crops of preprocess at 1024x1024 are not downloaded
+    min_size = args.min_size if args.min_size is not None else image_reshape.padded_size(1024)
+    downloader.download_subreddit(args.subreddit, args.savedir, pages=args.pages, method=args.method,
+                                  base_url=args.base_url, min_size=min_size or None, n_threads=args.threads)
+
+
+def preprocess(args):
+    from scripts import image_reshape
+
+    image_reshape.generate_square_crops(args.imgdir, args.savedir, args.max_size, args.margin)
+    image_reshape.resize(args.savedir, min_size=args.min_size, max_size=args.max_size,
+                         max_mem=args.max_mem, use_uint8=not args.float32, margin=args.margin)
+
+
+def index(args):
+    import nn_index
+
+    nn_index.build_index(args.imgdir, args.index, args.res, args.source_res, args.n_components)
+
+
+# Generate images and save a grid with each image followed by its nearest training images
+def nearest(args):
+    import numpy as np
+    import augment
+    import nn_index
+    import preview
+    from progan_v16 import ProGAN
+
+    config = load_config(args)
+    config.setdefault('imgdir', None)
+    progan = ProGAN(training=False, **config)
+    index = nn_index.NNIndex(args.index)
+
+    z = _latents(args, progan.z_length)
+    imgs = progan.generate(z, use_ema=not args.no_ema, batch_size=args.batch_size)
+    dist, ids = index.query(imgs, args.k)
+    print('distance to the nearest training image: mean {:.4f}, min {:.4f}'.format(
+        np.mean(dist[:, 0]), np.min(dist[:, 0])))
+
+    # Images are compared at the resolution of the index, so they are shown at it too
+    neighbors = index.images(ids)
+    neighbors = neighbors / 127.5 - 1 if neighbors.dtype == np.uint8 else neighbors
+    shape = (3, index.res, index.res)
+    neighbors = augment.downscale(neighbors, index.res).reshape((len(imgs), -1) + shape)
+    rows = np.concatenate([augment.downscale(imgs, index.res)[:, np.newaxis], neighbors], 1)
+    rows = preview.to_uint8(rows.reshape((-1,) + shape))
+    with open(args.out, 'wb') as f:
+        f.write(preview.encode_png(preview.grid(rows, neighbors.shape[1] + 1)))
+    print('Saved {}'.format(args.out))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Progressive growing of GANs')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    def model_command(name, func, help):
+        p = commands.add_parser(name, help=help)
+        p.add_argument('--config', help='JSON file of ProGAN keyword arguments')
+        p.add_argument('--logdir', help='directory of stored models, overrides the config')
+        p.add_argument('--imgdir', help='directory of memmap arrays, overrides the config')
+        p.add_argument('--set', action='append', metavar='KEY=VALUE', help='override a ProGAN argument')
+        p.set_defaults(func=func)
+        return p
+
+    p = model_command('train', train, 'train a model')
+    p.add_argument('--steps', type=int, default=None, help='stop after this many steps')
+    p.add_argument('--workers', type=int, default=1, help='number of data parallel worker processes')
+    p.add_argument('--autotune', action='store_true', help='tune session threading before training')
+
+    p = model_command('batch-sizes', batch_sizes, 'find the fastest batch sizes within a memory budget')
+    p.add_argument('--budget-mb', type=float, required=True, help='peak memory allowed for a training step')
+    p.add_argument('--max-batch-size', type=int, default=256)
+    p.add_argument('--steps', type=int, default=5, help='timed steps per batch size')
+    p.add_argument('--dry-run', action='store_true', help='only print the batch sizes')
+
+    p = model_command('generate', generate, 'generate images from a trained model')
+    p.add_argument('--out', required=True, help='directory to save PNG images in')
+    p.add_argument('--n', type=int, default=24, help='number of images')
+    p.add_argument('--seed', type=int, default=None, help='seed of the latent vectors')
+    p.add_argument('--psi', type=float, default=None, help='truncation towards the mean latent, 0 - 1')
+    p.add_argument('--batch-size', type=int, default=32)
+    p.add_argument('--grid', action='store_true', help='save a single grid image')
+    p.add_argument('--grid-cols', type=int, default=None)
+    p.add_argument('--no-ema', action='store_true', help='use the raw generator weights')
+
+    p = model_command('video', video, 'render a video driven by an audio file')
+    p.add_argument('--audio', required=True)
+    p.add_argument('--out', required=True, help='video file to write')
+    p.add_argument('--n-bins', type=int, default=60, help='number of frequency bins mapped to the latent')
+    p.add_argument('--random-state', type=int, default=0)
+    p.add_argument('--batch-size', type=int, default=20)
+    p.add_argument('--n-cols', type=int, default=None,
+                   help='generate each frame from a row of n latent vectors, (n + 3) / 4 times as wide as '
+                        'high; by default square frames are mirrored to 16:9')
+    p.add_argument('--workers', type=int, default=0,
+                   help='render resumable segments in this many processes, 0 renders in this process')
+    p.add_argument('--segment-seconds', type=float, default=10)
+
+    p = model_command('project', project, 'find the latent vectors of images')
+    p.add_argument('--images', required=True, help='.npy array of NCHW images, uint8 or -1 - 1')
+    p.add_argument('--out', required=True, help='.npy file to save the latent vectors in')
+    p.add_argument('--n', type=int, default=None, help='number of images, by default all')
+    p.add_argument('--steps', type=int, default=1000, help='maximum number of steps per image')
+    p.add_argument('--batch-size', type=int, default=16)
+    p.add_argument('--lr', type=float, default=0.05)
+    p.add_argument('--feature-weight', type=float, default=1.0, help='weight of the discriminator features')
+    p.add_argument('--no-ema', action='store_true', help='use the raw generator weights')
+
+    p = model_command('nearest', nearest, 'find the nearest training images of generated images')
+    p.add_argument('--index', required=True, help='directory of the index built with the index command')
+    p.add_argument('--out', required=True, help='PNG file of the generated images and their neighbors')
+    p.add_argument('--n', type=int, default=16, help='number of images')
+    p.add_argument('--k', type=int, default=4, help='number of neighbors of each image')
+    p.add_argument('--seed', type=int, default=None, help='seed of the latent vectors')
+    p.add_argument('--psi', type=float, default=None, help='truncation towards the mean latent, 0 - 1')
+    p.add_argument('--batch-size', type=int, default=32)
+    p.add_argument('--no-ema', action='store_true', help='use the raw generator weights')
+
+    p = commands.add_parser('index', help='build or extend a nearest neighbor index of the training images')
+    p.add_argument('--imgdir', required=True, help='directory of memmap arrays')
+    p.add_argument('--index', required=True, help='directory to save the index in')
+    p.add_argument('--res', type=int, default=32, help='resolution the images are compared at')
+    p.add_argument('--source-res', type=int, default=None, help='resolution of the arrays read, by default res')
+    p.add_argument('--n-components', type=int, default=64)
+    p.set_defaults(func=index)
+
+    p = commands.add_parser('download', help='download the images linked from a subreddit')
+    p.add_argument('--subreddit', required=True)
+    p.add_argument('--savedir', required=True, help='directory to save the images in')
+    p.add_argument('--pages', type=int, default=100, help='number of listing pages to read')
+    p.add_argument('--method', choices=['json', 'html'], default='json',
+                   help='how listings are read, Selenium is only used if they can\'t be')
+    p.add_argument('--min-size', type=int, default=None,
+                   help='skip images with a shorter side, by default 1152, 0 keeps all images')
+    p.add_argument('--threads', type=int, default=8)
+    p.add_argument('--base-url', default='https://old.reddit.com')
+    p.set_defaults(func=download)
+
+    p = commands.add_parser('preprocess', help='build memmap arrays from a directory of images')
+    p.add_argument('--imgdir', required=True, help='directory of downloaded images')
+    p.add_argument('--savedir', required=True, help='directory to save crops and memmaps in')
+    p.add_argument('--margin', type=float, default=0.125,
+                   help='images are stored this much larger than each resolution for random crops')
+    p.add_argument('--min-size', type=int, default=4)
+    p.add_argument('--max-size', type=int, default=1024)
+    p.add_argument('--max-mem', type=float, default=0.8, help='GB of images per memmap array')
+    p.add_argument('--float32', action='store_true', help='store float32 instead of uint8 arrays')
+    p.set_defaults(func=preprocess)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
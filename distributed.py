@@ -0,0 +1,208 @@
+import queue
+import sys
+import threading
+import time
+import multiprocessing as mp
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+'''
+Data parallel training of ProGAN with several worker processes. Every worker holds a full copy of the
+model and trains on its own shard of each batch. After each micro-batch has been accumulated, the
+gradient sums of all workers are added together with an all-reduce so that every copy applies the
+same update and the variables, global_step, total_imgs and alpha stay identical on all workers.
+
+Workers talk to each other through multiprocessing.connection over TCP, so they can run on one
+machine or on several nodes as long as every worker can reach the address of worker 0. A worker that
+dies or stops responding makes the others raise instead of waiting for it forever: connecting gives up
+after timeout seconds and every receive after recv_timeout seconds, which has to be longer than the
+chief takes to save and evaluate the model.
+'''
+
+
+class Communicator:
+
+    def __init__(self, rank, n_workers, address=('localhost', 6117), authkey=b'progan', timeout=60,
+                 recv_timeout=3600):
+        self.rank = rank
+        self.n_workers = n_workers
+        self.recv_timeout = recv_timeout
+        self.connections = []
+
+        if n_workers == 1:
+            return
+
+        # Worker 0 collects connections from all other workers, in order of rank. Listener.accept can't
+        # time out, so connections are accepted on a thread that is given up on after timeout.
+        if rank == 0:
+            with Listener(address, authkey=authkey) as listener:
+                connections = dict()
+
+                def accept():
+                    while len(connections) < n_workers - 1:
+                        conn = listener.accept()
+                        connections[conn.recv()] = conn
+
+                accept_thread = threading.Thread(target=accept, daemon=True)
+                accept_thread.start()
+                accept_thread.join(timeout)
+                if len(connections) < n_workers - 1:
+                    raise TimeoutError('Only {} of {} workers connected within {}s'.format(
+                        len(connections) + 1, n_workers, timeout))
+            self.connections = [connections[r] for r in sorted(connections)]
+
+        else:
+            start = time.time()
+            while True:
+                try:
+                    conn = Client(address, authkey=authkey)
+                    break
+                except ConnectionRefusedError:
+                    if time.time() - start > timeout:
+                        raise
+                    time.sleep(0.5)
+            conn.send(rank)
+            self.connections = [conn]
+
+    @property
+    def is_chief(self): return self.rank == 0
+
+    # Wait for data on conn, raising if its worker disconnected or sent nothing within recv_timeout
+    def _poll(self, conn):
+        peer = self.connections.index(conn) + 1 if self.is_chief else 0
+        try:
+            ready = conn.poll(self.recv_timeout)
+        except (EOFError, OSError):
+            ready = True
+        if not ready:
+            raise TimeoutError('Worker {} sent nothing for {}s'.format(peer, self.recv_timeout))
+        return peer
+
+    def _recv_bytes(self, conn):
+        peer = self._poll(conn)
+        try:
+            return conn.recv_bytes()
+        except (EOFError, OSError) as e:
+            raise ConnectionError('Worker {} disconnected'.format(peer)) from e
+
+    def _recv(self, conn):
+        peer = self._poll(conn)
+        try:
+            return conn.recv()
+        except (EOFError, OSError) as e:
+            raise ConnectionError('Worker {} disconnected'.format(peer)) from e
+
+    # Sum a list of numpy arrays over all workers. Arrays are sent as a single float32 buffer.
+    def allreduce(self, arrays):
+        if self.n_workers == 1:
+            return arrays
+
+        shapes = [np.shape(a) for a in arrays]
+        buffer = np.concatenate([np.ravel(a).astype(np.float32) for a in arrays])
+
+        if self.is_chief:
+            for conn in self.connections:
+                buffer += np.frombuffer(self._recv_bytes(conn), np.float32)
+            for conn in self.connections:
+                conn.send_bytes(buffer)
+        else:
+            self.connections[0].send_bytes(buffer)
+            buffer = np.frombuffer(self._recv_bytes(self.connections[0]), np.float32)
+
+        sizes = np.cumsum([int(np.prod(s)) for s in shapes])[:-1]
+        return [b.reshape(s) for b, s in zip(np.split(buffer, sizes), shapes)]
+
+    # Send a picklable object from worker 0 to all workers
+    def broadcast(self, obj=None):
+        if self.n_workers == 1:
+            return obj
+        if self.is_chief:
+            for conn in self.connections:
+                conn.send(obj)
+            return obj
+        return self._recv(self.connections[0])
+
+    def barrier(self):
+        self.allreduce([np.zeros(1)])
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
+
+
+# Train ProGAN as one worker. On multiple nodes, call this on every node with its rank and the
+# address of worker 0.
+def run_worker(rank, n_workers, address, progan_kwargs, n_steps=None, result_queue=None):
+    from progan_v16 import ProGAN
+
+    communicator = Communicator(rank, n_workers, address)
+    progan = ProGAN(communicator=communicator, **progan_kwargs)
+    imgs_per_sec = progan.train(n_steps)
+    communicator.close()
+
+    if result_queue is not None:
+        result_queue.put((rank, imgs_per_sec))
+    return imgs_per_sec
+
+
+# Train with n_workers local processes. Returns the number of training images per second of every
+# worker, all workers together process the sum of these. If a worker dies, the others are terminated
+# and a RuntimeError is raised.
+def launch(n_workers, progan_kwargs, n_steps=None, address=('localhost', 6117)):
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    workers = [ctx.Process(target=run_worker,
+        args=(rank, n_workers, address, progan_kwargs, n_steps, result_queue))
+        for rank in range(n_workers)]
+
+    for w in workers:
+        w.start()
+
+    results = dict()
+    while len(results) < n_workers:
+        try:
+            rank, imgs_per_sec = result_queue.get(timeout=1)
+            results[rank] = imgs_per_sec
+            continue
+        except queue.Empty:
+            pass
+
+        # A worker that exited has already put its result on the queue, unless it failed
+        failed = [(rank, w.exitcode) for rank, w in enumerate(workers) if rank not in results and
+                  w.exitcode is not None and (w.exitcode != 0 or result_queue.empty())]
+        if failed:
+            for w in workers:
+                if w.is_alive():
+                    w.terminate()
+                w.join()
+            raise RuntimeError(', '.join(
+                'worker {} exited with code {}'.format(rank, exitcode) for rank, exitcode in failed))
+
+    for w in workers:
+        w.join()
+
+    return [results[rank] for rank in range(n_workers)]
+
+
+# Measure throughput for each number of workers and its scaling efficiency relative to one worker
+def benchmark_scaling(progan_kwargs, worker_counts=(1, 2, 4), n_steps=50):
+    throughput = dict()
+    for i, n_workers in enumerate(worker_counts):
+        address = ('localhost', 6117 + i)
+        throughput[n_workers] = sum(launch(n_workers, progan_kwargs, n_steps, address))
+
+    base = throughput[worker_counts[0]] / worker_counts[0]
+    for n_workers, imgs_per_sec in throughput.items():
+        efficiency = imgs_per_sec / (n_workers * base)
+        print('workers: {} ---- images/sec: {:.2f} ---- scaling efficiency: {:.1f}%'.format(
+            n_workers, imgs_per_sec, efficiency * 100))
+
+    return throughput
+
+
+if __name__ == '__main__':
+    logdir, imgdir = sys.argv[1:3]
+    worker_counts = [int(n) for n in sys.argv[3:]] or [1, 2, 4]
+    benchmark_scaling({'logdir': logdir, 'imgdir': imgdir}, worker_counts)
@@ -1,7 +1,12 @@
+import json
 import os
-import pickle
+import threading
+import time
+from collections import deque
 import numpy as np
-from itertools import cycle
+
+import augment
+from tier_cache import TierCache
 
 ''' 
 FeedDict handles several numpy mem_map arrays of image data saved within the directory. The arrays 
@@ -9,22 +14,53 @@ should be named in the format "n1_n2.npy" where n1 x n1 is the resolution of the
 array, and n2 is its number used for indexing purposes. Data should be of type np.float32 and scaled 
 between -1.0 and 1.0. In order to avoid loading unnecessary data into memory, only one mem_map is 
 loaded at a time.
+
+For data parallel training, each of n_workers FeedDicts only takes every n_workers-th image of each
+array, starting at worker_index. Workers should be given the same seed so they walk the arrays in
+the same order.
+
+The order of the arrays and of the images within each array only depends on the seed, so the position
+in the data is fully described by a small state: the seed and, for each resolution, the number of
+arrays loaded so far and the index within the current one. save writes this state as JSON, and a
+FeedDict loading it continues with exactly the same batches without storing any image data.
+
+With n_open_shards, arrays are not loaded whole. Instead ShardSampler keeps that many arrays open as
+memmaps and reads contiguous blocks of images from them at random into a shuffle buffer, from which
+batches are drawn. Batches then mix images from several arrays while only the buffer is held in memory.
+io_stats reports how many bytes were read per byte of images returned and how long batches took.
+
+With cache_mb, the arrays of the smallest resolutions that fit in cache_mb are held in shared memory by
+a TierCache, and all processes reading the same imgdir share a single copy of them.
+
+Arrays can hold images slightly larger than their resolution. Batches are cut to the resolution at a
+random offset and mirrored at random when augment is True (see augment.py), or cut from the center
+otherwise. The random numbers only depend on the seed and the number of batches drawn so far.
+
+prefetch(res) reads the data the first batches of another resolution need on a background thread, so a
+change of resolution doesn't wait for the disk. The batches are the same as without prefetching.
 '''
 
 class FeedDict:
 
-    pickle_filename = 'fd_log.plk'
+    state_filename = 'feed_state.json'
 
-    def __init__(self, imgdir, logdir, shuffle=True, min_size=4, max_size=1024):
+    def __init__(self, imgdir, logdir, shuffle=True, min_size=4, max_size=1024,
+                 worker_index=0, n_workers=1, seed=None, n_open_shards=None, cache_mb=0,
+                 augment=True, **sampler_kwargs):
 
         self.logdir = logdir
         self.shuffle = shuffle
+        self.augment = augment
+        self.worker_index = worker_index
+        self.n_workers = n_workers
+        # Without a seed, draw one from numpy's global RandomState so it can be saved
+        self.seed = int(np.random.randint(2 ** 31)) if seed is None else seed
         self.sizes = [2 ** i for i in range(
             int(np.log2(min_size)),
             int(np.log2(max_size)) + 1
         )]
 
-        files = os.listdir(imgdir)
+        files = sorted(os.listdir(imgdir))
         self.arrays = dict()
 
         for s in [2 ** i for i in range(2, 11)]:
@@ -34,34 +70,153 @@ class FeedDict:
                 if f.startswith('{}_'.format(s)):
                     path_list.append(os.path.join(imgdir, f))
 
-            if shuffle: np.random.shuffle(path_list)
-            self.arrays.update({s: cycle(path_list)})
+            if shuffle: np.random.RandomState([self.seed, s]).shuffle(path_list)
+            self.arrays.update({s: path_list})
+
+        # Small resolutions shared in RAM between processes, see TierCache
+        self.cache = TierCache(imgdir, cache_mb, self.sizes) if cache_mb else None
+
+        # Number of arrays loaded so far and index of the next image in the current array, per resolution
+        self.cursors = {s: [0, 0] for s in self.arrays}
 
+        self.n_batches = 0
         self.cur_res = None
         self.cur_path = None
         self.cur_array = None
         self.cur_array_len = 0
+        self.order = None
         self.idx = 0
 
+        # Interleaved sampling of several memmaps per resolution, see ShardSampler
+        self.n_open_shards = n_open_shards
+        self.sampler_kwargs = sampler_kwargs
+        self.samplers = dict()
+
+        # Background threads reading the data of other resolutions, and what they read: the first array of
+        # the resolution or its ShardSampler with a full buffer
+        self.prefetching = dict()
+        self.prefetched = dict()
+        self.prefetch_wait = 0.0
+
+        # Bytes read from disk and returned in batches, and the time taken by recent batches
+        self.stats = {'bytes_read': 0, 'bytes_returned': 0, 'batch_times': deque(maxlen=1000)}
+
     @property
     def n_sizes(self): return len(self.sizes)
 
     def __change_res(self, res):
         assert res in self.arrays.keys()
+        if self.cur_res is not None:
+            self.cursors[self.cur_res][1] = self.idx
         self.cur_res = res
-        self.__change_array()
+        n_loaded, idx = self.cursors[res]
+        self.__load_array(max(0, n_loaded - 1))
+        self.idx = idx
 
-    def __change_array(self):
-        new_path = next(self.arrays[self.cur_res])
+    # This worker's images of the array at path in memory. With several workers they are copied from a
+    # memory map, so the images of the other workers are never read.
+    def __read_array(self, path):
+        if self.n_workers > 1:
+            return np.load(path, mmap_mode='r')[self.worker_index::self.n_workers].copy()
+        return np.load(path)
+
+    # Load the k-th array of the current resolution, cycling through the arrays. Each pass over an
+    # array visits its images in a different order that only depends on the seed.
+    def __load_array(self, k):
+        paths = self.arrays[self.cur_res]
+        new_path = paths[k % len(paths)]
         print('Loaded new memmap array: {}'.format(new_path))
         if new_path != self.cur_path:
             self.cur_path = new_path
-            self.cur_array = np.load(new_path)
+            self.cur_array = self.cache.get(new_path) if self.cache is not None else None
+            if self.cur_array is None:
+                path, array = self.prefetched.pop(self.cur_res, (None, None))
+                self.cur_array = array if path == new_path else self.__read_array(new_path)
+                self.stats['bytes_read'] += self.cur_array.nbytes
+            elif self.n_workers > 1:
+                # Strided view of the shared array, nothing is copied
+                self.cur_array = self.cur_array[self.worker_index::self.n_workers]
             self.cur_array_len = self.cur_array.shape[0]
-        if self.shuffle: np.random.shuffle(self.cur_array)
+        if self.shuffle:
+            self.order = np.random.RandomState([self.seed, self.cur_res, k]).permutation(self.cur_array_len)
+        else:
+            self.order = np.arange(self.cur_array_len)
+        self.cursors[self.cur_res] = [k + 1, 0]
         self.idx = 0
 
+    def __change_array(self):
+        self.__load_array(self.cursors[self.cur_res][0])
+
     def next_batch(self, batch_size, res):
+        start_time = time.perf_counter()
+        if res in self.prefetching:
+            self.__finish_prefetch(res)
+
+        if self.n_open_shards:
+            batch = self.__sampler(res).next_batch(batch_size)
+        else:
+            batch = self.__next_array_batch(batch_size, res)
+
+        self.stats['bytes_returned'] += batch.nbytes
+        batch = self.__augment(batch, res)
+        self.stats['batch_times'].append(time.perf_counter() - start_time)
+        return batch
+
+    def __augment(self, batch, res):
+        if self.augment:
+            random = np.random.RandomState([self.seed, res, 2, self.n_batches])
+            batch = augment.crop_flip(batch, res, random)
+        elif batch.shape[2:] != (res, res):
+            batch = augment.center_crop(batch, res)
+        self.n_batches += 1
+        return batch
+
+    def __sampler(self, res):
+        if res not in self.samplers:
+            self.samplers[res] = self.__new_sampler(res, self.stats)
+        return self.samplers[res]
+
+    def __new_sampler(self, res, stats):
+        return ShardSampler(
+            self.arrays[res], res, self.seed, self.n_open_shards, worker_index=self.worker_index,
+            n_workers=self.n_workers, stats=stats, cache=self.cache, **self.sampler_kwargs)
+
+    # Start reading the data of resolution res in the background, if it isn't already in memory
+    def prefetch(self, res):
+        if res == self.cur_res or res in self.prefetching or not self.arrays.get(res):
+            return
+        thread = threading.Thread(target=self.__prefetch, args=(res,), daemon=True)
+        self.prefetching[res] = thread
+        thread.start()
+
+    # Only touches self.prefetched, the data is handed over in __finish_prefetch. Samplers count the bytes
+    # they read separately until then.
+    def __prefetch(self, res):
+        if self.n_open_shards:
+            if res not in self.samplers:
+                sampler = self.__new_sampler(res, {'bytes_read': 0})
+                sampler._fill()
+                self.prefetched[res] = sampler
+        else:
+            paths = self.arrays[res]
+            path = paths[max(0, self.cursors[res][0] - 1) % len(paths)]
+            if self.cache is None or self.cache.get(path) is None:
+                self.prefetched[res] = (path, self.__read_array(path))
+
+    # Wait for the prefetch of res, the time spent waiting is added to prefetch_wait
+    def __finish_prefetch(self, res):
+        start_time = time.perf_counter()
+        self.prefetching.pop(res).join()
+        self.prefetch_wait += time.perf_counter() - start_time
+
+        if self.n_open_shards and res in self.prefetched:
+            sampler = self.prefetched.pop(res)
+            self.stats['bytes_read'] += sampler.stats['bytes_read']
+            sampler.stats = self.stats
+            self.samplers[res] = sampler
+
+    # Next batch from the current whole array
+    def __next_array_batch(self, batch_size, res):
         if res != self.cur_res:
             self.__change_res(res)
 
@@ -70,29 +225,221 @@ class FeedDict:
 
         if remaining >= batch_size:
             stop = start + batch_size
-            batch = self.cur_array[start:stop]
+            batch = self.cur_array[self.order[start:stop]]
 
         else:
             stop = batch_size - remaining
-            batch = self.cur_array[start:]
+            batch = self.cur_array[self.order[start:]]
             self.__change_array()
-            batch = np.concatenate((batch, self.cur_array[:stop]))
+            batch = np.concatenate((batch, self.cur_array[self.order[:stop]]))
 
         self.idx = stop
 
         return batch
 
+    # Bytes read per byte of images returned, and mean and 95th percentile time to assemble a batch
+    def io_stats(self):
+        times = np.array(self.stats['batch_times']) * 1000
+        return {
+            'io_amplification': float(self.stats['bytes_read'] / max(1, self.stats['bytes_returned'])),
+            'batch_ms_mean': float(np.mean(times)) if len(times) else 0.0,
+            'batch_ms_p95': float(np.percentile(times, 95)) if len(times) else 0.0
+        }
+
+    # Position in the data, small enough to be saved with every checkpoint
+    def state(self):
+        cursors = {s: list(c) for s, c in self.cursors.items()}
+        if self.cur_res is not None:
+            cursors[self.cur_res][1] = self.idx
+        return {'seed': self.seed, 'cur_res': self.cur_res, 'n_batches': self.n_batches,
+                'cursors': {str(s): c for s, c in cursors.items()},
+                'samplers': {str(s): sampler.state() for s, sampler in self.samplers.items()}}
+
+    def load_state(self, state):
+        for res in list(self.prefetching):
+            self.__finish_prefetch(res)
+        self.prefetched = dict()
+        self.seed = state['seed']
+        if self.shuffle:
+            for s, paths in self.arrays.items():
+                paths.sort()
+                np.random.RandomState([self.seed, s]).shuffle(paths)
+        self.cursors = {int(s): list(c) for s, c in state['cursors'].items()}
+        self.n_batches = state.get('n_batches', 0)
+        self.samplers = dict()
+        for s, sampler_state in state.get('samplers', {}).items():
+            self.__sampler(int(s)).load_state(sampler_state)
+
+        self.cur_res = None
+        if state['cur_res'] is not None:
+            self.__change_res(state['cur_res'])
+
+    # Each worker has its own state file, as the images in the shuffle buffers differ between workers
+    @property
+    def state_path(self):
+        filename = self.state_filename
+        if self.worker_index:
+            filename = filename.replace('.json', '.{}.json'.format(self.worker_index))
+        return os.path.join(self.logdir, filename)
+
     @classmethod
-    def load(cls, imgdir, logdir):
-        path = os.path.join(logdir, cls.pickle_filename)
-        if os.path.exists(path):
-            with open(path, 'rb') as f:
-                fd = pickle.load(f)
-            if type(fd) == cls:
-                return fd
-        return cls(imgdir, logdir)
-
-    def save(self):
-        path = os.path.join(self.logdir, self.pickle_filename)
-        with open(path, 'wb') as f:
-            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
\ No newline at end of file
+    def load(cls, imgdir, logdir, **kwargs):
+        fd = cls(imgdir, logdir, **kwargs)
+        if os.path.exists(fd.state_path):
+            with open(fd.state_path) as f:
+                fd.load_state(json.load(f))
+        return fd
+
+    # Save the state to logdir, extra values (e.g. the global step of the checkpoint) are saved with it
+    def save(self, **extra):
+        path = self.state_path
+        with open(path + '.tmp', 'w') as f:
+            json.dump(dict(self.state(), **extra), f)
+        os.replace(path + '.tmp', path)
+
+
+class ShardSampler:
+
+    '''
+    Draws batches of one resolution from a shuffle buffer filled with blocks of images from n_open
+    arrays at a time. Every array is opened as a memmap and its blocks are read in a random order, each
+    block with a single contiguous read, so little more than the images used is read from disk. When
+    all blocks of an array have been read it is replaced by the next array. Arrays are numbered in the
+    order they are opened, the k-th being paths[k % len(paths)] with its own order of blocks.
+
+    With several workers each worker keeps every n_workers-th image of each block. Arrays in the
+    TierCache are read from shared memory instead of their memmaps.
+    '''
+
+    def __init__(self, paths, res, seed, n_open=4, buffer_size=4096, buffer_mb=512, block_kb=1024,
+                 worker_index=0, n_workers=1, stats=None, cache=None):
+        self.paths = paths
+        self.res = res
+        self.seed = seed
+        self.n_open = n_open
+        self.worker_index = worker_index
+        self.n_workers = n_workers
+        self.stats = stats if stats is not None else {'bytes_read': 0}
+        self.cache = cache
+
+        first = self._load(paths[0])
+        self.img_shape, self.dtype = first.shape[1:], first.dtype
+        self.img_bytes = first[0].nbytes
+
+        self.capacity = max(1, min(buffer_size, buffer_mb * 2 ** 20 // self.img_bytes))
+        self.block_len = max(1, min(block_kb * 2 ** 10 // self.img_bytes, self.capacity // 4)) * n_workers
+        self.buffer = np.zeros((self.capacity, *self.img_shape), self.dtype)
+        self.reset()
+
+    def reset(self):
+        # Array number and image index of every image in the buffer
+        self.ids = np.zeros((self.capacity, 2), np.int64)
+        self.n = 0
+        # [array number, blocks read] of each open array and the memmap and block order of each
+        self.open = []
+        self.shards = dict()
+        self.next_shard = 0
+        self.n_reads = 0
+        self.n_draws = 0
+
+    def _load(self, path):
+        return self.cache.load(path, 'r') if self.cache is not None else np.load(path, mmap_mode='r')
+
+    def _open(self, k):
+        array = self._load(self.paths[k % len(self.paths)])
+        n_blocks = -(-len(array) // self.block_len)
+        order = np.random.RandomState([self.seed, self.res, k]).permutation(n_blocks)
+        self.shards[k] = (array, order)
+        return array, order
+
+    def _shard(self, k):
+        return self.shards[k] if k in self.shards else self._open(k)
+
+    # Grow the buffer so it can hold a batch and a block
+    def _reserve(self, batch_size):
+        self._grow(batch_size + self.block_len // self.n_workers + 1)
+
+    def _grow(self, capacity):
+        if capacity > self.capacity:
+            extra = capacity - self.capacity
+            self.buffer = np.concatenate([self.buffer, np.zeros((extra, *self.img_shape), self.dtype)])
+            self.ids = np.concatenate([self.ids, np.zeros((extra, 2), np.int64)])
+            self.capacity = capacity
+
+    # Read blocks of open arrays, chosen in proportion to their unread blocks, until the buffer is full
+    def _fill(self):
+        while True:
+            while len(self.open) < self.n_open:
+                self._open(self.next_shard)
+                self.open.append([self.next_shard, 0])
+                self.next_shard += 1
+
+            if self.n + -(-self.block_len // self.n_workers) > self.capacity:
+                return
+
+            remaining = np.array([len(self.shards[k][1]) - pos for k, pos in self.open], np.float64)
+            random = np.random.RandomState([self.seed, self.res, 0, self.n_reads])
+            i = random.choice(len(self.open), p=remaining / remaining.sum())
+            self.n_reads += 1
+
+            k, pos = self.open[i]
+            array, order = self.shards[k]
+            start = order[pos] * self.block_len
+            stop = min(start + self.block_len, len(array))
+            block = array[start:stop][self.worker_index::self.n_workers]
+            # Only memmaps are read from disk, shared arrays already are in memory
+            if isinstance(array, np.memmap):
+                self.stats['bytes_read'] += (stop - start) * self.img_bytes
+
+            n = len(block)
+            self.buffer[self.n:self.n + n] = block
+            self.ids[self.n:self.n + n, 0] = k
+            self.ids[self.n:self.n + n, 1] = np.arange(start, stop)[self.worker_index::self.n_workers]
+            self.n += n
+
+            self.open[i][1] += 1
+            if self.open[i][1] == len(order):
+                del self.open[i]
+                del self.shards[k]
+
+    def next_batch(self, batch_size):
+        self._reserve(batch_size)
+        self._fill()
+
+        random = np.random.RandomState([self.seed, self.res, 1, self.n_draws])
+        idx = random.choice(self.n, batch_size, replace=False)
+        self.n_draws += 1
+        batch = self.buffer[idx]
+        self.batch_ids = self.ids[idx]
+
+        # Move the images at the end of the buffer into the places of the drawn ones
+        n = self.n - batch_size
+        holes = idx[idx < n]
+        tail = np.setdiff1d(np.arange(n, self.n), idx)
+        self.buffer[holes] = self.buffer[tail]
+        self.ids[holes] = self.ids[tail]
+        self.n = n
+        return batch
+
+    # Only the numbers of the images in the buffer are saved, their data is read again on loading
+    def state(self):
+        return {'next_shard': self.next_shard, 'open': [list(o) for o in self.open],
+                'buffer': self.ids[:self.n].tolist(), 'capacity': self.capacity,
+                'n_reads': self.n_reads, 'n_draws': self.n_draws}
+
+    def load_state(self, state):
+        self.reset()
+        self.next_shard, self.n_reads, self.n_draws = state['next_shard'], state['n_reads'], state['n_draws']
+        self.open = [list(o) for o in state['open']]
+        for k, _ in self.open:
+            self._open(k)
+
+        ids = np.array(state['buffer'], np.int64).reshape(-1, 2)
+        self._grow(state['capacity'])
+        for k in np.unique(ids[:, 0]):
+            mask = ids[:, 0] == k
+            self.buffer[:len(ids)][mask] = self._shard(k)[0][ids[mask, 1]]
+            if k not in [o[0] for o in self.open]:
+                del self.shards[k]
+        self.ids[:len(ids)] = ids
+        self.n = len(ids)
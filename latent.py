@@ -0,0 +1,113 @@
+import numpy as np
+
+
+'''
+Latent vectors for exploring a trained generator. Every function returns a 2D array of latent vectors,
+one per row, computed in numpy for all frames at once. The arrays can be passed to ProGAN.generate or
+streamed through ProGAN.iter_generate in batches.
+
+Interpolations take keyframes, a [n_keyframes, z_length] array, and return n_steps vectors between each
+pair of consecutive keyframes. slerp follows great circles and keeps the norm of the vectors close to
+that of samples from the prior, which avoids the washed out images lerp gives halfway between keyframes.
+'''
+
+
+# Latent vectors drawn from the standard normal prior, reproducible for an int seed
+def normal(n, z_length, seed=None):
+    return np.random.RandomState(seed).normal(size=[n, z_length])
+
+
+# One latent vector per seed, the same vector as normal(1, z_length, seed)
+def from_seeds(seeds, z_length):
+    return np.concatenate([normal(1, z_length, seed) for seed in seeds])
+
+
+# Mean of n latent vectors, by default of the prior. Pass the latent vectors of chosen samples to
+# truncate towards those instead.
+def mean_latent(z_length, n=10000, seed=0, z=None):
+    if z is None:
+        z = normal(n, z_length, seed)
+    return np.mean(z, 0)
+
+
+# Move latent vectors towards mean by psi, psi = 1 leaves them unchanged and psi = 0 gives mean
+def truncate(z, psi=0.7, mean=None):
+    if mean is None:
+        mean = np.zeros(z.shape[-1])
+    return mean + psi * (z - mean)
+
+
+# Samples of the prior with every value outside of [-threshold, threshold] drawn again
+def truncated_normal(n, z_length, threshold=2.0, seed=None):
+    random = np.random.RandomState(seed)
+    z = random.normal(size=[n, z_length])
+    outside = np.abs(z) > threshold
+    while outside.any():
+        z[outside] = random.normal(size=outside.sum())
+        outside = np.abs(z) > threshold
+    return z
+
+
+def lerp(z0, z1, t):
+    t = np.reshape(t, np.shape(t) + (1,) * (np.ndim(z0) - np.ndim(t)))
+    return z0 + t * (z1 - z0)
+
+
+# Spherical interpolation between z0 and z1, broadcast over t. Falls back to lerp for (anti)parallel
+# vectors, where the great circle isn't defined.
+def slerp(z0, z1, t):
+    t = np.reshape(t, np.shape(t) + (1,) * (np.ndim(z0) - np.ndim(t)))
+    n0 = np.linalg.norm(z0, axis=-1, keepdims=True)
+    n1 = np.linalg.norm(z1, axis=-1, keepdims=True)
+    cos = np.clip(np.sum(z0 * z1, -1, keepdims=True) / (n0 * n1), -1, 1)
+    omega = np.arccos(cos)
+    sin = np.sin(omega)
+
+    parallel = sin < 1e-6
+    sin = np.where(parallel, 1, sin)
+    s0 = np.where(parallel, 1 - t, np.sin((1 - t) * omega) / sin)
+    s1 = np.where(parallel, t, np.sin(t * omega) / sin)
+    return s0 * z0 + s1 * z1
+
+
+# n_steps vectors from each keyframe towards the next, ending on the last keyframe, or going back to
+# the first keyframe if loop is True
+def interpolate(keyframes, n_steps, method='slerp', loop=False):
+    keyframes = np.asarray(keyframes)
+    if loop:
+        keyframes = np.concatenate([keyframes, keyframes[:1]])
+
+    t = np.arange(n_steps) / n_steps
+    z0 = keyframes[:-1, np.newaxis]
+    z1 = keyframes[1:, np.newaxis]
+    z = {'slerp': slerp, 'lerp': lerp}[method](z0, z1, t[np.newaxis])
+    z = z.reshape(-1, keyframes.shape[1])
+
+    if not loop:
+        z = np.concatenate([z, keyframes[-1:]])
+    return z
+
+
+# Grid of n_rows x n_cols latent vectors interpolated between 4 corners (top left, top right, bottom
+# left, bottom right), in row major order
+def corner_grid(corners, n_rows, n_cols, method='slerp'):
+    corners = np.asarray(corners)
+    interp = {'slerp': slerp, 'lerp': lerp}[method]
+    rows = np.linspace(0, 1, n_rows)[:, np.newaxis]
+    cols = np.linspace(0, 1, n_cols)[np.newaxis, :]
+
+    left = interp(corners[0], corners[2], rows)
+    right = interp(corners[1], corners[3], rows)
+    z = interp(left[:, np.newaxis], right[:, np.newaxis], cols)
+    return z.reshape(n_rows * n_cols, corners.shape[1])
+
+
+# Closed loop of n_frames latent vectors along a great circle through two random directions. Every
+# vector has the same norm, that of the random directions.
+def circular_loop(n_frames, z_length, seed=None):
+    a, b = normal(2, z_length, seed)
+    b -= a * np.dot(a, b) / np.dot(a, a)
+    b *= np.linalg.norm(a) / np.linalg.norm(b)
+
+    theta = 2 * np.pi * np.arange(n_frames) / n_frames
+    return np.cos(theta)[:, np.newaxis] * a + np.sin(theta)[:, np.newaxis] * b
@@ -1,22 +1,37 @@
-from progan_v15 import ProGAN
+import inspect
+import json
+import multiprocessing as mp
+import os
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 import librosa
 import numpy as np
+from moviepy.config import get_setting
 from moviepy.video.VideoClip import VideoClip
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 from moviepy.editor import AudioFileClip
 from sklearn.preprocessing import StandardScaler
 
+from preview import to_uint8
 
-def get_z_from_audio(audio, z_length, n_bins=60, hop_length=512, random_state=50):
-    np.random.seed(random_state)
+
+# Constant-Q magnitudes of audio, one standardized row of n_bins per hop
+def get_audio_features(audio, n_bins=60, hop_length=512):
     if type(audio) == str:
         audio, sr = librosa.load(audio)
 
     y = librosa.core.cqt(audio, n_bins=n_bins, hop_length=hop_length)
     mag, phase = librosa.core.magphase(y)
     mag = mag.T
-    mag = StandardScaler().fit_transform(mag)
+    return StandardScaler().fit_transform(mag)
 
+
+# Latent vectors of the audio features mag, padded with static noise and shuffled by random_state
+def get_z_from_features(mag, z_length, random_state=50):
+    np.random.seed(random_state)
     s0, s1 = mag.shape
     static = np.random.normal(size=[z_length - s1])
     static = np.tile(static, (s0, 1))
@@ -27,39 +42,215 @@ def get_z_from_audio(audio, z_length, n_bins=60, hop_length=512, random_state=50
     z = z.T
     return z
 
-def make_video(audio, filename, progan, n_bins=60, random_state=0, imgs_per_batch=20):
+
+def get_z_from_audio(audio, z_length, n_bins=60, hop_length=512, random_state=50):
+    mag = get_audio_features(audio, n_bins=n_bins, hop_length=hop_length)
+    return get_z_from_features(mag, z_length, random_state=random_state)
+
+
+# Latent vectors of the audio samples y at rate sr, one per frame, or with n_cols rows of n_cols latent
+# vectors each following the audio with its own noise and shuffling of the frequency bins, and the frame rate
+def get_frame_latents(y, sr, z_length, n_bins=60, random_state=0, n_cols=None):
+    mag = get_audio_features(y, n_bins=n_bins)
+    if n_cols is None:
+        z_audio = get_z_from_features(mag, z_length, random_state=random_state)
+    else:
+        z_audio = np.stack([get_z_from_features(mag, z_length, random_state=random_state + i)
+                            for i in range(n_cols)], 1)
+    return z_audio, z_audio.shape[0] / (len(y) / sr)
+
+
+# uint8 frames of images generated from frame latents. Without n_cols the square images are cropped and
+# joined with their mirror image, close to 16:9.
+def to_frames(imgs, n_cols=None):
+    frames = to_uint8(imgs)
+    if n_cols is not None:
+        return frames
+    res = frames.shape[1]
+    frames = frames[:, :, :res * 8 // 9, :]
+    return np.concatenate((frames, np.flip(frames, 2)), 2)
+
+
+# Render a video of images generated by progan (a progan_v16.ProGAN) from latent vectors following the
+# spectrum of audio. Without n_cols each frame is a square image mirrored to 16:9; with n_cols each is
+# generated from a row of n_cols latent vectors (see ProGAN.wide_generator) as a res x res * (n_cols + 3) / 4
+# image, n_cols=4 gives 4 x 7 blocks of 4x4 pixels, close to 16:9. Frames are generated imgs_per_batch at a
+# time as the video is written.
+def make_video(audio, filename, progan, n_bins=60, random_state=0, imgs_per_batch=20, n_cols=None):
     y, sr = librosa.load(audio)
     song_length = len(y) / sr
-    z_audio = get_z_from_audio(y, z_length=progan.z_length, n_bins=n_bins, random_state=random_state)
-    fps = z_audio.shape[0] / song_length
+    z_audio, fps = get_frame_latents(y, sr, progan.z_length, n_bins, random_state, n_cols)
     res = progan.get_cur_res()
-    shape = (res, res * 16 // 9, 3)
+    shape = (res, res * 8 // 9 * 2 if n_cols is None else res * (n_cols + 3) // 4, 3)
 
-    imgs = np.zeros(shape=[imgs_per_batch, *shape], dtype=np.float32)
+    # Batch of frames currently being shown and the index of its first frame, and the number of frames
+    # generated and the time spent generating them
+    batch = {'start': None, 'imgs': None}
+    stats = {'frames': 0, 'time': 0.0}
 
     def make_frame(t):
-        global imgs
         cur_frame_idx = int(t * fps)
 
         if cur_frame_idx >= len(z_audio):
             return np.zeros(shape=shape, dtype=np.uint8)
 
-        if cur_frame_idx % imgs_per_batch == 0:
-            imgs = progan.generate(z_audio[cur_frame_idx:cur_frame_idx + imgs_per_batch])
-            imgs = imgs[:, :, :res * 8 // 9, :]
-            imgs_rev = np.flip(imgs, 2)
-            imgs = np.concatenate((imgs, imgs_rev), 2)
+        start = cur_frame_idx - cur_frame_idx % imgs_per_batch
+        if start != batch['start']:
+            gen_start = time.perf_counter()
+            imgs = to_frames(progan.generate(z_audio[start:start + imgs_per_batch], wide=n_cols is not None),
+                             n_cols)
+            stats['time'] += time.perf_counter() - gen_start
+            stats['frames'] += len(imgs)
+            batch['start'], batch['imgs'] = start, imgs
 
-        return imgs[cur_frame_idx % imgs_per_batch]
+        return batch['imgs'][cur_frame_idx - start]
 
+    # The clip generates its first frame when it is created
+    render_start = time.perf_counter()
     video_clip = VideoClip(make_frame=make_frame, duration=song_length)
     audio_clip = AudioFileClip(audio)
     video_clip = video_clip.set_audio(audio_clip)
     video_clip.write_videofile(filename, fps=fps)
+    render_time = time.perf_counter() - render_start
+
+    n = max(stats['frames'], 1)
+    print('{} frames of {}x{} ---- generation: {:.1f} ms/frame, {:.1f} frames/sec ---- '
+          'rendering with encoding: {:.1f} ms/frame, {:.1f} frames/sec'.format(
+              stats['frames'], shape[1], shape[0], 1000 * stats['time'] / n, n / max(stats['time'], 1e-9),
+              1000 * render_time / n, n / render_time))
+
+
+# ProGAN of a segment rendering worker process, created once per process
+_worker = dict()
+
+
+def _init_worker(progan_kwargs, n_workers):
+    import session_config
+    from progan_v16 import ProGAN
+
+    # Workers share the CPU cores instead of each starting a thread per core
+    progan_kwargs = dict(progan_kwargs)
+    if progan_kwargs.get('session_options') is None:
+        options = session_config.load(progan_kwargs['logdir']) or dict()
+        options.setdefault('intra_op_threads', max(1, os.cpu_count() // n_workers))
+        progan_kwargs['session_options'] = options
+    _worker['progan'] = ProGAN(training=False, **progan_kwargs)
+
+
+# Generate and encode frames start to stop of the latents at z_path into a video file without audio. The
+# frames are written to a partial file that is renamed to path once complete, so an existing path is
+# always a whole segment. Returns the number of frames and the seconds they took.
+def _render_segment(z_path, start, stop, path, fps, imgs_per_batch, n_cols):
+    progan = _worker['progan']
+    z = np.array(np.load(z_path, mmap_mode='r')[start:stop])
+    partial = path[:-len('.mp4')] + '.partial.mp4'
+
+    segment_start = time.perf_counter()
+    writer = None
+    for imgs in progan.iter_generate(z, imgs_per_batch, wide=n_cols is not None):
+        frames = to_frames(imgs, n_cols)
+        if writer is None:
+            writer = FFMPEG_VideoWriter(partial, (frames.shape[2], frames.shape[1]), fps, codec='libx264')
+        for frame in frames:
+            writer.write_frame(frame)
+    writer.close()
+
+    os.replace(partial, path)
+    return stop - start, time.perf_counter() - segment_start
+
+
+# Render the same video as make_video in segments of segment_seconds, each generated and encoded by one of
+# n_workers processes with its own ProGAN built from progan_kwargs. The segments are joined by ffmpeg
+# without re-encoding and the audio is added once. Segments are kept in workdir, by default next to
+# filename, until the video is written: segments that failed or whose worker died are rendered again, up
+# to max_retries times, and running this again with the same arguments and checkpoint only renders missing
+# segments.
+def render_segments(audio, filename, progan_kwargs, n_workers=2, segment_seconds=10, n_bins=60,
+                    random_state=0, imgs_per_batch=20, n_cols=None, workdir=None, max_retries=3):
+    import tensorflow as tf
+    from progan_v16 import ProGAN
+    z_length = progan_kwargs.get('z_length', inspect.signature(ProGAN).parameters['z_length'].default)
+
+    y, sr = librosa.load(audio)
+    z_audio, fps = get_frame_latents(y, sr, z_length, n_bins, random_state, n_cols)
+    n_frames = len(z_audio)
+    segment_frames = max(1, int(round(segment_seconds * fps)))
+
+    workdir = workdir or os.path.splitext(filename)[0] + '_segments'
+    if not os.path.exists(workdir): os.makedirs(workdir)
+    z_path = os.path.join(workdir, 'latents.npy')
+    segments = [(start, min(start + segment_frames, n_frames),
+                 os.path.join(workdir, 'segment_{:05d}.mp4'.format(i)))
+                for i, start in enumerate(range(0, n_frames, segment_frames))]
+
+    # Segments of an earlier run are only reused if they were rendered from the same frames by the same
+    # checkpoint, which changes as training continues in logdir
+    checkpoint = tf.train.latest_checkpoint(progan_kwargs['logdir'])
+    settings = {'audio': os.path.abspath(audio), 'progan_kwargs': progan_kwargs, 'n_bins': n_bins,
+                'random_state': random_state, 'n_cols': n_cols, 'n_frames': n_frames, 'fps': fps,
+                'segment_frames': segment_frames, 'checkpoint': checkpoint,
+                'checkpoint_mtime': checkpoint and os.path.getmtime(checkpoint + '.index')}
+    settings_path = os.path.join(workdir, 'render.json')
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            if json.load(f) != json.loads(json.dumps(settings)):
+                print('Settings changed since {} was rendered, rendering all segments again'.format(workdir))
+                for f in os.listdir(workdir):
+                    if f.startswith('segment_'):
+                        os.remove(os.path.join(workdir, f))
+    np.save(z_path, z_audio)
+    with open(settings_path, 'w') as f:
+        json.dump(settings, f, indent=4)
+
+    render_start, rendered = time.perf_counter(), 0
+    for attempt in range(max_retries + 1):
+        pending = [s for s in segments if not os.path.exists(s[2])]
+        if not pending:
+            break
+        print('Rendering {} of {} segments with {} workers'.format(len(pending), len(segments), n_workers))
+
+        try:
+            with ProcessPoolExecutor(min(n_workers, len(pending)), mp_context=mp.get_context('spawn'),
+                                     initializer=_init_worker, initargs=(progan_kwargs, n_workers)) as pool:
+                futures = {pool.submit(_render_segment, z_path, start, stop, path, fps, imgs_per_batch,
+                                       n_cols): path
+                           for start, stop, path in pending}
+                for future in as_completed(futures):
+                    try:
+                        frames, seconds = future.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        # Other segments keep rendering, this one is rendered again on the next attempt
+                        print('{} failed ---- {!r}'.format(os.path.basename(futures[future]), e))
+                        continue
+                    rendered += frames
+                    print('{} ---- {} frames in {:.1f}s ---- {:.1f} ms/frame'.format(
+                        os.path.basename(futures[future]), frames, seconds, 1000 * seconds / frames))
+        except BrokenProcessPool:
+            print('A worker died, rendering its segments again')
+
+    missing = [path for _, _, path in segments if not os.path.exists(path)]
+    if missing:
+        raise RuntimeError('{} segments failed after {} retries, run again to resume'.format(
+            len(missing), max_retries))
+    render_time = time.perf_counter() - render_start
+
+    # Join the segments as they are and encode only the audio
+    list_path = os.path.join(workdir, 'segments.txt')
+    with open(list_path, 'w') as f:
+        f.writelines("file '{}'\n".format(os.path.basename(path)) for _, _, path in segments)
+    subprocess.run([get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error',
+                    '-f', 'concat', '-safe', '0', '-i', list_path, '-i', audio,
+                    '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', '-c:a', 'aac', '-shortest', filename],
+                   check=True)
+
+    for f in os.listdir(workdir):
+        if f.startswith('segment') or f in ('latents.npy', 'render.json'):
+            os.remove(os.path.join(workdir, f))
+    if not os.listdir(workdir):
+        os.rmdir(workdir)
 
-if __name__ == '__main__':
-    progan = ProGAN(
-        logdir='logdir_v2',
-        img_dir='img_arrays',
-    )
-    make_video('videos\\eco_zones.mp3', 'eco_zones.mp4', progan, random_state=768)
\ No newline at end of file
+    print('{} frames in {} segments, {} rendered in {:.1f}s ---- {:.1f} ms/frame, {:.1f} frames/sec'.format(
+        n_frames, len(segments), rendered, render_time, 1000 * render_time / max(rendered, 1),
+        rendered / render_time))
@@ -0,0 +1,169 @@
+import hashlib
+import os
+
+import numpy as np
+
+from augment import center_crop
+
+
+'''
+Sliced Wasserstein distance (SWD) between training images and generated images, as used to evaluate
+ProGAN in the paper. Images are split into Laplacian pyramids down to 16x16, 7x7 neighborhoods are
+sampled from every level and the distance between the distributions of real and generated neighborhoods
+is estimated with random 1D projections. Small distances at the coarse levels mean the overall structure
+of the images matches, at the fine levels that the textures and edges do.
+
+Everything is done with numpy on the CPU. Descriptors of the real images only depend on the memmap arrays
+of the resolution, so they are computed once from a sample of all arrays and cached in cache_dir until the
+arrays change. Generated images are drawn batch by batch and only their descriptors are kept.
+
+Images are expected in the range of the memmap arrays, 0 - 255, with generated images in -1 - 1. Real
+images larger than the resolution are cut from the center, as FeedDict does without augmentation.
+'''
+
+cache_filename = 'swd_real_{}.npz'
+
+# Binomial approximation of a gaussian, as used by cv2.pyrDown
+_kernel = np.float32([1, 4, 6, 4, 1]) / 16
+
+
+def _blur(imgs, kernel):
+    for axis in (2, 3):
+        pad = [(0, 0)] * 4
+        pad[axis] = (2, 2)
+        padded = np.pad(imgs, pad, mode='reflect')
+        size = imgs.shape[axis]
+        imgs = sum(w * np.take(padded, range(i, i + size), axis) for i, w in enumerate(kernel))
+    return imgs
+
+
+def _pyr_down(imgs):
+    return _blur(imgs, _kernel)[:, :, ::2, ::2]
+
+
+def _pyr_up(imgs):
+    n, c, h, w = imgs.shape
+    up = np.zeros((n, c, h * 2, w * 2), imgs.dtype)
+    up[:, :, ::2, ::2] = imgs
+    return _blur(up, _kernel * 2)
+
+
+# Levels of the Laplacian pyramid of a batch of NCHW images, finest first
+def laplacian_pyramid(imgs, n_levels):
+    pyramid = [np.float32(imgs)]
+    for _ in range(1, n_levels):
+        pyramid.append(_pyr_down(pyramid[-1]))
+        pyramid[-2] -= _pyr_up(pyramid[-1])
+    return pyramid
+
+
+def n_levels(dim):
+    return max(1, int(np.log2(dim)) - 3)
+
+
+# Random square neighborhoods of every image in the batch, flattened to [n_imgs * nhoods, c * size * size]
+def _descriptors(imgs, nhoods, random):
+    n, c, h, w = imgs.shape
+    size = min(7, h - 1, w - 1)
+    r = size // 2
+    img, chan, y, x = np.ogrid[0:n * nhoods, 0:c, -r:r + 1, -r:r + 1]
+    img = img // nhoods
+    y = y + random.randint(r, h - r, size=(n * nhoods, 1, 1, 1))
+    x = x + random.randint(r, w - r, size=(n * nhoods, 1, 1, 1))
+    return imgs[img, chan, y, x].reshape(n * nhoods, -1)
+
+
+# Normalize each color channel of a set of descriptors to zero mean and unit variance
+def _normalize(desc, n_channels=3):
+    desc = desc.reshape(desc.shape[0], n_channels, -1)
+    desc = desc - np.mean(desc, axis=(0, 2), keepdims=True)
+    desc /= np.std(desc, axis=(0, 2), keepdims=True) + 1e-8
+    return desc.reshape(desc.shape[0], -1)
+
+
+# Descriptors of every pyramid level for images drawn from batches, an iterable of NCHW arrays
+def pyramid_descriptors(batches, dim, nhoods_per_image=64, seed=0):
+    random = np.random.RandomState(seed)
+    levels = [[] for _ in range(n_levels(dim))]
+    for batch in batches:
+        for descs, level in zip(levels, laplacian_pyramid(batch, len(levels))):
+            descs.append(_descriptors(level, nhoods_per_image, random))
+    return [_normalize(np.concatenate(descs)) for descs in levels]
+
+
+def _array_paths(imgdir, dim):
+    return sorted(os.path.join(imgdir, f) for f in os.listdir(imgdir) if f.startswith('{}_'.format(dim)))
+
+
+# Key of the arrays at paths, which changes when any of them is rebuilt
+def _arrays_key(paths):
+    key = hashlib.md5()
+    for path in paths:
+        stat = os.stat(path)
+        key.update('{}:{}:{}'.format(os.path.basename(path), stat.st_size, stat.st_mtime_ns).encode())
+    return key.hexdigest()
+
+
+# Batches of up to n_images images of resolution dim drawn at random from all memmap arrays in imgdir, read
+# from the arrays or from shared memory for arrays in cache, a TierCache
+def iter_real_batches(imgdir, dim, n_images, batch_size=64, seed=0, cache=None):
+    random = np.random.RandomState(seed)
+    arrays = [cache.load(path, 'r') if cache is not None else np.load(path, mmap_mode='r')
+              for path in _array_paths(imgdir, dim)]
+
+    # Indices into all arrays one after another, split into the indices within each array
+    offsets = np.cumsum([0] + [len(array) for array in arrays])
+    idx = np.sort(random.permutation(offsets[-1])[:n_images])
+    bounds = np.searchsorted(idx, offsets)
+    for array, offset, lo, hi in zip(arrays, offsets, bounds[:-1], bounds[1:]):
+        for start in range(lo, hi, batch_size):
+            batch = idx[start:min(start + batch_size, hi)] - offset
+            yield np.asarray(center_crop(array[batch], dim), np.float32)
+
+
+# Real descriptors at resolution dim, loaded from cache_dir if they were computed before from the same arrays
+def real_descriptors(imgdir, cache_dir, dim, n_images=2048, batch_size=64, nhoods_per_image=64,
+                     tier_cache=None):
+    path = os.path.join(cache_dir, cache_filename.format(dim))
+    arrays_key = _arrays_key(_array_paths(imgdir, dim))
+    if os.path.exists(path):
+        with np.load(path) as cache:
+            if (cache['n_images'] == n_images and cache['nhoods_per_image'] == nhoods_per_image and
+                    'arrays_key' in cache.files and cache['arrays_key'] == arrays_key):
+                return [cache['level_{}'.format(i)] for i in range(n_levels(dim))]
+
+    batches = iter_real_batches(imgdir, dim, n_images, batch_size, cache=tier_cache)
+    levels = pyramid_descriptors(batches, dim, nhoods_per_image)
+
+    if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+    np.savez(path, n_images=n_images, nhoods_per_image=nhoods_per_image, arrays_key=arrays_key,
+             **{'level_{}'.format(i): desc for i, desc in enumerate(levels)})
+    return levels
+
+
+# Average over random directions of the 1D Wasserstein distance between projections of a and b
+def sliced_wasserstein(a, b, dir_repeats=4, dirs_per_repeat=128, seed=0):
+    random = np.random.RandomState(seed)
+    n = min(len(a), len(b))
+    a, b = a[:n], b[:n]
+
+    results = []
+    for _ in range(dir_repeats):
+        dirs = random.normal(size=(a.shape[1], dirs_per_repeat)).astype(np.float32)
+        dirs /= np.linalg.norm(dirs, axis=0, keepdims=True)
+        proj_a = np.sort(a @ dirs, axis=0)
+        proj_b = np.sort(b @ dirs, axis=0)
+        results.append(np.mean(np.abs(proj_a - proj_b)))
+    return float(np.mean(results))
+
+
+# SWD at every pyramid level between real images and images from generate(batch_size), which should
+# return NCHW images in -1 - 1. Returns the distances from the finest to the coarsest level, times 1000.
+def swd(generate, real, dim, n_images=2048, batch_size=64, nhoods_per_image=64):
+    def fake_batches():
+        for start in range(0, n_images, batch_size):
+            imgs = generate(min(batch_size, n_images - start))
+            yield (np.clip(imgs, -1, 1) + 1) * 127.5
+
+    fake = pyramid_descriptors(fake_batches(), dim, nhoods_per_image, seed=1)
+    return [sliced_wasserstein(r, f) * 1000 for r, f in zip(real, fake)]
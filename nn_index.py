@@ -0,0 +1,198 @@
+import json
+import os
+
+import numpy as np
+
+from augment import center_crop, downscale
+
+
+'''
+Nearest neighbor index over the training images, to check whether generated images copy them. Images
+are read from the memmap arrays of one resolution, averaged down to a small resolution (16x16 or 32x32),
+projected onto their first principal components and stored as float16, so millions of images take a few hundred
+MB and are memory-mapped instead of loaded.
+
+The index is built incrementally: the principal components are fitted to a sample of the first arrays
+found, and later builds only add arrays that aren't in the index yet. Embeddings and the array and
+image number of each embedding are appended to flat binary files, the manifest records how many of
+them are complete.
+
+Queries embed a batch of images (generated images in -1 - 1 or uint8 images of any larger resolution)
+and scan the index in chunks, keeping the k nearest of every image. With flip the mirrored images are
+searched too, as training mirrors images at random. Distances are RMS pixel differences in -1 - 1 as
+far as the principal components capture them.
+'''
+
+manifest_filename = 'manifest.json'
+pca_filename = 'pca.npz'
+embeddings_filename = 'embeddings.f16'
+ids_filename = 'ids.i32'
+
+
+# Flattened float32 images in -1 - 1 at res x res
+def _flatten(imgs, res):
+    imgs = np.asarray(imgs)
+    imgs = imgs / 127.5 - 1 if imgs.dtype == np.uint8 else imgs
+    return np.float32(downscale(imgs, res)).reshape(len(imgs), -1)
+
+
+def _save_manifest(index_dir, manifest):
+    path = os.path.join(index_dir, manifest_filename)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+# Principal components of n_fit images drawn at random from the arrays at paths
+def _fit_pca(paths, res, n_components, n_fit, seed):
+    arrays = [np.load(p, mmap_mode='r') for p in paths]
+    offsets = np.cumsum([0] + [len(a) for a in arrays])
+    n_fit = min(n_fit, offsets[-1])
+    idx = np.sort(np.random.RandomState(seed).choice(offsets[-1], n_fit, replace=False))
+
+    x = np.concatenate([_flatten(a[idx[(idx >= lo) & (idx < hi)] - lo], res)
+                        for a, lo, hi in zip(arrays, offsets[:-1], offsets[1:])])
+    mean = x.mean(0)
+    _, _, vt = np.linalg.svd(x - mean, full_matrices=False)
+    return mean, vt[:n_components]
+
+
+# Create the index of the source_res x source_res arrays in imgdir, by default those of res, or add the
+# arrays that aren't indexed yet
+def build_index(imgdir, index_dir, res=32, source_res=None, n_components=64, n_fit=10000, batch_size=4096,
+                seed=0):
+    source_res = source_res or res
+    files = sorted(f for f in os.listdir(imgdir) if f.startswith('{}_'.format(source_res)))
+    if not files:
+        raise ValueError('No {}x{} arrays in {}'.format(source_res, source_res, imgdir))
+
+    if not os.path.exists(index_dir): os.makedirs(index_dir)
+    manifest_path = os.path.join(index_dir, manifest_filename)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if (manifest['res'], manifest['source_res']) != (res, source_res):
+            raise ValueError('{} indexes {}x{} images of the {}x{} arrays'.format(
+                index_dir, manifest['res'], manifest['res'], manifest['source_res'], manifest['source_res']))
+    else:
+        mean, components = _fit_pca([os.path.join(imgdir, f) for f in files], res, n_components, n_fit, seed)
+        np.savez(os.path.join(index_dir, pca_filename), mean=mean, components=components)
+        manifest = {'res': res, 'source_res': source_res, 'n_components': len(components),
+                    'imgdir': os.path.abspath(imgdir), 'arrays': [], 'n': 0}
+        _save_manifest(index_dir, manifest)
+
+    with np.load(os.path.join(index_dir, pca_filename)) as pca:
+        mean, components = pca['mean'], pca['components']
+    d = manifest['n_components']
+    indexed = dict(manifest['arrays'])
+
+    with open(os.path.join(index_dir, embeddings_filename), 'ab') as embeddings, \
+            open(os.path.join(index_dir, ids_filename), 'ab') as ids:
+
+        # Drop whatever an interrupted build appended after the last complete array
+        embeddings.truncate(manifest['n'] * d * 2)
+        ids.truncate(manifest['n'] * 2 * 4)
+
+        for f in files:
+            array = np.load(os.path.join(imgdir, f), mmap_mode='r')
+            if f in indexed:
+                if indexed[f] != len(array):
+                    raise ValueError('{} changed since it was indexed, delete {} to rebuild'.format(
+                        f, index_dir))
+                continue
+
+            k = len(manifest['arrays'])
+            for start in range(0, len(array), batch_size):
+                x = _flatten(array[start:start + batch_size], res)
+                embeddings.write(((x - mean) @ components.T).astype(np.float16).tobytes())
+                n = len(x)
+                ids.write(np.stack([np.full(n, k), np.arange(start, start + n)], 1).astype(np.int32).tobytes())
+            embeddings.flush()
+            ids.flush()
+
+            manifest['arrays'].append([f, len(array)])
+            manifest['n'] += len(array)
+            _save_manifest(index_dir, manifest)
+            print('Indexed {}: {} images, {} in total'.format(f, len(array), manifest['n']))
+
+    return NNIndex(index_dir)
+
+
+class NNIndex:
+
+    def __init__(self, index_dir, imgdir=None):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, manifest_filename)) as f:
+            self.manifest = json.load(f)
+        self.imgdir = imgdir or self.manifest['imgdir']
+        with np.load(os.path.join(index_dir, pca_filename)) as pca:
+            self.mean, self.components = pca['mean'], pca['components']
+
+        self.res = self.manifest['res']
+        self.n = self.manifest['n']
+        d = self.manifest['n_components']
+        if self.n:
+            self.embeddings = np.memmap(os.path.join(index_dir, embeddings_filename), np.float16, 'r',
+                                        shape=(self.n, d))
+            self.ids = np.memmap(os.path.join(index_dir, ids_filename), np.int32, 'r', shape=(self.n, 2))
+        else:
+            self.embeddings = np.zeros((0, d), np.float16)
+            self.ids = np.zeros((0, 2), np.int32)
+
+    def __len__(self): return self.n
+
+    def embed(self, imgs):
+        return (_flatten(imgs, self.res) - self.mean) @ self.components.T
+
+    # Distances and ids of the k nearest indexed images of each of imgs, nearest first. Ids are pairs of
+    # the array number and the image number within the array, see path and images.
+    def query(self, imgs, k=5, flip=True, chunk_size=2 ** 16):
+        if self.n == 0:
+            raise ValueError('{} has no images to query'.format(self.index_dir))
+        k = min(k, self.n)
+        q = self.embed(imgs)
+        if flip:
+            q = np.concatenate([q, self.embed(np.asarray(imgs)[..., ::-1])])
+        q_norms = np.sum(np.square(q), 1, keepdims=True)
+
+        best_dist = np.full((len(q), k), np.inf, np.float32)
+        best_idx = np.zeros((len(q), k), np.int64)
+        for start in range(0, self.n, chunk_size):
+            x = np.asarray(self.embeddings[start:start + chunk_size], np.float32)
+            dist = q_norms - 2 * q @ x.T + np.sum(np.square(x), 1)
+            idx = np.broadcast_to(np.arange(start, start + len(x)), dist.shape)
+
+            dist = np.concatenate([best_dist, dist], 1)
+            idx = np.concatenate([best_idx, idx], 1)
+            top = np.argpartition(dist, k - 1, 1)[:, :k]
+            best_dist = np.take_along_axis(dist, top, 1)
+            best_idx = np.take_along_axis(idx, top, 1)
+
+        # Merge the neighbors of each image and its mirror image, keeping the nearer of duplicates
+        if flip:
+            n = len(imgs)
+            dist = np.concatenate([best_dist[:n], best_dist[n:]], 1)
+            idx = np.concatenate([best_idx[:n], best_idx[n:]], 1)
+            order = np.argsort(dist, 1, kind='stable')
+            dist, idx = np.take_along_axis(dist, order, 1), np.take_along_axis(idx, order, 1)
+            # np.unique returns the first, i.e. nearest, position of each image
+            keep = [np.sort(np.unique(i, return_index=True)[1])[:k] for i in idx]
+            best_dist = np.stack([d[p] for d, p in zip(dist, keep)])
+            best_idx = np.stack([i[p] for i, p in zip(idx, keep)])
+        else:
+            order = np.argsort(best_dist, 1)
+            best_dist = np.take_along_axis(best_dist, order, 1)
+            best_idx = np.take_along_axis(best_idx, order, 1)
+
+        rms = np.sqrt(np.maximum(best_dist, 0) / self.mean.size)
+        return rms, np.asarray(self.ids)[best_idx]
+
+    # The arrays are looked up in imgdir, by default the one the index was built from
+    def path(self, array_number):
+        return os.path.join(self.imgdir, self.manifest['arrays'][array_number][0])
+
+    # Indexed images of ids, as stored in the arrays and cut to their resolution
+    def images(self, ids):
+        ids = np.asarray(ids).reshape(-1, 2)
+        imgs = [np.load(self.path(k), mmap_mode='r')[i] for k, i in ids]
+        return center_crop(np.stack(imgs), self.manifest['source_res'])
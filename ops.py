@@ -5,8 +5,16 @@ import numpy as np
 weight_init = tf.random_normal_initializer()
 bias_init = tf.constant_initializer(0)
 
+# Implementation used for mode='upscale'/'downscale' in conv and for decrese_res when no
+# resample argument is given. 'fused' folds the 2x resampling into a stride 2 (transpose)
+# convolution, 'separate' resamples and convolves as two ops. Both produce the same output,
+# benchmark_ops.py measures which one is faster at each resolution.
+resample_modes = ('fused', 'separate')
+default_resample = 'fused'
 
-def conv(input, out_channels, filter_size=3, k=1, padding='SAME', mode=None, output_shape=None):
+
+def conv(input, out_channels, filter_size=3, k=1, padding='SAME', mode=None, output_shape=None,
+         resample=None):
     if tf.rank(input) == 3: input = tf.expand_dims(input, [3])
 
     in_shape = tf.shape(input)
@@ -17,13 +25,29 @@ def conv(input, out_channels, filter_size=3, k=1, padding='SAME', mode=None, out
     else:
         filter_shape = [filter_size, filter_size, input_channels, out_channels]
 
+    # Variables are always float32, they are cast to the precision of the input for the computation
     filter = tf.get_variable('filter', filter_shape, initializer=weight_init)
     fan_in = filter_size ** 2 * input_channels
-    filter = filter * tf.sqrt(2 / fan_in)
+    filter = tf.cast(filter * tf.sqrt(2 / fan_in), input.dtype)
 
     b = tf.get_variable('bias', [1, out_channels, 1, 1], initializer=bias_init)
+    b = tf.cast(b, input.dtype)
+
+    resample = resample or default_resample
+    assert resample in resample_modes
+
+    if mode == 'upscale' and resample == 'separate':
+        # conv2d_transpose with stride 1 is conv2d with a flipped filter
+        filter = tf.transpose(tf.reverse(filter, [0, 1]), [0, 1, 3, 2])
+        output = tf.nn.conv2d(upscale2d(input), filter, [1, 1, 1, 1],
+            padding=padding, data_format='NCHW')
 
-    if mode == 'upscale':
+    elif mode == 'downscale' and resample == 'separate':
+        output = tf.nn.conv2d(input, filter, [1, 1, 1, 1], padding=padding, data_format='NCHW')
+        output = tf.nn.avg_pool(output, ksize=[1, 1, 2, 2], strides=[1, 1, 2, 2],
+            padding='VALID', data_format='NCHW')
+
+    elif mode == 'upscale':
         filter = tf.pad(filter, [[1, 1], [1, 1], [0, 0], [0, 0]], mode='CONSTANT')
         filter = tf.add_n([filter[1:, 1:], filter[:-1, 1:], filter[1:, :-1], filter[:-1, :-1]])
         output_shape = [in_shape[0], out_channels, in_shape[2] * 2, in_shape[3] * 2]
@@ -54,42 +78,65 @@ def conv(input, out_channels, filter_size=3, k=1, padding='SAME', mode=None, out
 def dense(input, output_size):
     fan_in = int(input.get_shape()[1])
     W = tf.get_variable('W', [fan_in, output_size], initializer=weight_init)
-    W = W * tf.sqrt(2 / fan_in)
+    W = tf.cast(W * tf.sqrt(2 / fan_in), input.dtype)
     b = tf.get_variable('b', [1, output_size, 1, 1], initializer=bias_init)
-    return tf.matmul(input, W) + b
+    return tf.matmul(input, W) + tf.cast(b, input.dtype)
 
 
 def leaky_relu(input, alpha=0.2):
     return tf.nn.leaky_relu(input, alpha=alpha)
 
 
+# Statistics are computed in float32 so that the epsilon does not underflow in reduced precision
 def pixelwise_norm(input):
-    pixel_var = tf.reduce_mean(tf.square(input), 1, keepdims=True)
-    return input / tf.sqrt(pixel_var + 1e-8)
+    pixel_var = tf.reduce_mean(tf.square(tf.cast(input, tf.float32)), 1, keepdims=True)
+    return input * tf.cast(tf.rsqrt(pixel_var + 1e-8), input.dtype)
 
 
 def conv_layer(input, out_channels, **kwargs):
     return pixelwise_norm(leaky_relu(conv(input, out_channels, **kwargs)))
 
 
-def decrese_res(input, k=2, data_format='NCHW'):
+def upscale2d(input, k=2):
+    # Nearest neighbor upsampling of NCHW input by broadcasting against a k x k block of ones
+    shape = tf.shape(input)
+    channels = int(input.get_shape()[1])
+    output = tf.reshape(input, [-1, channels, shape[2], 1, shape[3], 1])
+    output = output * tf.ones([1, 1, 1, k, 1, k], dtype=input.dtype)
+    return tf.reshape(output, [-1, channels, shape[2] * k, shape[3] * k])
+
+
+def decrese_res(input, k=2, data_format='NCHW', resample=None):
     filter = [1, 1, k, k]
     pool =  tf.nn.avg_pool(
         input, ksize=filter, strides=filter, padding='SAME', data_format=data_format
     )
+    if (resample or default_resample) == 'separate':
+        return upscale2d(pool, k)
     shape = tf.shape(pool)
     output = tf.reshape(pool, [-1, shape[1], shape[2], 1, shape[3], 1])
     output = tf.tile(output, [1, 1, 1, k, 1, k])
     return tf.reshape(output, [-1, shape[1], shape[2] * k, shape[3] * k])
 
 
-def minibatch_stddev(input):
+# Appends the average standard deviation over the minibatch as an extra channel. If group_size is
+# given, the batch is split into groups of that size (batch size must be divisible by it) and each
+# group gets its own statistic, as in the ProGAN paper. Like pixelwise_norm it is computed in float32.
+def minibatch_stddev(input, group_size=None):
     shape = tf.shape(input)
-    x_ = tf.tile(tf.reduce_mean(input, 0, keepdims=True), [shape[0], 1, 1, 1])
-    sigma = tf.sqrt(tf.reduce_mean(tf.square(input - x_), 0, keepdims=True) + 1e-8)
-    sigma_avg = tf.reduce_mean(sigma, keepdims=True)
-    layer = tf.tile(sigma_avg, [shape[0], shape[1], shape[2], 1])
-    return tf.concat((input, layer), 3)
+    channels = int(input.get_shape()[1])
+    group_size = shape[0] if group_size is None else tf.minimum(group_size, shape[0])
+
+    # [group, minibatch, C, H, W], the statistic is taken over the group axis
+    x = tf.reshape(tf.cast(input, tf.float32), [group_size, -1, channels, shape[2], shape[3]])
+    x -= tf.reduce_mean(x, 0, keepdims=True)
+    sigma = tf.sqrt(tf.reduce_mean(tf.square(x), 0) + 1e-8)
+    sigma_avg = tf.reduce_mean(sigma, [1, 2, 3], keepdims=True)
+
+    # Broadcast each group's scalar to a [N, 1, H, W] feature map
+    layer = tf.ones([group_size, 1, 1, shape[2], shape[3]]) * sigma_avg[None]
+    layer = tf.cast(tf.reshape(layer, [-1, 1, shape[2], shape[3]]), input.dtype)
+    return tf.concat((input, layer), 1)
 
 
 def resize_images(input, dims=None):
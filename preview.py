@@ -0,0 +1,104 @@
+import os
+import queue
+import struct
+import threading
+import zlib
+
+import numpy as np
+import tensorflow as tf
+
+
+'''
+Preview images for TensorBoard and the logdir, assembled in numpy instead of in the graph. Grids are
+built from uint8 images and encoded as PNG on a background thread so training only waits for the
+generator itself.
+'''
+
+
+# NCHW images in -1 - 1 to NHWC uint8
+def to_uint8(imgs):
+    imgs = np.transpose(imgs, (0, 2, 3, 1))
+    return ((np.clip(imgs, -1, 1) + 1) * 127.5).astype(np.uint8)
+
+
+# Arrange NHWC images in a grid of n_cols columns, by default about 3:2, each upscaled by an integer
+# factor to at least min_size pixels. Missing images at the end of the last row are left black.
+def grid(imgs, n_cols=None, min_size=256):
+    n, h, w, c = imgs.shape
+    if n_cols is None:
+        n_cols = int(np.ceil(np.sqrt(n * 1.5)))
+    n_cols = min(n, n_cols)
+    n_rows = -(-n // n_cols)
+
+    scale = max(1, min_size // min(h, w))
+    if scale > 1:
+        imgs = imgs.repeat(scale, 1).repeat(scale, 2)
+        h, w = h * scale, w * scale
+
+    padded = np.zeros((n_rows * n_cols, h, w, c), imgs.dtype)
+    padded[:n] = imgs
+    padded = padded.reshape(n_rows, n_cols, h, w, c).transpose(0, 2, 1, 3, 4)
+    return padded.reshape(n_rows * h, n_cols * w, c)
+
+
+# Encode an HWC uint8 RGB image as PNG
+def encode_png(img):
+    h, w, c = img.shape
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+    # Each row starts with filter type 0 (none)
+    rows = np.concatenate([np.zeros((h, 1), np.uint8), img.reshape(h, w * c)], 1)
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)),
+        chunk(b'IEND', b'')
+    ])
+
+
+# Writes image summaries and PNG files on a background thread. Images are queued as uint8 arrays.
+class PreviewWriter:
+
+    def __init__(self, logdir, summary_writer=None, save_png=True):
+        self.summary_writer = summary_writer
+        self.png_dir = os.path.join(logdir, 'previews') if save_png else None
+        if self.png_dir and not os.path.exists(self.png_dir):
+            os.makedirs(self.png_dir)
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # Queue NHWC uint8 images to be written under tag at global step. With big_image they are combined
+    # into a single grid, otherwise each image is a separate summary.
+    def write(self, tag, imgs, step, big_image=True, n_cols=None):
+        self.queue.put((tag, imgs, step, big_image, n_cols))
+
+    def _run(self):
+        while True:
+            tag, imgs, step, big_image, n_cols = self.queue.get()
+            try:
+                self._write(tag, imgs, step, big_image, n_cols)
+            except Exception as e:
+                print('Could not write preview {}: {}'.format(tag, e))
+            finally:
+                self.queue.task_done()
+
+    def _write(self, tag, imgs, step, big_image, n_cols):
+        img_grid = grid(imgs, n_cols)
+        if self.png_dir:
+            with open(os.path.join(self.png_dir, '{}_{}.png'.format(tag, step)), 'wb') as f:
+                f.write(encode_png(img_grid))
+
+        if self.summary_writer is not None:
+            imgs = [img_grid] if big_image else [grid(img[np.newaxis]) for img in imgs]
+            values = [tf.Summary.Value(tag='{}/image/{}'.format(tag, i), image=tf.Summary.Image(
+                height=img.shape[0], width=img.shape[1], colorspace=3, encoded_image_string=encode_png(img)))
+                for i, img in enumerate(imgs)]
+            self.summary_writer.add_summary(tf.Summary(value=values), step)
+
+    # Wait until all queued previews have been written
+    def flush(self):
+        self.queue.join()
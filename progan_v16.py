@@ -1,18 +1,38 @@
+import contextlib
 import datetime as dt
+import json
 import os
 import sys
+import time
+from collections import deque, namedtuple
 
 # Operations used in building the network. Many are not used in the current model
 from ops import *
 # FeedDict object used to continuously provide new training data
 from feed_dict import FeedDict
+import augment
+import latent
+# Session threading and graph optimizer options
+import session_config
+# Sliced Wasserstein distance between real and generated images
+import metrics
+# Preview image grids written on a background thread
+import preview
 
 
-# TODO: add argparser and flags
 # TODO: refactor training function
 # TODO: train next version of model using reset_optimizer=True
 
 
+# Operations and tensors of the network at one layer. The accumulation ops and the lists of accumulator
+# variables are None unless gradients are accumulated over several micro-batches or workers, Gz_ema is
+# None without a moving average of the generator and only dim, Gz and Gz_ema are built if not training
+Network = namedtuple('Network', [
+    'dim', 'wd', 'gp', 'wd_sum', 'gp_sum', 'g_train', 'd_train',
+    'Gz', 'discriminator', 'g_accumulate', 'g_apply', 'd_accumulate', 'd_apply',
+    'g_accumulators', 'd_accumulators', 'Gz_ema', 'generator'], defaults=(None,) * 17)
+
+
 class ProGAN:
     def __init__(self,
             logdir,                    # directory of stored models
@@ -28,12 +48,26 @@ class ProGAN:
             batch_repeats=1,           # number of times to repeat minibatch
             n_examples=24,             # number of example images to generate
             lipschitz_penalty=True,   # if True, use WGAN-LP instead of WGAN-GP
-            big_image=True,            # Generate a single large preview image, only works if n_examples = 24
+            big_image=True,            # combine the preview images into a single grid
             scaling_factor=None,       # factor to scale down number of trainable parameters
             reset_optimizer=False,     # reset optimizer variables with each new layer
             use_uint8=False,
             batch_sizes=None,
-            channels=None
+            channels=None,
+            resample_mode=None,        # 'fused' or 'separate' resampling ops, or a list with one per layer
+            stddev_group_size=None,    # minibatch stddev group size, None uses the whole batch as one group
+            precision='float32',       # 'float16' or 'bfloat16' to train with reduced precision activations
+            loss_scaling=None,         # dynamic loss scaling, by default only used for float16
+            loss_scale_interval=1000,  # number of steps without overflow before the loss scale is doubled
+            accum_steps=1,             # micro-batches per update, or a list with one per layer
+            communicator=None,         # distributed.Communicator for data parallel training with several workers
+            session_options=None,      # session_config options, by default loaded from logdir if saved there
+            jit=False,                 # compile the generator, discriminator and losses with XLA
+            ema_decay=0.999,           # decay of the moving average of generator weights, None to disable
+            training=True,             # if False, only build the generators to sample from a saved model
+            eval_images=None,          # number of images to compute the sliced Wasserstein distance on at each save
+            feed_options=None,         # extra FeedDict arguments, e.g. {'n_open_shards': 4, 'cache_mb': 2048}
+            prewarm_imgs=10000         # images before the end of a layer to warm up the next one, None to disable
     ):
 
         # Scale down the number of factors if scaling_factor is provided
@@ -48,14 +82,55 @@ class ProGAN:
         self.batch_repeats = batch_repeats if batch_repeats else 1
         self.n_imgs = n_imgs
         self.logdir = logdir
+        self.imgdir = imgdir
+        self.eval_images = eval_images
+        self.prewarm_imgs = prewarm_imgs
         self.big_image = big_image
         self.w_lambda = w_lambda
         self.w_gamma = w_gamma
         self.epsilon = epsilon
         self.reset_optimizer=reset_optimizer
         self.lipschitz_penalty = lipschitz_penalty
+        self.resample_mode = resample_mode
+        self.stddev_group_size = stddev_group_size
+        self.jit = jit
+        self.training = training
         self.start = True
 
+        # Shadow variable holding the exponential moving average of each generator variable
+        self.ema_decay = ema_decay
+        self.ema_vars = dict()
+
+        # Activations and matmuls use self.dtype, variables and losses stay in float32
+        if precision not in ('float32', 'float16', 'bfloat16'):
+            raise ValueError("precision must be 'float32', 'float16' or 'bfloat16', not {!r}".format(precision))
+        self.dtype = tf.as_dtype(precision)
+        if loss_scaling is None:
+            loss_scaling = self.dtype == tf.float16
+        self.loss_scale_interval = loss_scale_interval
+
+        # Gradient accumulators are shared between layers, one per variable and one counter each for G and D
+        self.accum_steps = accum_steps
+        self.accumulators = dict()
+        self.accumulator_loads = dict()
+
+        # With several workers every worker trains on batch_size // n_workers images of each batch and
+        # the accumulated gradients are summed over all workers before each update
+        self.communicator = communicator
+        self.n_workers = communicator.n_workers if communicator else 1
+        self.worker_index = communicator.rank if communicator else 0
+        self.is_chief = self.worker_index == 0
+
+        # The minibatch stddev of a worker's share of a batch needs at least one whole group, or two images
+        # if the group is the whole batch
+        if self.n_workers > 1:
+            min_batch_size = self.stddev_group_size or 2
+            for layer, batch_size in enumerate(self.batch_sizes):
+                if batch_size // self.n_workers < min_batch_size:
+                    raise ValueError('batch size {} of layer {} leaves {} images per worker, fewer than the '
+                                     'minibatch stddev needs ({})'.format(
+                                         batch_size, layer, batch_size // self.n_workers, min_batch_size))
+
         # Generate fized latent variables for image previews
         np.random.seed(0)
         self.z_fixed = np.random.normal(size=[self.n_examples, self.z_length])
@@ -79,6 +154,15 @@ class ProGAN:
             self.alpha = tf.minimum(1.0, tf.div(tf.to_float(self.img_step), self.n_imgs))
             self.layer = tf.to_int32(tf.add(self.total_imgs, self.n_imgs) / (self.n_imgs * 2))
 
+        # Dynamic loss scales for the generator and discriminator, each a (scale, good steps) pair
+        self.g_loss_scale, self.d_loss_scale = None, None
+        if loss_scaling:
+            with tf.variable_scope('loss_scale'):
+                self.g_loss_scale, self.d_loss_scale = [(
+                    tf.Variable(2.0 ** 15, name='{}_loss_scale'.format(name), trainable=False),
+                    tf.Variable(0, name='{}_good_steps'.format(name), trainable=False)
+                ) for name in ('G', 'D')]
+
         # Initialize optimizer as member variable if not rest_optimizer, otherwise generate new
         # optimizer for each layer
         if self.reset_optimizer:
@@ -89,43 +173,249 @@ class ProGAN:
             self.g_optimizer = tf.train.AdamOptimizer(learning_rate, beta1, beta2)
             self.d_optimizer = tf.train.AdamOptimizer(learning_rate, beta1, beta2)
 
-        # Initialize FeedDict
-        self.feed = FeedDict(imgdir, logdir)
-        self.n_layers = self.feed.n_sizes
+        # Initialize FeedDict, workers share the seed of their FeedDicts but draw different latent variables.
+        # Without training data, generators are built for every layer with a batch size.
+        feed_options = feed_options or dict()
+        if not self.training:
+            self.feed = None
+        elif self.n_workers > 1:
+            self.feed = FeedDict(imgdir, logdir,
+                worker_index=self.worker_index, n_workers=self.n_workers, seed=0, **feed_options)
+            np.random.seed(self.worker_index + 1)
+        else:
+            self.feed = FeedDict(imgdir, logdir, **feed_options)
+        self.n_layers = self.feed.n_sizes if self.feed is not None else len(self.batch_sizes)
         self.networks = [self._create_network(i + 1) for i in range(self.n_layers)]
 
+        # Assignment of every variable from a placeholder, to restore them after warming up a layer with a
+        # single run
+        self.variable_loads = None
+
+        # Graphs for projecting images onto the latent space and for generating wide images, built when
+        # first used
+        self.projectors = dict()
+        self.wide_generators = dict()
+        if self.training and self.prewarm_imgs:
+            with tf.variable_scope('warm_up'):
+                variables = tf.global_variables()
+                placeholders = [tf.placeholder(var.dtype.base_dtype, var.shape) for var in variables]
+                self.variable_loads = (variables, placeholders, tf.group(
+                    *[tf.assign(var, placeholder) for var, placeholder in zip(variables, placeholders)]))
+
         # Initialize Session, FileWriter and Saver
-        self.sess = tf.Session()
-        self.sess.run(tf.global_variables_initializer())
-        self.writer = tf.summary.FileWriter(self.logdir, graph=self.sess.graph)
+        if session_options is None:
+            session_options = session_config.load(logdir) or dict()
+        self.session_options = session_options
+        self.sess = tf.Session(config=session_config.make_config(**session_options))
+        self.init_ops = [tf.global_variables_initializer(), tf.local_variables_initializer()]
+        self.sess.run(self.init_ops)
+        self.writer, self.previews = None, None
+        if self.is_chief and self.training:
+            self.writer = tf.summary.FileWriter(self.logdir, graph=self.sess.graph)
+            self.previews = preview.PreviewWriter(self.logdir, self.writer)
         self.saver = tf.train.Saver()
 
         # Look in logdir to see if a saved model already exists. If so, load it
         try:
-            self.saver.restore(self.sess, tf.train.latest_checkpoint(self.logdir))
+            self._restore()
             print('Restored ----------------\n')
         except Exception:
             pass
 
+        if self.n_workers > 1:
+            self._broadcast_variables()
+
+        # Continue with the batches that followed the restored checkpoint
+        if self.feed is not None:
+            self._restore_feed()
+
+
+    # Restore the latest checkpoint in logdir. Only variables saved in the checkpoint are restored, so a
+    # model saved before the moving average was added (or by a different number of layers) still loads.
+    # Moving averages missing from the checkpoint start from the restored generator weights.
+    def _restore(self, variables=None):
+        variables = tf.global_variables() if variables is None else variables
+        checkpoint = tf.train.latest_checkpoint(self.logdir)
+        saved = {name for name, _ in tf.train.list_variables(checkpoint)}
+        tf.train.Saver([v for v in variables if v.op.name in saved]).restore(self.sess, checkpoint)
+
+        missing = [(var, ema) for var, ema in self.ema_vars.items()
+                   if ema in variables and ema.op.name not in saved]
+        self.sess.run([tf.assign(ema, var) for var, ema in missing])
+
+
+    # Load the FeedDict state this worker saved with the restored checkpoint, if it was saved at the same
+    # global step
+    def _restore_feed(self):
+        state = None
+        if os.path.exists(self.feed.state_path):
+            with open(self.feed.state_path) as f:
+                state = json.load(f)
+
+        if state is not None and state.get('global_step') == self.sess.run(self.global_step):
+            self.feed.load_state(state)
+            print('Restored data order ----------------\n')
+
 
     # Function for fading input of current layer into previous layer based on current value of alpha
     def _reparameterize(self, x0, x1):
+        alpha = tf.cast(self.alpha, x0.dtype)
         return tf.add(
-            tf.scalar_mul(tf.subtract(1.0, self.alpha), x0),
-            tf.scalar_mul(self.alpha, x1)
+            tf.scalar_mul(tf.subtract(tf.cast(1.0, x0.dtype), alpha), x0),
+            tf.scalar_mul(alpha, x1)
         )
 
 
+    # Ops built within this scope are compiled with XLA if jit is enabled, their gradients included
+    def _compile_scope(self):
+        return tf.xla.experimental.jit_scope() if self.jit else contextlib.nullcontext()
+
+
+    # Gradients of cost. If a loss scale is given, the cost is scaled up before computing gradients in
+    # reduced precision and the gradients are scaled back down.
+    def _gradients(self, cost, var_list, loss_scale=None):
+        if loss_scale is None:
+            return tf.gradients(cost, var_list)
+
+        scale = loss_scale[0]
+        return [g / scale for g in tf.gradients(cost * scale, var_list)]
+
+
+    # Apply gradients with optimizer. With a loss scale, updates that overflow are skipped and halve the
+    # loss scale, loss_scale_interval updates without overflow double it.
+    def _apply_gradients(self, optimizer, grads, var_list, loss_scale=None, global_step=None):
+        if loss_scale is None:
+            return optimizer.apply_gradients(zip(grads, var_list), global_step=global_step)
+
+        scale, good_steps = loss_scale
+        finite = tf.reduce_all([tf.reduce_all(tf.is_finite(g)) for g in grads])
+
+        train = tf.cond(finite,
+            lambda: optimizer.apply_gradients(zip(grads, var_list), global_step=global_step),
+            tf.no_op)
+
+        with tf.control_dependencies([train]):
+            next_good_steps = tf.where(finite, good_steps + 1, tf.zeros_like(good_steps))
+            grow = next_good_steps >= self.loss_scale_interval
+            next_scale = tf.where(finite,
+                tf.where(grow, scale * 2, scale),
+                tf.maximum(scale / 2, 1.0))
+            return tf.group(
+                tf.assign(scale, next_scale),
+                tf.assign(good_steps, tf.where(grow, tf.zeros_like(good_steps), next_good_steps)))
+
+
+    def _minimize(self, optimizer, cost, var_list, loss_scale=None, global_step=None):
+        grads = self._gradients(cost, var_list, loss_scale)
+        return self._apply_gradients(optimizer, grads, var_list, loss_scale, global_step)
+
+
+    # Variables of the 'Generator' or 'Discriminator' used at a layer
+    def _layer_vars(self, network, layers):
+        var_list = []
+        var_scopes = ['layer_{}'.format(i) for i in range(layers)]
+        var_scopes.extend(['dense', 'rgb_layer_{}'.format(layers - 1), 'rgb_layer_{}'.format(layers - 2)])
+        for scope in var_scopes:
+            var_list.extend(tf.get_collection(
+                tf.GraphKeys.GLOBAL_VARIABLES,
+                scope='Network/{}/{}'.format(network, scope)))
+        return var_list
+
+
+    # Build the generator again on the moving averages of the weights of g_vars, creating shadow
+    # variables for the ones that don't have one yet. Shadows are saved with the model as EMA/<name>.
+    def _ema_generator(self, generator, g_vars, z=None):
+        with tf.name_scope('EMA/'):
+            for var in g_vars:
+                if var not in self.ema_vars:
+                    self.ema_vars[var] = tf.Variable(
+                        var.initialized_value(), name=var.op.name, trainable=False)
+
+        def ema_getter(getter, *args, **kwargs):
+            return self.ema_vars[getter(*args, **kwargs)]
+
+        with tf.variable_scope('Network', reuse=True, custom_getter=ema_getter):
+            return tf.cast(generator(self.z_placeholder if z is None else z), tf.float32)
+
+
+    # Update the moving averages of g_vars after train has been run
+    def _ema_update(self, train, g_vars):
+        with tf.control_dependencies([train]):
+            return tf.group(*[
+                tf.assign_sub(self.ema_vars[var], (1 - self.ema_decay) * (self.ema_vars[var] - var))
+                for var in g_vars])
+
+
+    # Local (not checkpointed) variable holding the running sum of gradients of var, or a counter. Each
+    # accumulator also gets a placeholder and assign op used to load the sums of all workers into it.
+    def _accumulator(self, name, shape=()):
+        if name not in self.accumulators:
+            with tf.name_scope('accumulate/'):
+                accum = tf.Variable(
+                    tf.zeros(shape), name=name, trainable=False,
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                placeholder = tf.placeholder(tf.float32, shape)
+            self.accumulators[name] = accum
+            self.accumulator_loads[accum] = (placeholder, tf.assign(accum, placeholder))
+        return self.accumulators[name]
+
+
+    # Number of micro-batches of each update at layer
+    def _accum_steps(self, layer):
+        if isinstance(self.accum_steps, (list, tuple)):
+            return self.accum_steps[layer]
+        return self.accum_steps
+
+
+    # Whether the updates of layer go through the gradient accumulators, which they do with several
+    # micro-batches or several workers
+    def _accumulates(self, layer):
+        return self._accum_steps(layer) > 1 or self.n_workers > 1
+
+
+    # Build an op adding the gradients of cost for one micro-batch to the accumulators and an op
+    # applying their average and resetting the accumulators. Also returns the accumulators used.
+    def _accumulate(self, optimizer, cost, var_list, name, loss_scale=None, global_step=None):
+        accums = [self._accumulator(var.op.name, var.shape) for var in var_list]
+        count = self._accumulator('{}_count'.format(name))
+
+        grads = self._gradients(cost, var_list, loss_scale)
+        accumulate = tf.group(
+            *[tf.assign_add(a, g) for a, g in zip(accums, grads)],
+            tf.assign_add(count, 1.0))
+
+        grads = [a / count for a in accums]
+        train = self._apply_gradients(optimizer, grads, var_list, loss_scale, global_step)
+        with tf.control_dependencies([train]):
+            apply = tf.group(
+                *[tf.assign(a, tf.zeros_like(a)) for a in accums],
+                tf.assign(count, 0.0))
+
+        return accumulate, apply, accums + [count]
+
+
     # Function for creating network layout at each layer
     def _create_network(self, layers):
 
-        # Build the generator for this layer
+        # Resampling implementation for this layer, see ops.conv
+        if isinstance(self.resample_mode, (list, tuple)):
+            resample = self.resample_mode[layers - 1]
+        else:
+            resample = self.resample_mode
+
+        # Build the generator for this layer. z is a batch of latent vectors, or a batch of rows of n latent
+        # vectors [N, n, z_length], a 1 x n latent grid whose 4x4 blocks overlap into a 4 x (n + 3) grid,
+        # so that a single pass generates images (n + 3) / 4 times as wide as they are high.
         def generator(z):
-            with tf.variable_scope('Generator'):
+            with tf.variable_scope('Generator'), self._compile_scope():
 
                 with tf.variable_scope('latent_vector'):
-                    z = tf.expand_dims(z, 2)
-                    g1 = tf.expand_dims(z, 3)
+                    z = tf.cast(z, self.dtype)
+                    if z.get_shape().ndims == 3:
+                        g1 = tf.expand_dims(tf.transpose(z, [0, 2, 1]), 2)
+                    else:
+                        z = tf.expand_dims(z, 2)
+                        g1 = tf.expand_dims(z, 3)
 
                 for i in range(layers):
                     with tf.variable_scope('layer_{}'.format(i)):
@@ -137,7 +427,7 @@ class ProGAN:
                             if i == 0:
                                 g1 = conv_layer(g1, self.channels[i],
                                     filter_size=4, padding='VALID', mode='transpose',
-                                    output_shape=[tf.shape(g1)[0], self.channels[i], 4, 4])
+                                    output_shape=[tf.shape(g1)[0], self.channels[i], 4, tf.shape(g1)[3] + 3])
                             else:
                                 g1 = conv_layer(g1, self.channels[i])
 
@@ -145,7 +435,8 @@ class ProGAN:
                             if i == layers - 1:
                                 g1 = conv_layer(g1, self.channels[i])
                             else:
-                                g1 = conv_layer(g1, self.channels[i], mode='upscale')
+                                g1 = conv_layer(g1, self.channels[i], mode='upscale',
+                                    resample=resample)
 
                 with tf.variable_scope('rgb_layer_{}'.format(layers - 1)):
                     g1 = conv(g1, 3, filter_size=1)
@@ -159,14 +450,16 @@ class ProGAN:
 
             return g
 
-        # Build the discriminator for this layer
-        def discriminator(x):
-            with tf.variable_scope('Discriminator'):
+        # Build the discriminator for this layer. If features is a list, the activations of every block
+        # above the minibatch stddev layer, which mixes the images of a batch, are appended to it.
+        def discriminator(x, features=None):
+            with tf.variable_scope('Discriminator'), self._compile_scope():
+                x = tf.cast(x, self.dtype)
 
                 if layers > 1:
                     with tf.variable_scope('rgb_layer_{}'.format(layers - 2)):
                         d0 = conv_layer(x, self.channels[layers - 1],
-                            filter_size=1, mode='downscale')
+                            filter_size=1, mode='downscale', resample=resample)
 
                 with tf.variable_scope('rgb_layer_{}'.format(layers - 1)):
                     d1 = conv_layer(x, self.channels[layers], filter_size=1)
@@ -175,7 +468,7 @@ class ProGAN:
                     with tf.variable_scope('layer_{}'.format(i)):
 
                         if i == 0:
-                            d1 = minibatch_stddev(d1)
+                            d1 = minibatch_stddev(d1, self.stddev_group_size)
 
                         with tf.variable_scope('1'):
                             d1 = conv_layer(d1, self.channels[i])
@@ -185,14 +478,18 @@ class ProGAN:
                                 d1 = conv_layer(d1, self.channels[0],
                                     filter_size=4, padding='VALID')
                             else:
-                                d1 = conv_layer(d1, self.channels[i], mode='downscale')
+                                d1 = conv_layer(d1, self.channels[i], mode='downscale',
+                                    resample=resample)
 
                         if i == layers - 1 and layers > 1:
                             d1 = self._reparameterize(d0, d1)
 
+                        if features is not None and i > 0:
+                            features.append(d1)
+
                 with tf.variable_scope('dense'):
                     d = tf.reshape(d1, [-1, self.channels[0]])
-                    d = dense(d, 1)
+                    d = tf.cast(dense(d, 1), tf.float32)
 
             return d
 
@@ -202,13 +499,24 @@ class ProGAN:
         # Build the current network
         with tf.variable_scope('Network', reuse=tf.AUTO_REUSE):
             Gz = generator(self.z_placeholder)
+
+        # Generator on the moving averages of its weights, used for sampling
+        Gz_ema = None
+        if self.ema_decay is not None:
+            Gz_ema = self._ema_generator(generator, self._layer_vars('Generator', layers))
+
+        if not self.training:
+            return Network(dim, Gz=tf.cast(Gz, tf.float32), discriminator=discriminator, Gz_ema=Gz_ema,
+                           generator=generator)
+
+        with tf.variable_scope('Network', reuse=tf.AUTO_REUSE):
             Dz = discriminator(Gz)
 
             # Mix different resolutions of input images according to value of alpha
             with tf.variable_scope('training_images'):
                 x = scale_uint8(self.x_placeholder)
                 if layers > 1:
-                    x0 = decrese_res(x)
+                    x0 = decrese_res(x, resample=resample)
                     x1 = x
                     x = self._reparameterize(x0, x1)
 
@@ -216,17 +524,23 @@ class ProGAN:
 
             # Fake and real image mixing for WGAN-GP loss function
             interp = tf.random_uniform(shape=[tf.shape(Dz)[0], 1, 1, 1], minval=0., maxval=1.)
-            x_hat = interp * x + (1 - interp) * Gz
+            interp = tf.cast(interp, self.dtype)
+            x_hat = interp * tf.cast(x, self.dtype) + (1 - interp) * Gz
             Dx_hat = discriminator(x_hat)
 
         # Loss function and scalar summaries
-        with tf.variable_scope('Loss_Function'):
+        with tf.variable_scope('Loss_Function'), self._compile_scope():
 
             # Wasserstein Distance
             wd = Dz - Dx
 
-            # Gradient/Lipschitz Penalty
-            grads = tf.gradients(Dx_hat, [x_hat])[0]
+            # Gradient/Lipschitz Penalty, scaled by the discriminator's loss scale if there is one
+            if self.d_loss_scale is None:
+                grads = tf.cast(tf.gradients(Dx_hat, [x_hat])[0], tf.float32)
+            else:
+                scale = self.d_loss_scale[0]
+                grads = tf.gradients(Dx_hat * scale, [x_hat])[0]
+                grads = tf.cast(grads, tf.float32) / scale
             slopes = tf.sqrt(tf.reduce_sum(tf.square(grads), [1, 2, 3]))
             if self.lipschitz_penalty:
                 gp = tf.square(tf.maximum((slopes - self.w_gamma) / self.w_gamma, 0))
@@ -248,74 +562,81 @@ class ProGAN:
             gp_sum = tf.summary.scalar('gradient_penalty_{}x{}'.format(dim, dim), gp)
 
         # Collecting variables to be trained by optimizers
-        g_vars, d_vars = [], []
-        var_scopes = ['layer_{}'.format(i) for i in range(layers)]
-        var_scopes.extend(['dense', 'rgb_layer_{}'.format(layers - 1), 'rgb_layer_{}'.format(layers - 2)])
-        for scope in var_scopes:
-            g_vars.extend(tf.get_collection(
-                tf.GraphKeys.GLOBAL_VARIABLES,
-                scope='Network/Generator/{}'.format(scope)))
-            d_vars.extend(tf.get_collection(
-                tf.GraphKeys.GLOBAL_VARIABLES,
-                scope='Network/Discriminator/{}'.format(scope)))
+        g_vars = self._layer_vars('Generator', layers)
+        d_vars = self._layer_vars('Discriminator', layers)
 
         # Generate optimizer operations
         # if self.reset_optimizer is True then initialize a new optimizer for each layer
         with tf.variable_scope('Optimize'):
             if self.reset_optimizer:
-                g_train = tf.train.AdamOptimizer(
-                    self.lr, self.beta1, self.beta2, name='G_optimizer_{}'.format(layers - 1)).minimize(
-                    g_cost, var_list=g_vars)
-                d_train = tf.train.AdamOptimizer(
-                    self.lr, self.beta1, self.beta2, name='D_optimizer_{}'.format(layers - 1)).minimize(
-                    d_cost, var_list=d_vars, global_step=self.global_step)
-
+                g_optimizer = tf.train.AdamOptimizer(
+                    self.lr, self.beta1, self.beta2, name='G_optimizer_{}'.format(layers - 1))
+                d_optimizer = tf.train.AdamOptimizer(
+                    self.lr, self.beta1, self.beta2, name='D_optimizer_{}'.format(layers - 1))
             else:
-                g_train = self.g_optimizer.minimize(g_cost, var_list=g_vars)
-                d_train = self.d_optimizer.minimize(d_cost, var_list=d_vars, global_step=self.global_step)
+                g_optimizer = self.g_optimizer
+                d_optimizer = self.d_optimizer
+
+            g_train = self._minimize(g_optimizer, g_cost, g_vars, self.g_loss_scale)
+            d_train = self._minimize(d_optimizer, d_cost, d_vars, self.d_loss_scale,
+                global_step=self.global_step)
 
-            # Increment image count
-            n_imgs = tf.shape(x)[0]
+            # Increment image count, all workers train on batches of the same size
+            n_imgs = tf.shape(x)[0] * self.n_workers
             new_image_count = tf.add(self.total_imgs, n_imgs)
             img_step_op = tf.assign(self.total_imgs, new_image_count)
             d_train = tf.group(d_train, img_step_op)
 
+            # Gradient accumulation over micro-batches, images are counted as each micro-batch is seen
+            g_accumulate, g_apply, d_accumulate, d_apply = None, None, None, None
+            g_accumulators, d_accumulators = None, None
+            if self._accumulates(layers - 1):
+                g_accumulate, g_apply, g_accumulators = self._accumulate(
+                    g_optimizer, g_cost, g_vars, 'G', self.g_loss_scale)
+                d_accumulate, d_apply, d_accumulators = self._accumulate(
+                    d_optimizer, d_cost, d_vars, 'D', self.d_loss_scale, global_step=self.global_step)
+                d_accumulate = tf.group(d_accumulate, img_step_op)
+
+            # Moving averages are updated with every update of the generator
+            if self.ema_decay is not None:
+                g_train = self._ema_update(g_train, g_vars)
+                if self._accumulates(layers - 1):
+                    g_apply = self._ema_update(g_apply, g_vars)
+
         # Print variable names to before running model
         print([var.name for var in g_vars])
         print([var.name for var in d_vars])
 
-        # Generate preview images
-        with tf.variable_scope('image_preview'):
-            fake_imgs = tensor_to_imgs(Gz)
-            real_imgs = tensor_to_imgs(x[:min(self.batch_sizes[layers - 1], 4)])
+        # Generated images are returned in float32 regardless of precision
+        Gz = tf.cast(Gz, tf.float32)
 
-            # Upsize images to normal visibility
-            if dim < 256:
-                fake_imgs = resize_images(fake_imgs, (256, 256))
-                real_imgs = resize_images(real_imgs, (256, 256))
+        return Network(dim, wd, gp, wd_sum, gp_sum, g_train, d_train,
+                       Gz, discriminator, g_accumulate, g_apply, d_accumulate, d_apply,
+                       g_accumulators, d_accumulators, Gz_ema, generator)
 
-            # Concatenate images into one large image for preview, only used if 24 preview images are requested
-            if self.big_image and self.n_examples == 24:
-                fake_img_list = tf.unstack(fake_imgs, num=24)
-                fake_img_list = [tf.concat(fake_img_list[6 * i:6 * (i + 1)], 1) for i in range(4)]
-                fake_imgs = tf.concat(fake_img_list, 0)
-                fake_imgs = tf.expand_dims(fake_imgs, 0)
 
-                real_img_list = tf.unstack(real_imgs, num=min(self.batch_sizes[layers - 1], 4))
-                real_imgs = tf.concat(real_img_list, 1)
-                real_imgs = tf.expand_dims(real_imgs, 0)
+    # Summary adding function, only the chief worker writes summaries
+    def _add_summary(self, string, gs):
+        if self.writer is not None:
+            self.writer.add_summary(string, gs)
 
-            # images summaries
-            fake_img_sum = tf.summary.image('fake{}x{}'.format(dim, dim), fake_imgs, self.n_examples)
-            real_img_sum = tf.summary.image('real{}x{}'.format(dim, dim), real_imgs, 4)
 
-        return (dim, wd, gp, wd_sum, gp_sum, g_train, d_train,
-                fake_img_sum, real_img_sum, Gz, discriminator)
+    # Replace the accumulated gradients of every worker by their sum over all workers
+    def _allreduce(self, accumulators):
+        if self.n_workers == 1:
+            return
+        values = self.communicator.allreduce(self.sess.run(accumulators))
+        loads = [self.accumulator_loads[a] for a in accumulators]
+        self.sess.run([assign for _, assign in loads],
+            {placeholder: v for (placeholder, _), v in zip(loads, values)})
 
 
-    # Summary adding function
-    def _add_summary(self, string, gs):
-        self.writer.add_summary(string, gs)
+    # Start all workers from the variables of the chief, which may have restored a checkpoint
+    def _broadcast_variables(self):
+        variables = tf.global_variables()
+        values = self.communicator.broadcast(self.sess.run(variables) if self.is_chief else None)
+        for var, value in zip(variables, values):
+            var.load(value, self.sess)
 
 
     # Latent variable 'z' generator
@@ -323,41 +644,109 @@ class ProGAN:
         return np.random.normal(0.0, 1.0, [batch_size, self.z_length])
 
 
-    # Main training function
-    def train(self):
+    # Run the training operations of layer once on a batch of zeros, so TensorFlow prunes and optimizes
+    # their graph and allocates their memory before the transition instead of during the first steps.
+    # Every variable is restored afterwards, training continues as if they had never been run.
+    def _warm_up(self, layer):
+        network = self.networks[layer]
+        batch_size = max(1, self.batch_sizes[layer] // self.n_workers)
+        feed_dict = {
+            self.x_placeholder: np.zeros([batch_size, 3, network.dim, network.dim],
+                                         self.x_placeholder.dtype.as_numpy_dtype),
+            self.z_placeholder: np.zeros([batch_size, self.z_length])
+        }
+
+        variables, placeholders, load = self.variable_loads
+        values = self.sess.run(variables)
+        # Ops are run with the same feeds as in train, TensorFlow prepares each combination separately
+        if self._accumulates(layer):
+            self.sess.run(network.g_accumulate, feed_dict)
+            self.sess.run(network.g_apply)
+            self.sess.run(network.d_accumulate, feed_dict)
+            self.sess.run(network.d_apply)
+        else:
+            self.sess.run(network.g_train, feed_dict)
+            self.sess.run(network.d_train, feed_dict)
+        self.sess.run([network.wd, network.gp, network.wd_sum, network.gp_sum], feed_dict)
+        self.sess.run(load, dict(zip(placeholders, values)))
+
+
+    # Main training function, optionally stopping after n_steps. Returns the number of images per
+    # second this worker trained on.
+    def train(self, n_steps=None):
+        assert self.training, 'ProGAN was built with training=False'
         prev_layer = None
+        train_start_time = dt.datetime.now()
+        n_trained = 0
+        step = 0
 
         total_imgs = self.sess.run(self.total_imgs)
         max_imgs = (self.n_layers - 0.5) * self.n_imgs * 2
 
-        while total_imgs < max_imgs:
+        # Durations of recent steps, to compare the first step of a new layer with
+        step_times = deque(maxlen=100)
+        prewarmed = set()
+
+        while total_imgs < max_imgs and (n_steps is None or step < n_steps):
+            step += 1
+            step_start = time.perf_counter()
 
             # Get current layer, global step, alpha and total number of images used so far
             layer, gs, img_step, alpha, total_imgs = self.sess.run([
                 self.layer, self.global_step, self.img_step, self.alpha, self.total_imgs])
 
+            # The last step may have finished the last layer
+            if layer >= self.n_layers:
+                break
+
             # Reset start times if a new layer has begun training
             if layer != prev_layer:
                 start_time = dt.datetime.now()
-                batch_size = self.batch_sizes[layer]
+                batch_size = max(1, self.batch_sizes[layer] // self.n_workers)
 
                 # Global step interval to save model and generate image previews
                 save_interval = max(1000, 10000 // 2 ** layer)
 
                 # Get network operations and loss functions for current layer
-                (dim, wd, gp, wd_sum, gp_sum, g_train, d_train,
-                 fake_img_sum, real_img_sum, _, __) = self.networks[layer]
-
-            # Get training data and latent variables to store in feed_dict
-            feed_dict = {
+                network = self.networks[layer]
+                dim, wd, gp, wd_sum, gp_sum, g_train, d_train = network[:7]
+
+            # Shortly before the transition, read the data of the next layer in the background and warm
+            # up its operations. All workers reach this at the same step.
+            next_layer = layer + 1
+            warmed_up = False
+            if (self.prewarm_imgs and next_layer < self.n_layers and next_layer not in prewarmed
+                    and img_step >= 2 * self.n_imgs - self.prewarm_imgs):
+                prewarmed.add(next_layer)
+                warmed_up = True
+                self.feed.prefetch(self.networks[next_layer].dim)
+                warm_up_start = time.perf_counter()
+                self._warm_up(next_layer)
+                print('warmed up {0}x{0} in {1:.2f}s\n'.format(
+                    self.networks[next_layer].dim, time.perf_counter() - warm_up_start))
+
+            # Get training data and latent variables to store in feed_dict, one per micro-batch
+            feed_dicts = [{
                 self.x_placeholder: self.feed.next_batch(batch_size, dim),
                 self.z_placeholder: self._z(batch_size)
-            }
+            } for _ in range(self._accum_steps(layer))]
+            feed_dict = feed_dicts[-1]
 
             # Here's where we actually train the model
             for _ in range(self.batch_repeats):
-                self.sess.run(g_train, feed_dict)
-                self.sess.run(d_train, feed_dict)
+                if self._accumulates(layer):
+                    for fd in feed_dicts:
+                        self.sess.run(network.g_accumulate, fd)
+                    self._allreduce(network.g_accumulators)
+                    self.sess.run(network.g_apply)
+                    for fd in feed_dicts:
+                        self.sess.run(network.d_accumulate, fd)
+                    self._allreduce(network.d_accumulators)
+                    self.sess.run(network.d_apply)
+                else:
+                    self.sess.run(g_train, feed_dict)
+                    self.sess.run(d_train, feed_dict)
+                n_trained += batch_size * self._accum_steps(layer)
 
             # Get loss values and summaries
             wd_, gp_, wd_sum_str, gp_sum_str = self.sess.run([wd, gp, wd_sum, gp_sum], feed_dict)
@@ -388,88 +777,257 @@ class ProGAN:
                     self.start = False
 
                 # Save the model and generate image previews
-                else:
+                elif self.is_chief:
                     print('saving and making images...\n')
+                    print('data loading: {}\n'.format(self.feed.io_stats()))
                     self.saver.save(
                         self.sess, os.path.join(self.logdir, "model.ckpt"),
                         global_step=self.global_step)
+                    self.feed.save(global_step=int(self.sess.run(self.global_step)))
 
-                    real_img_sum_str = self.sess.run(real_img_sum, feed_dict)
-                    img_preview_feed_dict = {
-                        self.x_placeholder: feed_dict[self.x_placeholder][:4],
-                        self.z_placeholder: self.z_fixed
-                    }
+                    # Only the generator is run, grids are assembled and written in the background
+                    fake_imgs = preview.to_uint8(self.generate(self.z_fixed))
+                    real_imgs = preview.to_uint8(feed_dict[self.x_placeholder][:4] / 127.5 - 1)
+                    self.previews.write('fake{}x{}'.format(dim, dim), fake_imgs, gs, self.big_image)
+                    self.previews.write('real{}x{}'.format(dim, dim), real_imgs, gs, self.big_image, n_cols=4)
 
-                    fake_img_sum_str = self.sess.run(fake_img_sum, img_preview_feed_dict)
-                    self._add_summary(fake_img_sum_str, gs)
-                    self._add_summary(real_img_sum_str, gs)
+                    if self.eval_images:
+                        self.evaluate(self.eval_images)
+
+                # Other workers only save their position in the data
+                else:
+                    self.feed.save(global_step=int(self.sess.run(self.global_step)))
 
             # Calculate and print estimated time remaining
             delta_t = dt.datetime.now() - start_time
             time_remaining = delta_t * (1 / (percent_done + 1e-8) - 1)
             print('est. time remaining on current layer: {}'.format(time_remaining))
 
+            # Log how much longer the first step of a new layer took than the steps before it, steps that
+            # warmed up a layer are left out of the comparison
+            step_time = time.perf_counter() - step_start
+            if prev_layer is not None and layer != prev_layer and step_times:
+                stall = step_time - float(np.median(step_times))
+                print('layer transition to {0}x{0}: first step {1:.3f}s, stall {2:.3f}s, waited {3:.3f}s for '
+                      'data\n'.format(dim, step_time, stall, self.feed.prefetch_wait))
+                self._add_summary(tf.Summary(value=[tf.Summary.Value(
+                    tag='transition_stall_{0}x{0}'.format(dim), simple_value=stall)]), gs)
+                step_times.clear()
+                self.feed.prefetch_wait = 0.0
+            if not warmed_up:
+                step_times.append(step_time)
+
             prev_layer = layer
 
+        if self.previews is not None:
+            self.previews.flush()
+        return n_trained / (dt.datetime.now() - train_start_time).total_seconds()
+
+
+    # Sliced Wasserstein distance between n_images generated images and the training images at the
+    # current resolution, for each level of their Laplacian pyramids. Real image descriptors are cached
+    # in logdir. The distances and their average are printed and written as summaries.
+    def evaluate(self, n_images=2048, batch_size=64):
+        layer = int(self.sess.run(self.layer))
+        dim = self.networks[layer].dim
+
+        tier_cache = self.feed.cache if self.feed is not None else None
+        real = metrics.real_descriptors(self.imgdir, self.logdir, dim, n_images, batch_size,
+                                        tier_cache=tier_cache)
+        distances = metrics.swd(lambda n: self.generate(self._z(n)), real, dim, n_images, batch_size)
+        distances.append(float(np.mean(distances)))
+
+        tags = ['{}x{}'.format(dim // 2 ** i, dim // 2 ** i) for i in range(len(distances) - 1)] + ['avg']
+        print('SWD {}x{}: '.format(dim, dim) + ', '.join(
+            '{} {:.2f}'.format(tag, d) for tag, d in zip(tags, distances)) + '\n')
+
+        summary = tf.Summary(value=[tf.Summary.Value(
+            tag='SWD_{}x{}/{}'.format(dim, dim, tag), simple_value=d) for tag, d in zip(tags, distances)])
+        self._add_summary(summary, self.sess.run(self.global_step))
+        return distances
+
 
     def get_cur_res(self):
         cur_layer = self.sess.run(self.layer)
         return 2 ** (2 + cur_layer)
 
 
-    # Function for generating images from a 1D or 2D array of latent vectors
-    def generate(self, z):
-        solo = z.ndim == 1
+    # Function for generating images from latent vectors: z is one latent vector [z_length] or a batch of
+    # them [N, z_length], or with wide one row of latent vectors [n, z_length] or a batch of rows
+    # [N, n, z_length], each row generating one wide image (see wide_generator). With use_ema the moving
+    # average of the generator is used if there is one. Large arrays can be generated batch_size at a time.
+    def generate(self, z, use_ema=True, batch_size=None, wide=False):
+        solo = z.ndim == (2 if wide else 1)
         if solo:
             z = np.expand_dims(z, 0)
 
-        cur_layer = int(self.sess.run(self.layer))
-        imgs = self.networks[cur_layer][9]
-        imgs = self.sess.run(imgs, {self.z_placeholder: z})
+        imgs = np.concatenate(list(self.iter_generate(z, batch_size or len(z), use_ema, wide)))
 
         if solo:
             imgs = np.squeeze(imgs, 0)
         return imgs
 
 
-    # def transform(self, input_img, n_iter=100000):
-    #     with tf.variable_scope('transform'):
-    #         global_step = tf.Variable(0, name='transform_global_step', trainable=False)
-    #         transform_img = tf.Variable(input_img, name='transform_img', dtype=tf.float32)
-    #
-    #     cur_layer = self.sess.run(self.layer)
-    #     (dim, wd, gp, wd_sum, gp_sum, g_train, d_train,
-    #      ake_img_sum, real_img_sum, Gz, discriminator) = self.networks[cur_layer]
-    #
-    #     with tf.variable_scope('Network', reuse=tf.AUTO_REUSE):
-    #         with tf.variable_scope('resize'):
-    #             jitter = tf.random_uniform([2], -10, 10, tf.int32)
-    #             img = tf.manip.roll(transform_img, jitter, [1, 2])
-    #             img = resize(img, (dim, dim))
-    #         Dt = discriminator(img)
-    #
-    #     t_cost = tf.reduce_mean(-Dt)
-    #     tc_sum = tf.summary.scalar('transform_cost_{}x{}'.format(dim, dim), t_cost)
-    #     t_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='transform/transform_img')
-    #     t_train = tf.train.AdamOptimizer(0.0001).minimize(
-    #         t_cost, var_list=t_vars, global_step=global_step)
-    #     transform_img_sum = tf.summary.image('transform', transform_img)
-    #
-    #     self.sess.run(tf.global_variables_initializer())
-    #
-    #     for i in range(n_iter):
-    #         gs, t_cost_, tc_sum_str, _ = self.sess.run([global_step, t_cost, tc_sum, t_train])
-    #         print('Global step: {}, cost: {}\n\n'.format(gs, t_cost_))
-    #         if i % 20 == 0:
-    #             self._add_summary(tc_sum_str, gs)
-    #         if i % 1000 == 0:
-    #             img_sum_str = self.sess.run(transform_img_sum)
-    #             self._add_summary(img_sum_str, gs)
-
-
-if __name__ == '__main__':
-    progan = ProGAN(
-        logdir='logdir_v5',
-        imgdir='memmaps',
-    )
-    progan.train()
\ No newline at end of file
+    # Generate images for a batch of latent vectors [N, z_length], or with wide a batch of rows of them
+    # [N, n, z_length], batch_size at a time, yielding each batch. Only one batch of images is held in
+    # memory, e.g. to render the frames of an interpolation.
+    def iter_generate(self, z, batch_size=64, use_ema=True, wide=False):
+        if z.ndim != (3 if wide else 2):
+            raise ValueError('Expected latent vectors of shape {}, got {}'.format(
+                '[N, n, z_length]' if wide else '[N, z_length]', list(z.shape)))
+
+        cur_layer = int(self.sess.run(self.layer))
+        if wide:
+            z_placeholder, imgs = self.wide_generator(cur_layer, use_ema)
+        else:
+            network = self.networks[cur_layer]
+            z_placeholder = self.z_placeholder
+            imgs = network.Gz_ema if use_ema and network.Gz_ema is not None else network.Gz
+
+        for start in range(0, len(z), batch_size):
+            yield self.sess.run(imgs, {z_placeholder: z[start:start + batch_size]})
+
+
+    # Placeholder for rows of n latent vectors [N, n, z_length] and the images of dim x dim * (n + 3) / 4
+    # the generator of layer produces from them in one pass. Any n works with the same graph, with n = 1
+    # the images are those of the latent vectors. No variables are created, the generator's are reused.
+    def wide_generator(self, layer, use_ema=True):
+        network = self.networks[layer]
+        use_ema = use_ema and network.Gz_ema is not None
+        key = (layer, use_ema)
+        if key in self.wide_generators:
+            return self.wide_generators[key]
+
+        with tf.name_scope('wide_{}x{}'.format(network.dim, network.dim)):
+            z = tf.placeholder(tf.float32, [None, None, self.z_length])
+            if use_ema:
+                imgs = self._ema_generator(network.generator, self._layer_vars('Generator', layer + 1), z)
+            else:
+                with tf.variable_scope('Network', reuse=True):
+                    imgs = tf.cast(network.generator(z), tf.float32)
+
+        self.wide_generators[key] = (z, imgs)
+        return self.wide_generators[key]
+
+
+    # Per image loss between generated images and target images and its gradient with respect to the latent
+    # vectors, for the generator of layer. The loss is the mean squared difference of the pixels plus
+    # feature_weight times that of the discriminator's features, each relative to the target's features.
+    def _projector(self, layer, use_ema=True):
+        key = (layer, use_ema)
+        if key in self.projectors:
+            return self.projectors[key]
+
+        network = self.networks[layer]
+        imgs = network.Gz_ema if use_ema and network.Gz_ema is not None else network.Gz
+        existing = set(tf.global_variables())
+
+        with tf.name_scope('project_{}x{}'.format(network.dim, network.dim)):
+            target = tf.placeholder(tf.float32, [None, 3, network.dim, network.dim])
+            feature_weight = tf.placeholder_with_default(1.0, [])
+
+            fake_features, real_features = [], []
+            with tf.variable_scope('Network', reuse=tf.AUTO_REUSE):
+                network.discriminator(imgs, fake_features)
+                network.discriminator(target, real_features)
+
+            loss = tf.reduce_mean(tf.square(imgs - target), [1, 2, 3])
+            for fake, real in zip(fake_features, real_features):
+                fake, real = tf.cast(fake, tf.float32), tf.cast(real, tf.float32)
+                loss += feature_weight / len(real_features) * (
+                    tf.reduce_mean(tf.square(fake - real), [1, 2, 3]) /
+                    (tf.reduce_mean(tf.square(real), [1, 2, 3]) + 1e-8))
+            grad = tf.gradients(tf.reduce_sum(loss), self.z_placeholder)[0]
+
+        # Without training the discriminator is only built here, its variables are loaded from logdir
+        new_vars = [var for var in tf.global_variables() if var not in existing]
+        if new_vars:
+            self.sess.run(tf.variables_initializer(new_vars))
+            try:
+                self._restore(new_vars)
+            except Exception:
+                pass
+
+        self.projectors[key] = (target, feature_weight, loss, grad)
+        return self.projectors[key]
+
+
+    # Images to project as float32 in -1 - 1 at dim x dim. uint8 images, as in the memmap arrays, are
+    # scaled and larger images are cut from the center and averaged down by an integer factor.
+    def _projection_targets(self, imgs, dim):
+        imgs = np.asarray(imgs)
+        imgs = imgs / 127.5 - 1 if imgs.dtype == np.uint8 else imgs.astype(np.float32)
+        return augment.downscale(imgs, dim).astype(np.float32)
+
+
+    # Starting point of projections: the mean of the latent vectors found by earlier projections, saved
+    # in logdir, or the mean of the prior before the first projection
+    def mean_latent(self):
+        path = os.path.join(self.logdir, 'mean_latent.npz')
+        if os.path.exists(path):
+            with np.load(path) as cache:
+                return cache['mean']
+        return latent.mean_latent(self.z_length)
+
+
+    def _update_mean_latent(self, z):
+        path = os.path.join(self.logdir, 'mean_latent.npz')
+        mean, n = np.mean(z, 0), len(z)
+        if os.path.exists(path):
+            with np.load(path) as cache:
+                mean = (cache['mean'] * cache['n'] + mean * n) / (cache['n'] + n)
+                n += int(cache['n'])
+        np.savez(path, mean=mean, n=n)
+
+
+    # Find latent vectors whose generated images match imgs, NCHW images of the current resolution or
+    # larger, by gradient descent with Adam. Up to batch_size images are optimized together. An image is
+    # done once its loss hasn't improved by a factor of tol for patience steps, or after n_steps, and the
+    # next image takes its place. Returns the best latent vector of each image and its loss.
+    def project(self, imgs, n_steps=1000, batch_size=16, learning_rate=0.05, feature_weight=1.0,
+                patience=50, tol=1e-3, use_ema=True, z_init=None):
+        layer = int(self.sess.run(self.layer))
+        imgs = self._projection_targets(imgs, self.networks[layer].dim)
+        target, weight, loss_op, grad_op = self._projector(layer, use_ema)
+
+        n = len(imgs)
+        z = np.zeros([n, self.z_length])
+        z[:] = self.mean_latent() if z_init is None else z_init
+        best_z, best_loss = z.copy(), np.full(n, np.inf)
+
+        # Adam moments, step counts and steps without improvement of each image
+        m, v = np.zeros_like(z), np.zeros_like(z)
+        steps, stale = np.zeros(n, np.int64), np.zeros(n, np.int64)
+        beta1, beta2 = 0.9, 0.999
+
+        start_time = time.perf_counter()
+        queue, active = deque(range(n)), []
+        while queue or active:
+            while queue and len(active) < batch_size:
+                active.append(queue.popleft())
+            idx = np.array(active)
+
+            loss, grad = self.sess.run([loss_op, grad_op], {
+                self.z_placeholder: z[idx], target: imgs[idx], weight: feature_weight})
+
+            better = loss < best_loss[idx]
+            improved = loss < best_loss[idx] * (1 - tol)
+            best_z[idx[better]] = z[idx[better]]
+            best_loss[idx[better]] = loss[better]
+            stale[idx] = np.where(improved, 0, stale[idx] + 1)
+
+            steps[idx] += 1
+            t = steps[idx, np.newaxis]
+            m[idx] = beta1 * m[idx] + (1 - beta1) * grad
+            v[idx] = beta2 * v[idx] + (1 - beta2) * np.square(grad)
+            z[idx] -= learning_rate * (m[idx] / (1 - beta1 ** t)) / (np.sqrt(v[idx] / (1 - beta2 ** t)) + 1e-8)
+
+            done = (stale[idx] >= patience) | (steps[idx] >= n_steps)
+            active = [i for i, d in zip(active, done) if not d]
+
+        elapsed = time.perf_counter() - start_time
+        print('projected {} images in {:.1f}s ---- {:.1f} images/min ---- {:.0f} steps per image ---- '
+              'mean loss: {:.4f}\n'.format(n, elapsed, 60 * n / elapsed, np.mean(steps), np.mean(best_loss)))
+
+        self._update_mean_latent(best_z)
+        return best_z, best_loss
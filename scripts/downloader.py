@@ -1,48 +1,297 @@
+import hashlib
+import io
+import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse
+
 import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 
+'''
+Downloader fetches images with a pool of threads sharing one requests.Session. Images are streamed to
+disk and named by the sha1 of their content, so the same image found under different links is only
+stored once. Every finished download is appended to a state file in save_dir, which lets an
+interrupted run resume without fetching or overwriting anything it already has. If min_size is given,
+downloads are stopped as soon as the image header shows the image is smaller than that, or when the
+first header_size bytes hold no image header at all, and the link is recorded as rejected.
 
-subreddit = input('Enter subreddit name: ')
-save_dir = input('Enter name of folder to save images in: ')
+Links are found by reading subreddit listing pages (old reddit JSON or HTML) with the same session and
+are handed to the Downloader as soon as each page is parsed. Driving a browser with Selenium is only
+needed as a fallback if the listings can't be fetched directly.
+'''
 
-if not os.path.isdir(save_dir):
-    os.makedirs(save_dir)
+# Width and height of the image whose data starts with data, or None if data doesn't hold a whole image
+# header. Image.open only reads the header, the image is never decoded. Images too large for Pillow to
+# open count as not images.
+def image_size(data):
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return image.size
+    except (OSError, Image.DecompressionBombError):
+        return None
 
-pages = 100
-img_n = 0
-browser = webdriver.Firefox()
-browser.get('https://old.reddit.com/r/{}'.format(subreddit))
 
-for i in range(pages):
-    icons = WebDriverWait(browser, 300).until(
-        EC.presence_of_all_elements_located(
-            (By.CLASS_NAME, "expando-button")
-        )
-    )
+class Downloader:
+
+    state_filename = 'download_state.jsonl'
+
+    def __init__(self, save_dir, n_threads=8, timeout=30, max_retries=3, chunk_size=2 ** 16,
+                 user_agent='ProGAN image downloader', min_size=None, header_size=2 ** 18):
+        self.save_dir = save_dir
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.min_size = min_size
+        self.header_size = header_size
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir)
+
+        adapter = HTTPAdapter(pool_connections=n_threads, pool_maxsize=n_threads, max_retries=max_retries)
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(n_threads)
+        self.lock = threading.Lock()
+
+        # Links already downloaded or queued, and the file stored for each content hash
+        self.urls = set()
+        self.hashes = dict()
+        self.n_downloaded = 0
+        self.n_duplicates = 0
+        self.n_rejected = 0
+        self.n_failed = 0
+
+        self.state_path = os.path.join(save_dir, self.state_filename)
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.urls.add(record['url'])
+                    if record['file']:
+                        self.hashes[record['sha1']] = record['file']
+
+            # Files deleted since the last run can't stand in for new downloads of the same image
+            self.hashes = {sha1: filename for sha1, filename in self.hashes.items()
+                           if os.path.exists(os.path.join(save_dir, filename))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Queue a link for downloading, links that were seen before are skipped
+    def submit(self, url):
+        with self.lock:
+            if url in self.urls:
+                return None
+            self.urls.add(url)
+        return self.executor.submit(self._fetch, url)
+
+    def _record(self, url, sha1, filename, rejected=None):
+        record = {'url': url, 'sha1': sha1, 'file': filename}
+        if rejected: record['rejected'] = rejected
+        with open(self.state_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    # Returns the reason to reject an image of size (width, height), or None if it should be kept
+    def _check_size(self, size):
+        width, height = size
+        if min(width, height) < self.min_size:
+            return 'too small ({}x{})'.format(width, height)
+        return None
+
+    def _fetch(self, url):
+        part_path = os.path.join(self.save_dir, '{}.part'.format(hashlib.sha1(url.encode()).hexdigest()))
+        sha1 = hashlib.sha1()
+        header = bytearray() if self.min_size else None
+        rejected = None
+
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                with open(part_path, 'wb') as f:
+                    for chunk in response.iter_content(self.chunk_size):
+                        if header is not None:
+                            header += chunk[:self.header_size - len(header)]
+                            size = image_size(header)
+                            if size is not None:
+                                rejected, header = self._check_size(size), None
+                            elif len(header) >= self.header_size:
+                                rejected = 'not an image'
+                            if rejected: break
+                        sha1.update(chunk)
+                        f.write(chunk)
+
+            if header is not None and rejected is None:
+                rejected = 'not an image'
+
+        except (requests.RequestException, OSError) as e:
+            print('Failed {}: {}'.format(url, e))
+            if os.path.exists(part_path): os.remove(part_path)
+            with self.lock:
+                self.urls.discard(url)
+                self.n_failed += 1
+            return None
+
+        if rejected:
+            os.remove(part_path)
+            with self.lock:
+                self.n_rejected += 1
+                self._record(url, None, None, rejected)
+            return None
+
+        digest = sha1.hexdigest()
+        with self.lock:
+            duplicate = digest in self.hashes
+            if duplicate:
+                os.remove(part_path)
+                self.n_duplicates += 1
+            else:
+                extension = os.path.splitext(urlparse(url).path)[1] or '.jpg'
+                self.hashes[digest] = digest + extension
+                os.replace(part_path, os.path.join(self.save_dir, self.hashes[digest]))
+                self.n_downloaded += 1
+
+            self._record(url, digest, self.hashes[digest])
+
+        return None if duplicate else self.hashes[digest]
+
+    # Wait for all queued downloads to finish
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+        print('downloaded: {}, duplicates: {}, rejected: {}, failed: {}'.format(
+            self.n_downloaded, self.n_duplicates, self.n_rejected, self.n_failed))
+
 
-    for icon in icons:
-        icon.click()
+# Collects the post links and the next page link of an old reddit listing page
+class _ListingParser(HTMLParser):
 
-    links = WebDriverWait(browser, 300).until(
-        EC.presence_of_all_elements_located((By.CLASS_NAME, "may-blank"))
-    )
-    links = list(set([a.get_attribute('href') for a in links if a.get_attribute('href').endswith('.jpg')]))
+    def __init__(self):
+        super().__init__()
+        self.links = []
+        self.next_page = None
+        self._in_next_button = False
 
-    for link in links:
-        image = requests.get(link)
-        with open('{}/img_{}.jpg'.format(save_dir, img_n), 'wb') as f:
-            f.write(image.content)
-        img_n += 1
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        if tag == 'span' and 'next-button' in classes:
+            self._in_next_button = True
+        elif tag == 'a' and attrs.get('href'):
+            if self._in_next_button:
+                self.next_page = attrs['href']
+            elif 'may-blank' in classes:
+                self.links.append(attrs['href'])
 
-    if i != pages - 1:
-        next_button = WebDriverWait(browser, 300).until(
-            EC.presence_of_element_located((By.CLASS_NAME, "next-button"))
+    def handle_endtag(self, tag):
+        if tag == 'span':
+            self._in_next_button = False
+
+
+# Yield image links from the JSON listings of a subreddit, one page at a time
+def iter_json_links(subreddit, session, pages=100, base_url='https://old.reddit.com',
+                    extensions=('.jpg',), timeout=30):
+    url = '{}/r/{}/.json'.format(base_url, subreddit)
+    after = None
+
+    for i in range(pages):
+        params = {'limit': 100, 'after': after} if after else {'limit': 100}
+        response = session.get(url, params=params, timeout=timeout)
+        response.raise_for_status()
+        listing = response.json()['data']
+
+        links = [c['data'].get('url') or '' for c in listing['children']]
+        links = [l for l in links if urlparse(l).path.endswith(extensions)]
+        print('page: {}, images: {}'.format(i, len(links)))
+        yield from links
+
+        after = listing.get('after')
+        if not after: break
+
+
+# Yield image links from the HTML listing pages of a subreddit, following the next button
+def iter_html_links(subreddit, session, pages=100, base_url='https://old.reddit.com',
+                    extensions=('.jpg',), timeout=30):
+    url = '{}/r/{}/'.format(base_url, subreddit)
+
+    for i in range(pages):
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+        parser = _ListingParser()
+        parser.feed(response.text)
+
+        links = [urljoin(url, l) for l in parser.links]
+        links = [l for l in dict.fromkeys(links) if urlparse(l).path.endswith(extensions)]
+        print('page: {}, images: {}'.format(i, len(links)))
+        yield from links
+
+        if parser.next_page is None: break
+        url = urljoin(url, parser.next_page)
+
+
+# Yield image links by clicking through the subreddit in Firefox, only used as a fallback
+def iter_selenium_links(subreddit, pages=100, base_url='https://old.reddit.com', extensions=('.jpg',)):
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
+    browser = webdriver.Firefox()
+    browser.get('{}/r/{}'.format(base_url, subreddit))
+
+    for i in range(pages):
+        icons = WebDriverWait(browser, 300).until(
+            EC.presence_of_all_elements_located(
+                (By.CLASS_NAME, "expando-button")
+            )
+        )
+
+        for icon in icons:
+            icon.click()
+
+        links = WebDriverWait(browser, 300).until(
+            EC.presence_of_all_elements_located((By.CLASS_NAME, "may-blank"))
         )
-        next_button.click()
+        links = list(set([a.get_attribute('href') for a in links if a.get_attribute('href').endswith(extensions)]))
+        print('page: {}, images: {}'.format(i, len(links)))
+        yield from links
+
+        if i != pages - 1:
+            next_button = WebDriverWait(browser, 300).until(
+                EC.presence_of_element_located((By.CLASS_NAME, "next-button"))
+            )
+            next_button.click()
+
+    browser.quit()
+
+
+# Download the images of a subreddit from the listings at base_url. Links are found with method 'json' or
+# 'html', falling back to Selenium if the listing can't be fetched or read. Other keyword arguments are
+# passed to Downloader.
+def download_subreddit(subreddit, save_dir, pages=100, method='json', base_url='https://old.reddit.com',
+                       **kwargs):
+    iter_links = {'json': iter_json_links, 'html': iter_html_links}[method]
+
+    with Downloader(save_dir, **kwargs) as downloader:
+        try:
+            for link in iter_links(subreddit, downloader.session, pages, base_url=base_url):
+                downloader.submit(link)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print('Could not read listing ({!r}), falling back to Selenium'.format(e))
+            for link in iter_selenium_links(subreddit, pages, base_url=base_url):
+                downloader.submit(link)
+
 
-    print('page: {}, images: {}'.format(i, len(links)))
\ No newline at end of file
+if __name__ == '__main__':
+    subreddit = input('Enter subreddit name: ')
+    save_dir = input('Enter name of folder to save images in: ')
+    # Images smaller than the crops of the largest training resolution, image_reshape.padded_size(1024),
+    # are never used, so don't download them
+    download_subreddit(subreddit, save_dir, min_size=1152)
@@ -1,62 +1,126 @@
+import json
 import os
 import numpy as np
 from PIL import Image
 
 
-def generate_square_crops(imgdir, savedir, crops_per_img=10, max_size=1024, filter=Image.BICUBIC):
+# Difference hash of an image: compares neighboring pixels of a small grayscale thumbnail. draft lets
+# the JPEG decoder skip most of the work by decoding at a fraction of the full size. Other formats (PNG,
+# WebP, ...) have no reduced size decoding and are decoded in full, bounded only by PIL's
+# Image.MAX_IMAGE_PIXELS, so hash as few of them as possible.
+def dhash(img, hash_size=8):
+    img.draft('L', (hash_size * 8, hash_size * 8))
+    img = img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(img, np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(''.join('1' if b else '0' for b in bits), 2)
+
+
+# Number of bits set in each 16 bit value
+_popcount16 = np.array([bin(i).count('1') for i in range(2 ** 16)], np.uint8)
+
+
+# Number of bits in which the 64 bit hash h differs from each of hashes, an array of np.uint64
+def hamming_distances(hashes, h):
+    return _popcount16[(hashes ^ np.uint64(h)).view(np.uint16)].reshape(len(hashes), 4).sum(1)
+
+
+# Returns the image files of img_files that should be used for the dataset. Images whose header can't be
+# read or that are smaller than min_size are rejected first, from the headers alone. Only the images left
+# are decoded to find perceptual duplicates of an earlier image, whose hashes differ in at most
+# max_distance bits, as resized or re-encoded copies rarely have exactly the same hash. Rejections are
+# appended to report_path.
+def validate_images(img_files, min_size=1024, report_path=None, max_distance=6):
+    rejected = []
+
+    # Image.open only reads the header, the image data is not decoded
+    candidates = []
+    for f in img_files:
+        try:
+            with Image.open(f) as img:
+                width, height = img.size
+        except OSError as e:
+            rejected.append({'file': f, 'reason': 'corrupt', 'error': str(e)})
+            continue
+
+        if width < min_size or height < min_size:
+            rejected.append({'file': f, 'reason': 'too small', 'size': [width, height]})
+            continue
+        candidates.append(f)
+
+    # Hashes of the valid images in the same order
+    valid = []
+    hashes = np.zeros(len(candidates), np.uint64)
+    for f in candidates:
+        try:
+            with Image.open(f) as img:
+                h = dhash(img)
+        except OSError as e:
+            rejected.append({'file': f, 'reason': 'corrupt', 'error': str(e)})
+            continue
+
+        distances = hamming_distances(hashes[:len(valid)], h)
+        if len(valid) and distances.min() <= max_distance:
+            nearest = int(np.argmin(distances))
+            rejected.append({'file': f, 'reason': 'duplicate', 'duplicate_of': valid[nearest],
+                             'distance': int(distances[nearest])})
+            continue
+        hashes[len(valid)] = h
+        valid.append(f)
+
+    if report_path is not None:
+        with open(report_path, 'a') as report:
+            for r in rejected:
+                report.write(json.dumps(r) + '\n')
+
+    print('Validated {} images: {} accepted, {} rejected'.format(len(img_files), len(valid), len(rejected)))
+    return valid
+
+
+# Side of the stored images of resolution size, a margin larger so windows of size can be cut at an offset
+def padded_size(size, margin=0.125):
+    return size + int(size * margin)
+
+
+# Saves a single square crop from the center of each image, resized to padded_size(max_size, margin).
+# Mirrored and shifted copies are not stored, FeedDict mirrors the images and cuts them at random offsets
+# while training.
+def generate_square_crops(imgdir, savedir, max_size=1024, margin=0.125, filter=Image.BICUBIC):
 
     img_files = [os.path.join(imgdir, f) for f in os.listdir(imgdir)]
+    report_path = os.path.join(savedir, 'rejected.jsonl')
     savedir = os.path.join(savedir, '_temp')
     if not os.path.exists(savedir): os.makedirs(savedir)
 
+    # Images smaller than the crops would be upscaled, and the largest resolution trained on interpolation
+    crop_size = padded_size(max_size, margin)
+    img_files = validate_images(img_files, crop_size, report_path)
+
     for i, f in enumerate(img_files):
 
         with Image.open(f) as img:
             width, height = img.size
-
-            if width < max_size or height < max_size: continue
-
-            landscape = width > height
-            if landscape:
-                new_height = max_size
-                new_width = int(width * (max_size / height))
-                offset = int(max_size * (width / height - 1) + 1)
-            else:
-                new_width = max_size
-                new_height = int(height * (max_size / width))
-                offset = int(max_size * (height / width - 1) + 1)
-
-            n_crops = min(offset, crops_per_img)
-            window_slide_len = offset / n_crops
+            side = min(width, height)
+            left, top = (width - side) // 2, (height - side) // 2
 
             try:
                 img = img.convert('RGB')
-                img = img.resize((new_width, new_height), filter)
-
-                for j in range(n_crops):
-                    shift = int(j * window_slide_len)
-
-                    if landscape: window = (shift, 0, max_size + shift, max_size)
-                    else: window = (0, shift, max_size, max_size + shift)
-
-                    cropped_img = img.crop(window)
-                    mirror_img = cropped_img.transpose(Image.FLIP_LEFT_RIGHT)
-
-                    path = os.path.join(savedir, 'img_{}_{}.jpg'.format(i, j))
-                    mirror_path = os.path.join(savedir, 'img_{}_{}_mirror.jpg'.format(i, j))
-                    cropped_img.save(path, "JPEG")
-                    mirror_img.save(mirror_path, "JPEG")
+                img = img.resize((crop_size, crop_size), filter, box=(left, top, left + side, top + side))
+                img.save(os.path.join(savedir, 'img_{}.jpg'.format(i)), "JPEG")
 
                 print('Processed {}\n'.format(f))
 
-            except OSError:
-                continue
+            # Images can still be truncated past the part read during validation
+            except OSError as e:
+                with open(report_path, 'a') as report:
+                    report.write(json.dumps({'file': f, 'reason': 'corrupt', 'error': str(e)}) + '\n')
 
 
+# Arrays of resolution s hold images of padded_size(s, margin), use margin=0 for images of exactly s
 def resize(savedir, NCHW=True, min_size=4, max_size=1024, max_mem=0.8,
-           use_uint8=True, filter=Image.BICUBIC):
+           use_uint8=True, margin=0.125, filter=Image.BICUBIC):
 
-    img_files = [os.path.join(savedir, '_temp', f) for f in os.listdir(imgdir)]
+    img_files = [os.path.join(savedir, '_temp', f) for f in os.listdir(os.path.join(savedir, '_temp'))]
     np.random.shuffle(img_files)
     savedir = os.path.join(savedir, 'memmaps')
     if not os.path.exists(savedir): os.makedirs(savedir)
@@ -71,8 +135,9 @@ def resize(savedir, NCHW=True, min_size=4, max_size=1024, max_mem=0.8,
     max_bytes = max_mem * 1e9
 
     for s in sizes:
-        max_imgs = int(max_bytes / (pixel_bytes * s ** 2))
-        batch_shape = (max_imgs, 3, s, s) if NCHW else (max_imgs, s, s, 3)
+        p = padded_size(s, margin)
+        max_imgs = int(max_bytes / (pixel_bytes * p ** 2))
+        batch_shape = (max_imgs, 3, p, p) if NCHW else (max_imgs, p, p, 3)
         batch = np.zeros(batch_shape, np.uint8)
         img_count = 0
         batch_count = 0
@@ -82,8 +147,8 @@ def resize(savedir, NCHW=True, min_size=4, max_size=1024, max_mem=0.8,
             with Image.open(f) as img:
                 width, height = img.size
 
-                if width != s and height != s:
-                    img = img.resize((s, s), filter)
+                if width != p and height != p:
+                    img = img.resize((p, p), filter)
                 img = np.asarray(img, np.uint8)
                 if NCHW:
                     img = np.transpose(img, (2, 0, 1))
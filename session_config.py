@@ -0,0 +1,172 @@
+import itertools
+import json
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
+
+
+'''
+Session configuration for training on CPU. Options are kept as a plain dict so they can be saved as
+JSON in the logdir, where ProGAN picks them up when it creates its session:
+
+    intra_op_threads    threads used within a single op, 0 lets TensorFlow decide
+    inter_op_threads    threads used to run independent ops in parallel, 0 lets TensorFlow decide
+    xla                 enable XLA JIT compilation of the graph (auto-clustering), on CPU through
+                        TF_XLA_FLAGS, which TensorFlow reads when the process creates its first session
+    opt_level           graph optimizer level, 1 (default) or 0 to disable common subexpression
+                        elimination and constant folding
+    rewrite_options     dict of grappler optimizers to turn on (True) or off (False), e.g.
+                        {'remapping': False, 'layout_optimizer': False}
+
+autotune sweeps thread counts and XLA on the current layer of a ProGAN and saves the fastest options.
+The intra-op thread pool belongs to the process and is sized by its first session, so every candidate
+is timed in a new process with a ProGAN of its own, as the options will be used when training starts.
+'''
+
+config_filename = 'session_config.json'
+
+
+def make_config(intra_op_threads=0, inter_op_threads=0, xla=False, opt_level=1, rewrite_options=None,
+                per_session_threads=False):
+    if xla:
+        enable_cpu_jit()
+
+    config = tf.ConfigProto(
+        intra_op_parallelism_threads=intra_op_threads,
+        inter_op_parallelism_threads=inter_op_threads,
+        use_per_session_threads=per_session_threads
+    )
+
+    optimizer_options = config.graph_options.optimizer_options
+    optimizer_options.opt_level = tf.OptimizerOptions.L1 if opt_level else tf.OptimizerOptions.L0
+    optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1 if xla else tf.OptimizerOptions.OFF
+
+    for name, enabled in (rewrite_options or {}).items():
+        toggle = rewriter_config_pb2.RewriterConfig.ON if enabled else rewriter_config_pb2.RewriterConfig.OFF
+        setattr(config.graph_options.rewrite_options, name, toggle)
+
+    return config
+
+
+# Let global_jit_level also cluster ops placed on the CPU. Only has an effect before the first session of
+# the process is created.
+def enable_cpu_jit():
+    flags = os.environ.get('TF_XLA_FLAGS', '')
+    if '--tf_xla_cpu_global_jit' not in flags.split():
+        os.environ['TF_XLA_FLAGS'] = (flags + ' --tf_xla_cpu_global_jit').strip()
+
+
+def load(logdir):
+    path = os.path.join(logdir, config_filename)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return None
+
+
+def save(options, logdir):
+    if not os.path.exists(logdir): os.makedirs(logdir)
+    with open(os.path.join(logdir, config_filename), 'w') as f:
+        json.dump(options, f, indent=4)
+
+
+# Options swept by autotune: thread counts around the number of cores, with and without XLA
+def default_candidates():
+    cores = os.cpu_count() or 1
+    intra = sorted({cores, max(1, cores // 2), max(1, cores // 4)})
+    inter = [1, 2]
+    return [{'intra_op_threads': a, 'inter_op_threads': b, 'xla': x}
+            for a, b, x in itertools.product(intra, inter, [False, True])]
+
+
+# Number of images per second trained on by the training steps of network at batch_size in the session of
+# progan
+def throughput(progan, network, batch_size, n_steps):
+    feed_dict = {
+        progan.x_placeholder: progan.feed.next_batch(batch_size, network.dim),
+        progan.z_placeholder: progan._z(batch_size)
+    }
+
+    # The first steps include graph optimization and compilation, which XLA does separately for
+    # each combination of fetches, so they are run the same way as the timed steps
+    for _ in range(2):
+        progan.sess.run(network.g_train, feed_dict)
+        progan.sess.run(network.d_train, feed_dict)
+
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        progan.sess.run(network.g_train, feed_dict)
+        progan.sess.run(network.d_train, feed_dict)
+    return n_steps * batch_size / (time.perf_counter() - start)
+
+
+# Build a ProGAN from progan_kwargs with the session options in a process of its own and put the layer and
+# its throughput on results. The layer is that of the latest checkpoint in logdir unless one is given. The
+# model is built in an empty logdir, so nothing is written next to the real checkpoints.
+def _throughput_process(progan_kwargs, options, layer, n_steps, results):
+    from progan_v16 import ProGAN
+
+    logdir = tempfile.mkdtemp()
+    try:
+        progan = ProGAN(**dict(progan_kwargs, logdir=logdir, session_options=options))
+        if layer is None:
+            checkpoint = tf.train.latest_checkpoint(progan_kwargs['logdir'])
+            if checkpoint is not None:
+                progan.total_imgs.load(tf.train.load_variable(checkpoint, progan.total_imgs.op.name), progan.sess)
+            layer = int(progan.sess.run(progan.layer))
+
+        network = progan.networks[layer]
+        batch_size = progan.batch_sizes[layer]
+        results.put({'layer': layer, 'dim': network.dim, 'batch_size': batch_size,
+                     'imgs_per_sec': throughput(progan, network, batch_size, n_steps)})
+    finally:
+        shutil.rmtree(logdir, ignore_errors=True)
+
+
+# Layer, resolution, batch size and images per second of a ProGAN built from progan_kwargs training with the session
+# options, measured in a new process (see _throughput_process). Raises RuntimeError if the process died.
+def measure(progan_kwargs, options, layer=None, n_steps=10):
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=_throughput_process, args=(progan_kwargs, options, layer, n_steps, results))
+    process.start()
+
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError('Timing {} failed, see the error above'.format(options or 'default'))
+    process.join()
+    return result
+
+
+# Time training steps of the current layer of the ProGAN built from progan_kwargs with each candidate set
+# of options, save the fastest to its logdir and return it. The first candidate is the default
+# configuration.
+def autotune(progan_kwargs, candidates=None, n_steps=10, save_result=True):
+    candidates = [{}] + (candidates if candidates is not None else default_candidates())
+
+    results, layer = [], None
+    for options in candidates:
+        result = measure(progan_kwargs, options, layer, n_steps)
+        layer = result['layer']
+        results.append(result['imgs_per_sec'])
+        print('{}x{} ---- {} ---- images/sec: {:.2f}'.format(
+            result['dim'], result['dim'], options or 'default', result['imgs_per_sec']))
+
+    best = int(np.argmax(results))
+    print('fastest: {} ---- {:.1f}% of default throughput'.format(
+        candidates[best] or 'default', 100 * results[best] / results[0]))
+
+    if save_result:
+        save(candidates[best], progan_kwargs['logdir'])
+    return candidates[best]
@@ -0,0 +1,72 @@
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+'''
+Shared fixtures. Tests run on CPU without network access, remote servers are replaced by a local
+http.server running in a thread.
+'''
+
+
+# Start local HTTP servers for a test. serve(routes) serves routes, a dict of request paths including the
+# query string to (content type, bytes), and returns the base URL and the list of paths requested so far.
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(routes):
+        requested = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requested.append(self.path)
+                if self.path not in routes:
+                    self.send_error(404)
+                    return
+                content_type, body = routes[self.path]
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return 'http://127.0.0.1:{}'.format(server.server_address[1]), requested
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+# Directory of tiny uint8 memmap arrays at 4x4 and 8x8, for models built with feed_options={'max_size': 8}
+@pytest.fixture
+def tiny_imgdir(tmp_path):
+    imgdir = tmp_path / 'memmaps'
+    imgdir.mkdir()
+    random = np.random.RandomState(0)
+    for res in (4, 8):
+        for i in range(2):
+            imgs = random.randint(0, 256, [32, 3, res, res]).astype(np.uint8)
+            np.save(str(imgdir / '{}_{}.npy'.format(res, i)), imgs)
+    return str(imgdir)
+
+
+# ProGAN keyword arguments of a tiny model of two layers, 4x4 and 8x8, training on tiny_imgdir
+@pytest.fixture
+def tiny_progan_kwargs(tmp_path, tiny_imgdir):
+    return {'logdir': str(tmp_path / 'logdir'), 'imgdir': tiny_imgdir, 'scaling_factor': 64,
+            'batch_sizes': [4, 4], 'use_uint8': True, 'n_imgs': 64, 'ema_decay': None, 'prewarm_imgs': None,
+            'feed_options': {'max_size': 8}}
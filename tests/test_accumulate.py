@@ -0,0 +1,56 @@
+import numpy as np
+import tensorflow as tf
+
+from progan_v16 import ProGAN
+
+
+def test_accum_steps_per_layer(tiny_progan_kwargs):
+    with tf.Graph().as_default():
+        progan = ProGAN(**dict(tiny_progan_kwargs, n_imgs=8, accum_steps=[1, 2]))
+
+        # Only the layer with several micro-batches goes through the accumulators
+        assert progan.networks[0].g_accumulate is None
+        assert progan.networks[1].g_accumulate is not None
+
+        progan.train()
+        # Both layers are trained to the end, 8 images per update at the second
+        assert progan.sess.run(progan.total_imgs) == 24
+        assert all(np.all(np.isfinite(v)) for v in progan.sess.run(tf.trainable_variables()))
+        progan.sess.close()
+
+
+def test_micro_batches_match_one_batch(tiny_progan_kwargs):
+    # Minibatch stddev groups take every other image of a batch of 8 with a group size of 4, which are the
+    # images of one micro-batch
+    with tf.Graph().as_default():
+        progan = ProGAN(**dict(tiny_progan_kwargs, accum_steps=2, stddev_group_size=4))
+        network = progan.networks[1]
+        g_vars = progan._layer_vars('Generator', 2)
+        z = np.random.RandomState(0).normal(size=[8, progan.z_length])
+        start = progan.sess.run(tf.global_variables())
+
+        def reset():
+            for var, value in zip(tf.global_variables(), start):
+                var.load(value, progan.sess)
+
+        # The averaged gradients of two micro-batches are the gradients of the batch of both
+        for micro_batch in (z[0::2], z[1::2]):
+            progan.sess.run(network.g_accumulate, {progan.z_placeholder: micro_batch})
+        *accumulated, count = progan.sess.run(network.g_accumulators)
+        assert count == 2
+        progan.sess.run(network.g_apply)
+        accumulated_update = progan.sess.run(g_vars)
+
+        reset()
+        progan.sess.run(network.g_accumulate, {progan.z_placeholder: z})
+        *batch_grads, count = progan.sess.run(network.g_accumulators)
+        assert count == 1
+        for a, b in zip(accumulated, batch_grads):
+            np.testing.assert_allclose(a / 2, b, rtol=1e-4, atol=1e-6)
+
+        # And applying them updates the generator as one step on the whole batch does
+        reset()
+        progan.sess.run(network.g_train, {progan.z_placeholder: z})
+        for a, b in zip(accumulated_update, progan.sess.run(g_vars)):
+            np.testing.assert_allclose(a, b, rtol=1e-4, atol=1e-6)
+        progan.sess.close()
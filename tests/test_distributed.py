@@ -0,0 +1,108 @@
+import multiprocessing as mp
+import os
+import socket
+import types
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import distributed
+from distributed import Communicator
+from feed_dict import FeedDict
+from progan_v16 import ProGAN
+
+
+def _address():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return 'localhost', s.getsockname()[1]
+
+
+def _communicate(rank, n_workers, address, results):
+    communicator = Communicator(rank, n_workers, address, timeout=30)
+    summed = communicator.allreduce([np.full(3, rank), np.array(rank * 10.0)])
+    message = communicator.broadcast('from the chief' if communicator.is_chief else None)
+    communicator.barrier()
+    communicator.close()
+    results.put((rank, [a.tolist() for a in summed], message))
+
+
+def _connect_and_die(address):
+    Communicator(1, 2, address, timeout=30)
+    os._exit(1)
+
+
+# Train a few steps as one of the workers and report a checksum of the variables
+def _train(rank, n_workers, address, progan_kwargs, results):
+    communicator = Communicator(rank, n_workers, address, timeout=60)
+    logdir = '{}_{}'.format(progan_kwargs['logdir'], rank)
+    progan = ProGAN(communicator=communicator, **dict(progan_kwargs, logdir=logdir))
+    progan.train(n_steps=4)
+    checksum = sum(float(np.sum(v)) for v in progan.sess.run(tf.trainable_variables()))
+    results.put((rank, checksum, int(progan.sess.run(progan.total_imgs))))
+    communicator.close()
+
+
+def _run(target, n_workers, *args):
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    workers = [ctx.Process(target=target, args=(rank, n_workers) + args + (results,))
+               for rank in range(n_workers)]
+    for w in workers:
+        w.start()
+    out = sorted(results.get(timeout=300) for _ in workers)
+    for w in workers:
+        w.join()
+    return out
+
+
+def test_allreduce_and_broadcast():
+    results = _run(_communicate, 3, _address())
+    for rank, summed, message in results:
+        assert summed == [[3.0, 3.0, 3.0], 30.0]
+        assert message == 'from the chief'
+
+
+def test_dead_worker_raises():
+    address = _address()
+    worker = mp.get_context('spawn').Process(target=_connect_and_die, args=(address,))
+    worker.start()
+    communicator = Communicator(0, 2, address, timeout=30, recv_timeout=30)
+    worker.join()
+    with pytest.raises(ConnectionError):
+        communicator.allreduce([np.zeros(3)])
+    communicator.close()
+
+
+def test_missing_worker_times_out():
+    with pytest.raises(TimeoutError):
+        Communicator(0, 2, _address(), timeout=1)
+
+
+def test_workers_train_in_lockstep(tiny_progan_kwargs):
+    results = _run(_train, 2, _address(), tiny_progan_kwargs)
+    (_, checksum_0, total_0), (_, checksum_1, total_1) = results
+    assert checksum_0 == checksum_1
+    assert total_0 == total_1 == 16
+
+
+def test_launch_raises_when_workers_die(tmp_path, tiny_progan_kwargs):
+    progan_kwargs = dict(tiny_progan_kwargs, imgdir=str(tmp_path / 'missing'))
+    with pytest.raises(RuntimeError):
+        distributed.launch(2, progan_kwargs, n_steps=1, address=_address())
+
+
+def test_worker_batches_cover_the_arrays(tmp_path, tiny_imgdir):
+    feeds = [FeedDict(tiny_imgdir, str(tmp_path), shuffle=False, augment=False, max_size=8, worker_index=i,
+                      n_workers=2, seed=0) for i in range(2)]
+    batches = [feed.next_batch(16, 4) for feed in feeds]
+    array = np.load(os.path.join(tiny_imgdir, '4_0.npy'))
+    assert np.array_equal(np.stack(batches, 1).reshape(array.shape), array)
+
+
+def test_rejects_too_few_images_per_worker(tiny_progan_kwargs):
+    communicator = types.SimpleNamespace(n_workers=4, rank=0)
+    with tf.Graph().as_default():
+        with pytest.raises(ValueError):
+            ProGAN(communicator=communicator, **tiny_progan_kwargs)
@@ -0,0 +1,203 @@
+import io
+import json
+import os
+
+import numpy as np
+import pytest
+import requests
+from PIL import Image
+
+from scripts import downloader as downloader_module
+from scripts.downloader import Downloader, download_subreddit, iter_html_links, iter_json_links
+
+fixture_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def _png(seed, size=64):
+    pixels = np.random.RandomState(seed).randint(0, 256, [size, size, 3], dtype=np.uint8)
+    f = io.BytesIO()
+    Image.fromarray(pixels).save(f, format='PNG')
+    return f.getvalue()
+
+
+def _image_routes():
+    a, c = _png(0), _png(1)
+    return {'/a.png': ('image/png', a), '/copy_of_a.png': ('image/png', a), '/c.png': ('image/png', c)}
+
+
+def _image_files(save_dir):
+    return sorted(f for f in os.listdir(save_dir) if f != Downloader.state_filename)
+
+
+def test_dedupes_urls_and_content(serve, tmp_path):
+    routes = _image_routes()
+    base_url, requested = serve(routes)
+
+    with Downloader(str(tmp_path), n_threads=2) as downloader:
+        for path in ['/a.png', '/a.png', '/copy_of_a.png', '/c.png']:
+            downloader.submit(base_url + path)
+
+    # The repeated link is never fetched, the copy is fetched but not stored
+    assert sorted(requested) == ['/a.png', '/c.png', '/copy_of_a.png']
+    assert (downloader.n_downloaded, downloader.n_duplicates) == (2, 1)
+    assert len(_image_files(str(tmp_path))) == 2
+
+
+def test_streams_to_disk(serve, tmp_path):
+    routes = _image_routes()
+    base_url, _ = serve(routes)
+
+    # Images are many chunks long
+    with Downloader(str(tmp_path), chunk_size=1024) as downloader:
+        filename = downloader.submit(base_url + '/c.png').result()
+
+    assert len(routes['/c.png'][1]) > 4 * 1024
+    with open(os.path.join(str(tmp_path), filename), 'rb') as f:
+        assert f.read() == routes['/c.png'][1]
+    assert not [f for f in os.listdir(str(tmp_path)) if f.endswith('.part')]
+
+
+def test_resumes_from_state(serve, tmp_path):
+    base_url, requested = serve(_image_routes())
+    urls = [base_url + path for path in ['/a.png', '/copy_of_a.png', '/c.png']]
+
+    with Downloader(str(tmp_path)) as downloader:
+        for url in urls:
+            downloader.submit(url)
+    n_requests = len(requested)
+    files = _image_files(str(tmp_path))
+
+    with Downloader(str(tmp_path)) as downloader:
+        assert all(downloader.submit(url) is None for url in urls)
+    assert len(requested) == n_requests
+    assert _image_files(str(tmp_path)) == files
+
+    with open(os.path.join(str(tmp_path), Downloader.state_filename)) as f:
+        assert sorted(json.loads(line)['url'] for line in f) == sorted(urls)
+
+
+def test_forgets_deleted_files(serve, tmp_path):
+    routes = _image_routes()
+    routes['/another_copy_of_a.png'] = routes['/a.png']
+    base_url, _ = serve(routes)
+
+    with Downloader(str(tmp_path)) as downloader:
+        filename = downloader.submit(base_url + '/a.png').result()
+    os.remove(os.path.join(str(tmp_path), filename))
+
+    # The same image under a new link is stored again instead of counted as a duplicate of a missing file
+    with Downloader(str(tmp_path)) as downloader:
+        assert filename not in downloader.hashes.values()
+        assert downloader.submit(base_url + '/another_copy_of_a.png').result() == filename
+    assert os.path.exists(os.path.join(str(tmp_path), filename))
+
+
+def _fixture(filename, base_url):
+    with open(os.path.join(fixture_dir, filename)) as f:
+        return f.read().replace('{base_url}', base_url).encode()
+
+
+# Serve two pages of saved listings of r/test in HTML and JSON and the images they link to
+def _serve_listings(serve, json_page1='listing_page1.json'):
+    routes = dict()
+    base_url, requested = serve(routes)
+    routes.update({
+        '/r/test/': ('text/html', _fixture('listing_page1.html', base_url)),
+        '/r/test/?count=25&after=t3_b': ('text/html', _fixture('listing_page2.html', base_url)),
+        '/r/test/.json?limit=100': ('application/json', _fixture(json_page1, base_url)),
+        '/r/test/.json?limit=100&after=t3_b': ('application/json', _fixture('listing_page2.json', base_url)),
+    })
+    for i in (1, 2, 4):
+        routes['/img/{}.jpg'.format(i)] = ('image/jpeg', _png(i))
+    return base_url, requested
+
+
+def test_html_links(serve):
+    base_url, _ = _serve_listings(serve)
+    with requests.Session() as session:
+        links = list(iter_html_links('test', session, base_url=base_url))
+    assert links == [base_url + '/img/{}.jpg'.format(i) for i in (1, 2, 4)]
+
+
+def test_json_links(serve):
+    base_url, _ = _serve_listings(serve)
+    with requests.Session() as session:
+        links = list(iter_json_links('test', session, base_url=base_url))
+    assert links == [base_url + '/img/{}.jpg'.format(i) for i in (1, 2, 4)]
+
+
+def test_pages_limit(serve):
+    base_url, requested = _serve_listings(serve)
+    with requests.Session() as session:
+        links = list(iter_json_links('test', session, pages=1, base_url=base_url))
+    assert len(links) == 2 and requested == ['/r/test/.json?limit=100']
+
+
+@pytest.mark.parametrize('method', ['json', 'html'])
+def test_download_subreddit(serve, tmp_path, method):
+    base_url, requested = _serve_listings(serve)
+    download_subreddit('test', str(tmp_path), method=method, base_url=base_url)
+
+    assert sorted(p for p in requested if p.startswith('/img/')) == ['/img/1.jpg', '/img/2.jpg', '/img/4.jpg']
+    assert len(_image_files(str(tmp_path))) == 3
+
+
+def test_malformed_listing_falls_back_to_selenium(serve, tmp_path, monkeypatch):
+    base_url, _ = _serve_listings(serve, json_page1='listing_malformed.json')
+    calls = []
+
+    def fake_selenium_links(subreddit, pages=100, base_url=None, extensions=('.jpg',)):
+        calls.append((subreddit, base_url))
+        yield base_url + '/img/1.jpg'
+
+    monkeypatch.setattr(downloader_module, 'iter_selenium_links', fake_selenium_links)
+    download_subreddit('test', str(tmp_path), method='json', base_url=base_url)
+
+    assert calls == [('test', base_url)]
+    assert len(_image_files(str(tmp_path))) == 1
+
+
+def _rejected(save_dir):
+    with open(os.path.join(save_dir, Downloader.state_filename)) as f:
+        return {json.loads(line)['url']: json.loads(line).get('rejected') for line in f}
+
+
+def test_min_size_rejects_small_images(serve, tmp_path):
+    base_url, _ = serve({'/small.png': ('image/png', _png(0, size=32)), '/large.png': ('image/png', _png(1))})
+
+    with Downloader(str(tmp_path), min_size=64, chunk_size=1024) as downloader:
+        assert downloader.submit(base_url + '/small.png').result() is None
+        filename = downloader.submit(base_url + '/large.png').result()
+
+    assert _image_files(str(tmp_path)) == [filename]
+    assert _rejected(str(tmp_path))[base_url + '/small.png'] == 'too small (32x32)'
+    assert downloader.n_rejected == 1
+
+
+def test_min_size_rejects_non_images(serve, tmp_path, monkeypatch):
+    base_url, _ = serve({'/page.html': ('text/html', b'<html>' + b' ' * 2 ** 20 + b'</html>')})
+    calls = []
+
+    def image_size(data):
+        calls.append(len(data))
+        return None
+    monkeypatch.setattr(downloader_module, 'image_size', image_size)
+
+    # Only the first header_size bytes are looked at
+    with Downloader(str(tmp_path), min_size=64, chunk_size=1024, header_size=4096) as downloader:
+        assert downloader.submit(base_url + '/page.html').result() is None
+
+    assert calls == [1024, 2048, 3072, 4096]
+    assert _rejected(str(tmp_path))[base_url + '/page.html'] == 'not an image'
+    assert _image_files(str(tmp_path)) == []
+
+
+def test_cli_download(serve, tmp_path):
+    import cli
+
+    base_url, requested = _serve_listings(serve)
+    cli.main(['download', '--subreddit', 'test', '--savedir', str(tmp_path), '--base-url', base_url,
+              '--min-size', '0'])
+
+    assert sorted(p for p in requested if p.startswith('/img/')) == ['/img/1.jpg', '/img/2.jpg', '/img/4.jpg']
+    assert len(_image_files(str(tmp_path))) == 3
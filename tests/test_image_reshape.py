@@ -0,0 +1,80 @@
+import json
+
+import numpy as np
+from PIL import Image
+
+from scripts import image_reshape
+
+
+# A smooth random pattern, as photos have
+def _image(size, seed=0):
+    coarse = np.random.RandomState(seed).randint(0, 256, [8, 8, 3], dtype=np.uint8)
+    return Image.fromarray(coarse).resize((size, size), Image.BICUBIC)
+
+
+def _save(path, size, seed=0):
+    _image(size, seed).save(str(path))
+    return str(path)
+
+
+def test_filters_headers_before_decoding(tmp_path, monkeypatch):
+    a = _save(tmp_path / 'a.png', 64, seed=0)
+    copy_of_a = _save(tmp_path / 'copy_of_a.jpg', 64, seed=0)
+    small = _save(tmp_path / 'small.png', 16, seed=1)
+    corrupt = str(tmp_path / 'corrupt.jpg')
+    with open(corrupt, 'wb') as f:
+        f.write(b'not an image')
+
+    hashed = []
+    dhash = image_reshape.dhash
+
+    def recording_dhash(img, hash_size=8):
+        hashed.append(img.filename)
+        return dhash(img, hash_size)
+
+    monkeypatch.setattr(image_reshape, 'dhash', recording_dhash)
+    report_path = str(tmp_path / 'rejected.jsonl')
+    valid = image_reshape.validate_images([a, small, corrupt, copy_of_a], min_size=32, report_path=report_path)
+
+    # Images rejected from their headers are never decoded
+    assert valid == [a]
+    assert hashed == [a, copy_of_a]
+    with open(report_path) as f:
+        reasons = {r['file']: r['reason'] for r in map(json.loads, f)}
+    assert reasons == {small: 'too small', corrupt: 'corrupt', copy_of_a: 'duplicate'}
+
+
+def test_finds_near_duplicates(tmp_path):
+    a = _save(tmp_path / 'a.png', 256, seed=0)
+    b = _save(tmp_path / 'b.png', 256, seed=1)
+
+    # A slightly cropped, downscaled and recompressed repost of a
+    repost = str(tmp_path / 'repost.jpg')
+    _image(256, seed=0).crop((4, 0, 256, 252)).resize((200, 200), Image.BICUBIC).save(repost, quality=50)
+    with Image.open(a) as img_a, Image.open(repost) as img_repost:
+        distance = bin(image_reshape.dhash(img_a) ^ image_reshape.dhash(img_repost)).count('1')
+    assert 0 < distance <= 6
+
+    report_path = str(tmp_path / 'rejected.jsonl')
+    assert image_reshape.validate_images([a, b, repost], min_size=32, report_path=report_path) == [a, b]
+    with open(report_path) as f:
+        [r] = map(json.loads, f)
+    assert (r['file'], r['duplicate_of'], r['distance']) == (repost, a, distance)
+    assert image_reshape.validate_images([a, b, repost], min_size=32, max_distance=0) == [a, b, repost]
+
+
+def test_crops_are_never_upscaled(tmp_path):
+    imgdir = tmp_path / 'downloads'
+    imgdir.mkdir()
+    _save(imgdir / 'short.png', 34, seed=0)
+    _save(imgdir / 'large.png', 40, seed=1)
+
+    # Crops of 32x32 with the default margin are 36x36
+    image_reshape.generate_square_crops(str(imgdir), str(tmp_path), max_size=32)
+
+    [crop] = (tmp_path / '_temp').iterdir()
+    with Image.open(str(crop)) as img:
+        assert img.size == (36, 36)
+    with open(str(tmp_path / 'rejected.jsonl')) as f:
+        [r] = map(json.loads, f)
+    assert (r['file'], r['reason']) == (str(imgdir / 'short.png'), 'too small')
@@ -0,0 +1,30 @@
+import os
+
+import numpy as np
+
+import metrics
+
+
+def test_real_batches_sample_every_array(tiny_imgdir):
+    arrays = [np.load(os.path.join(tiny_imgdir, '8_{}.npy'.format(i))) for i in range(2)]
+    batches = list(metrics.iter_real_batches(tiny_imgdir, 8, 16, batch_size=4))
+
+    imgs = np.concatenate(batches)
+    assert len(imgs) == 16 and all(len(batch) <= 4 for batch in batches)
+    sources = [[i for i, array in enumerate(arrays) if (array == img).all(axis=(1, 2, 3)).any()]
+               for img in imgs]
+    assert all(len(s) == 1 for s in sources)
+    assert {s[0] for s in sources} == {0, 1}
+
+
+def test_real_descriptors_follow_the_arrays(tiny_imgdir, tmp_path):
+    cache_dir = str(tmp_path / 'logdir')
+    first = metrics.real_descriptors(tiny_imgdir, cache_dir, 8, n_images=16, nhoods_per_image=4)
+    cached = metrics.real_descriptors(tiny_imgdir, cache_dir, 8, n_images=16, nhoods_per_image=4)
+    assert all(np.array_equal(a, b) for a, b in zip(first, cached))
+
+    # Rebuilding the arrays invalidates the cached descriptors
+    path = os.path.join(tiny_imgdir, '8_0.npy')
+    np.save(path, 255 - np.load(path))
+    rebuilt = metrics.real_descriptors(tiny_imgdir, cache_dir, 8, n_images=16, nhoods_per_image=4)
+    assert not all(np.array_equal(a, b) for a, b in zip(first, rebuilt))
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from progan_v16 import ProGAN
+
+
+def _feed(progan, layer=1, batch_size=4):
+    np.random.seed(layer)
+    dim = progan.networks[layer].dim
+    return {progan.x_placeholder: progan.feed.next_batch(batch_size, dim),
+            progan.z_placeholder: np.random.normal(size=[batch_size, progan.z_length])}
+
+
+@pytest.mark.parametrize('precision', ['bfloat16', 'float16'])
+def test_reduced_precision_steps(tiny_progan_kwargs, precision):
+    with tf.Graph().as_default():
+        progan = ProGAN(precision=precision, **tiny_progan_kwargs)
+        for layer in range(progan.n_layers):
+            network = progan.networks[layer]
+            for _ in range(3):
+                progan.sess.run(network.g_train, _feed(progan, layer))
+                progan.sess.run(network.d_train, _feed(progan, layer))
+            wd, gp = progan.sess.run([network.wd, network.gp], _feed(progan, layer))
+            assert np.isfinite(wd) and np.isfinite(gp)
+
+        assert all(np.all(np.isfinite(v)) for v in progan.sess.run(tf.trainable_variables()))
+        progan.sess.close()
+
+
+def test_float16_overflow_skips_step(tiny_progan_kwargs):
+    with tf.Graph().as_default():
+        progan = ProGAN(precision='float16', **tiny_progan_kwargs)
+        network = progan.networks[1]
+        scale, good_steps = progan.d_loss_scale
+        d_vars = progan._layer_vars('Discriminator', 2)
+
+        # Gradients scaled this far overflow float16
+        scale.load(2.0 ** 100, progan.sess)
+        before = progan.sess.run(d_vars + [progan.global_step])
+        progan.sess.run(network.d_train, _feed(progan))
+        after = progan.sess.run(d_vars + [progan.global_step])
+
+        assert all(np.array_equal(b, a) for b, a in zip(before, after))
+        assert progan.sess.run(scale) == 2.0 ** 99
+        assert progan.sess.run(good_steps) == 0
+
+        # Without scaling nothing overflows, the step updates the variables and is counted
+        scale.load(1.0, progan.sess)
+        progan.sess.run(network.d_train, _feed(progan))
+        after = progan.sess.run(d_vars + [progan.global_step])
+        assert not all(np.array_equal(b, a) for b, a in zip(before, after))
+        assert progan.sess.run([scale, good_steps]) == [1.0, 1]
+        progan.sess.close()
+
+
+def test_rejects_unknown_precision(tiny_progan_kwargs):
+    with tf.Graph().as_default():
+        with pytest.raises(ValueError):
+            ProGAN(precision='float64', **tiny_progan_kwargs)
@@ -0,0 +1,172 @@
+import atexit
+import hashlib
+import os
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+'''
+RAM cache of the memmap arrays of small resolutions, shared between processes. All arrays of a pinned
+resolution (a tier) are copied once into a single multiprocessing.shared_memory block, and every other
+process using the same imgdir (data parallel workers, evaluation, preview jobs) attaches to that block
+and reads the images from it without copying them or touching the disk.
+
+Tiers are pinned from the smallest resolution up as long as they fit in budget_mb together, and never
+beyond the free space of /dev/shm. Blocks are named after imgdir and the names, sizes and modification
+times of the arrays, so arrays written again are never served from an old block.
+
+The process that creates a block removes it when it exits. Processes attached to it keep their mapping,
+later processes create the block again.
+'''
+
+# The first byte of a block is set once its arrays have been copied, the arrays start after the header
+_header_bytes = 64
+
+# Names of the blocks created by this process, which stay registered with its resource tracker
+_created = set()
+
+
+# Attach to an existing block without the resource tracker removing it when this process exits
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        if name not in _created:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def _free_shm_bytes():
+    if os.path.isdir('/dev/shm'):
+        stat = os.statvfs('/dev/shm')
+        return stat.f_bavail * stat.f_frsize
+    return None
+
+
+class TierCache:
+
+    def __init__(self, imgdir, budget_mb=1024, sizes=None, create=True, prefix='progan', timeout=600):
+        self.imgdir = imgdir
+        self.budget = int(budget_mb * 2 ** 20)
+        self.create = create
+        self.prefix = prefix
+        self.timeout = timeout
+
+        # SharedMemory block of every pinned resolution, the ones created by this process, and the array
+        # of every cached path
+        self.blocks = dict()
+        self.owned = []
+        self.arrays = dict()
+
+        files = sorted(os.listdir(imgdir))
+        self.tiers = dict()
+        for s in sizes or [2 ** i for i in range(2, 11)]:
+            paths = [os.path.join(imgdir, f) for f in files if f.startswith('{}_'.format(s))]
+            if paths:
+                self.tiers[s] = paths
+
+        for s in self.plan():
+            self._pin(s)
+        atexit.register(self.close)
+
+    # Resolutions that fit in the budget, filled from the smallest up
+    def plan(self):
+        budget = self.budget
+        free = _free_shm_bytes()
+        if free is not None:
+            budget = min(budget, free)
+
+        pinned, total = [], 0
+        for s in sorted(self.tiers):
+            size = _header_bytes + sum(np.load(p, mmap_mode='r').nbytes for p in self.tiers[s])
+            if total + size > budget:
+                break
+            pinned.append(s)
+            total += size
+        return pinned
+
+    def _block_name(self, res):
+        key = hashlib.md5(os.path.abspath(self.imgdir).encode())
+        for path in self.tiers[res]:
+            stat = os.stat(path)
+            key.update('{}:{}:{}'.format(os.path.basename(path), stat.st_size, stat.st_mtime_ns).encode())
+        return '{}_{}_{}'.format(self.prefix, key.hexdigest()[:12], res)
+
+    # Attach to the block of resolution res, or create and fill it if no other process has
+    def _pin(self, res):
+        memmaps = [np.load(p, mmap_mode='r') for p in self.tiers[res]]
+        size = _header_bytes + sum(m.nbytes for m in memmaps)
+        name = self._block_name(res)
+
+        created = False
+        try:
+            shm = _attach(name)
+        except FileNotFoundError:
+            if not self.create:
+                return
+            try:
+                shm = shared_memory.SharedMemory(name, create=True, size=size)
+                _created.add(name)
+                created = True
+            except FileExistsError:
+                shm = _attach(name)
+
+        arrays, offset = [], _header_bytes
+        for m in memmaps:
+            arrays.append(np.ndarray(m.shape, m.dtype, buffer=shm.buf, offset=offset))
+            offset += m.nbytes
+
+        if created:
+            self.owned.append(shm)
+            for array, m in zip(arrays, memmaps):
+                array[...] = m
+            shm.buf[0] = 1
+
+        # Wait for the process that created the block to finish copying, or read this tier from disk
+        start = time.time()
+        while shm.buf[0] != 1:
+            if time.time() - start > self.timeout:
+                print('Timed out waiting for shared memory block {}'.format(name))
+                del arrays
+                shm.close()
+                return
+            time.sleep(0.1)
+
+        self.blocks[res] = shm
+        self.arrays.update(zip(self.tiers[res], arrays))
+        print('{} {}x{} images in shared memory block {}'.format(
+            'Cached' if created else 'Attached to', res, res, name))
+
+    @property
+    def pinned(self): return sorted(self.blocks)
+
+    # Array of path in shared memory, or None if its resolution isn't pinned
+    def get(self, path):
+        return self.arrays.get(path)
+
+    # np.load that returns the shared array of path if there is one
+    def load(self, path, mmap_mode=None):
+        array = self.get(path)
+        return array if array is not None else np.load(path, mmap_mode=mmap_mode)
+
+    def nbytes(self):
+        return sum(shm.size for shm in self.blocks.values())
+
+    def close(self):
+        self.arrays = dict()
+        for shm in self.blocks.values():
+            try:
+                shm.close()
+            except BufferError:
+                # Arrays from the block are still in use, the mapping is released with the process
+                pass
+        for shm in self.owned:
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+            _created.discard(shm.name)
+        self.blocks, self.owned = dict(), []